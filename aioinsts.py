@@ -0,0 +1,663 @@
+#!/usr/bin/env python3
+"""asyncio versions of the BK9129B, BK8500 and TC0521 drivers.
+
+One event loop can drive any number of instruments without a thread per device, e.g.
+
+    loads = [await AsyncBkDcLoad_8500.open(port) for port in load_ports]
+    values = await asyncio.gather(*[load.get_present_values() for load in loads])
+
+The drivers are built by composition: the 8500 packet codec and shadow state live in an
+unconnected BkDcLoad_8500, the 9129B shadow state in a Bk9129BState, its batches are planned
+by Bk9129BBatch and the TC0521 frames decoded by tc0521.decode_status, only the transport is
+different.  None of the blocking methods are reachable from an async driver.  The 9129B is
+driven as a plain serial SCPI instrument (pyvisa has no asynchronous API).  Every driver
+keeps sample_t like the blocking ones, see bkinsts.sample_time()."""
+
+import asyncio
+import io
+import time
+import serial   # From official package 'pyserial'
+
+from bkinsts import BkDcLoad_8500, Bk9129BBatch, Bk9129BState, ChannelMeasurements, StateAttribute, sample_time
+from tc0521 import Tc0521, Tc0521Reading, decode_status, reading_property, take_frame, STATUS_FRAME_LENGTH, STATUS_CHECKSUM_BYTE
+
+class AsyncSerialTransport(object):
+    """    Non-blocking serial port for asyncio.
+    On POSIX the port's file descriptor is watched with loop.add_reader, on other platforms
+    the port is polled from a task on the event loop.  Received bytes are buffered until a
+    read_exactly() or read_until() claims them.  Writes are short command packets that fit in
+    the driver's transmit buffer, so they are handed straight to the port."""
+    
+    POLL_INTERVAL = 0.002   # Seconds between polls where the port has no usable file descriptor
+    
+    def __init__(self, sp, loop):
+        self.sp = sp
+        self.loop = loop
+        self.buffer = bytearray()
+        self.data_ready = asyncio.Event()
+        self.poller = None
+        try:
+            self.fd = sp.fileno()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            self.fd = None
+        if self.fd is not None:
+            loop.add_reader(self.fd, self.on_readable)
+        else:
+            self.poller = loop.create_task(self.poll())
+    
+    @classmethod
+    async def open(cls, device, baudrate=9600, **kwargs):
+        sp = serial.Serial(port=device, baudrate=baudrate, timeout=0, **kwargs)
+        return cls(sp, asyncio.get_running_loop())
+    
+    def on_readable(self):
+        try:
+            data = self.sp.read(self.sp.in_waiting or 1)
+        except serial.SerialException:
+            return
+        if data:
+            self.buffer += data
+            self.data_ready.set()
+    
+    async def poll(self):
+        while True:
+            if self.sp.in_waiting:
+                self.on_readable()
+            await asyncio.sleep(self.POLL_INTERVAL)
+    
+    def reset_input_buffer(self):
+        del self.buffer[:]
+        self.sp.reset_input_buffer()
+    
+    def write(self, data):
+        self.sp.write(data)
+    
+    async def wait_for_data(self, deadline):
+        self.data_ready.clear()
+        remaining = deadline - self.loop.time()
+        if remaining <= 0:
+            raise asyncio.TimeoutError()
+        await asyncio.wait_for(self.data_ready.wait(), remaining)
+    
+    async def read_exactly(self, n, timeout=1.0):
+        """Returns exactly n bytes, raises asyncio.TimeoutError if they do not arrive in time."""
+        deadline = self.loop.time() + timeout
+        while len(self.buffer) < n:
+            await self.wait_for_data(deadline)
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+    
+    async def read_until(self, terminator=b'\n', timeout=1.0):
+        """Returns bytes up to and including terminator, raises asyncio.TimeoutError if it does not arrive in time."""
+        deadline = self.loop.time() + timeout
+        while True:
+            end = self.buffer.find(terminator)
+            if end >= 0:
+                end += len(terminator)
+                data = bytes(self.buffer[:end])
+                del self.buffer[:end]
+                return data
+            await self.wait_for_data(deadline)
+    
+    async def read_available(self, timeout=1.0):
+        """Returns every byte received so far, waiting for at least one.  Raises asyncio.TimeoutError if none arrive in time."""
+        deadline = self.loop.time() + timeout
+        while not self.buffer:
+            await self.wait_for_data(deadline)
+        data = bytes(self.buffer)
+        del self.buffer[:]
+        return data
+    
+    @property
+    def baudrate(self):
+        return getattr(self.sp, 'baudrate', None)
+    
+    def close(self):
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+        if self.poller is not None:
+            self.poller.cancel()
+        self.sp.close()
+
+class AsyncBkDcLoad_8500(object):
+    """    asyncio driver for the BK8500 DC load, the methods of BkDcLoad_8500 but awaitable.
+    Create with 'await AsyncBkDcLoad_8500.open(device)'.  Packets are built and decoded by an
+    unconnected BkDcLoad_8500 (codec), which also holds the shadow state."""
+    
+    sample_offset = 0.0     # Seconds from the middle of the turnaround to the reading, see bkinsts.sample_time()
+    
+    def __init__(self, transport, cache=True, timeout=1.0, address=None):
+        self.transport = transport
+        self.timeout = timeout      # Seconds to wait for a response packet
+        self.codec = BkDcLoad_8500.unconnected(cache=cache, address=address)
+        self.lock = asyncio.Lock()  # One transaction at a time on the codec's packet buffers
+        self.sample_t = None        # Estimated time.monotonic() the last reading was taken
+        self.list_duration = None   # Seconds one pass of the last uploaded list takes
+    
+    @classmethod
+    async def open(cls, device, baudrate=9600, **kwargs):
+        transport = await AsyncSerialTransport.open(device, baudrate, write_timeout=5)
+        return cls(transport, **kwargs)
+    
+    @property
+    def interlock(self):
+        """interlock.Interlock guarding the input, enable_load() is refused while a trip is latched."""
+        return self.codec.interlock
+    
+    @interlock.setter
+    def interlock(self, interlock):
+        self.codec.interlock = interlock
+    
+    def invalidate_cache(self):
+        """Forget all shadow state, the next settings and readbacks go to the load."""
+        self.codec.invalidate_cache()
+    
+    async def receive(self, rx_view, length):
+        # A missing or short response is zero filled so it fails as a bad packet
+        try:
+            rx_view[:length] = await self.transport.read_exactly(length, self.timeout)
+        except asyncio.TimeoutError:
+            rx_view[:length] = bytes(length)
+    
+    async def transact(self):
+        """Send the packet in the codec's tx_buff and read the response into its rx_buff.  Caller holds the lock."""
+        codec = self.codec
+        start = time.monotonic()
+        self.transport.reset_input_buffer()
+        self.transport.write(codec.tx_buff)
+        await self.receive(codec.rx_view, codec.PACKET_LENGTH)
+        self.sample_t = sample_time(start, time.monotonic(), codec.PACKET_LENGTH, codec.PACKET_LENGTH,
+                                    self.transport.baudrate, self.sample_offset)
+    
+    async def send_command(self, cmd, arg=None):
+        codec = self.codec
+        codec.refuse(cmd)
+        async with self.lock:
+            result = codec.cached_result(cmd, arg)
+            if result is not codec.NOT_CACHED:
+                return result
+            
+            codec.encode_command(cmd, arg)
+            await self.transact()
+            return codec.decode_response(cmd, arg)
+    
+    async def read_present_counts(self):
+        """Poll GET_VALUES and return the raw (1mV, 0.1mA, 1mW) counts, None if the response is malformed."""
+        codec = self.codec
+        async with self.lock:
+            codec.encode_command(codec.cmd_get_present_values, None)
+            await self.transact()
+            return codec.present_counts()
+    
+    async def write_read_counts(self, cmd, arg):
+        """Send a setting and GET_VALUES back to back in one write, like BkDcLoad_8500.write_read_counts().
+        Returns (counts, accepted)."""
+        codec = self.codec
+        codec.refuse(cmd)
+        async with self.lock:
+            accepted = True
+            if codec.cached_result(cmd, arg) is codec.NOT_CACHED:
+                length = codec.PACKET_LENGTH
+                codec.encode_command(cmd, arg)
+                codec.pair_tx[:length] = codec.tx_buff
+                codec.encode_command(codec.cmd_get_present_values, None)
+                codec.pair_tx[length:] = codec.tx_buff
+                start = time.monotonic()
+                self.transport.reset_input_buffer()
+                self.transport.write(codec.pair_tx)
+                await self.receive(codec.pair_view, 2 * length)
+                # The read goes out second and is answered second
+                self.sample_t = sample_time(start, time.monotonic(), 2 * length, length, self.transport.baudrate, self.sample_offset)
+                codec.rx_view[:] = codec.pair_view[:length]
+                accepted = codec.setting_accepted(cmd, arg)
+                codec.rx_view[:] = codec.pair_view[length:]
+                return codec.present_counts(), accepted
+            codec.encode_command(codec.cmd_get_present_values, None)
+            await self.transact()
+            return codec.present_counts(), accepted
+    
+    async def resync(self):
+        """Read the mode, setpoints and limits back from the load into the shadow state."""
+        codec = self.codec
+        codec.invalidate_cache()
+        for cmd in (codec.cmd_get_max_voltage_limit, codec.cmd_get_max_current_limit, codec.cmd_get_max_power_limit, codec.cmd_get_mode,
+                    codec.cmd_get_cc_mode_current, codec.cmd_get_cv_mode_voltage, codec.cmd_get_cw_mode_power, codec.cmd_get_cr_mode_resistance,
+                    codec.cmd_get_uvlo_voltage):
+            await self.send_command(cmd)
+    
+    # Short methods for easy control:
+    
+    async def remote_control(self): await self.send_command(self.codec.cmd_remote_control)
+    
+    async def local_control(self): await self.send_command(self.codec.cmd_local_control)
+    
+    async def enable_load(self): await self.send_command(self.codec.cmd_enable_load)
+    
+    async def disable_load(self): await self.send_command(self.codec.cmd_disable_load)
+    
+    async def set_max_voltage_limit(self, max_voltage):
+        await self.send_command(self.codec.cmd_set_max_voltage_limit, max_voltage)
+    
+    async def get_max_voltage_limit(self):
+        return await self.send_command(self.codec.cmd_get_max_voltage_limit)
+    
+    async def set_max_current_limit(self, max_current):
+        await self.send_command(self.codec.cmd_set_max_current_limit, max_current)
+    
+    async def get_max_current_limit(self):
+        return await self.send_command(self.codec.cmd_get_max_current_limit)
+    
+    async def set_max_power_limit(self, max_power):
+        await self.send_command(self.codec.cmd_set_max_power_limit, max_power)
+    
+    async def get_max_power_limit(self):
+        return await self.send_command(self.codec.cmd_get_max_power_limit)
+    
+    async def set_mode(self, mode):
+        # mode = 'CC', 'CV', 'CW', 'CR'
+        await self.send_command(self.codec.cmd_set_mode, mode)
+    
+    async def get_mode(self):
+        return await self.send_command(self.codec.cmd_get_mode)
+    
+    async def set_current_setpoint(self, current):
+        await self.send_command(self.codec.cmd_set_cc_mode_current, current)
+    
+    async def get_current_setpoint(self):
+        return await self.send_command(self.codec.cmd_get_cc_mode_current)
+    
+    async def set_voltage_setpoint(self, voltage):
+        await self.send_command(self.codec.cmd_set_cv_mode_voltage, voltage)
+    
+    async def get_voltage_setpoint(self):
+        return await self.send_command(self.codec.cmd_get_cv_mode_voltage)
+    
+    async def set_power_setpoint(self, power):
+        await self.send_command(self.codec.cmd_set_cw_mode_power, power)
+    
+    async def get_power_setpoint(self):
+        return await self.send_command(self.codec.cmd_get_cw_mode_power)
+    
+    async def set_resistance_setpoint(self, resistance):
+        await self.send_command(self.codec.cmd_set_cr_mode_resistance, resistance)
+    
+    async def get_resistance_setpoint(self):
+        return await self.send_command(self.codec.cmd_get_cr_mode_resistance)
+    
+    async def set_uvlo_setpoint(self, voltage):
+        await self.send_command(self.codec.cmd_set_uvlo_voltage, voltage)
+    
+    async def get_uvlo_setpoint(self):
+        return await self.send_command(self.codec.cmd_get_uvlo_voltage)
+    
+    async def get_present_values(self):
+        return await self.send_command(self.codec.cmd_get_present_values)
+    
+    async def get_mfg_info(self):
+        return await self.send_command(self.codec.cmd_get_mfg_info)
+    
+    async def set_list_mode(self, mode):
+        await self.send_command(self.codec.cmd_set_list_mode, mode)
+    
+    async def get_list_mode(self):
+        return await self.send_command(self.codec.cmd_get_list_mode)
+    
+    async def set_list_repeat(self, repeat):
+        await self.send_command(self.codec.cmd_set_list_repeat, bool(repeat))
+    
+    async def get_list_repeat(self):
+        return await self.send_command(self.codec.cmd_get_list_repeat)
+    
+    async def set_list_step_count(self, count):
+        await self.send_command(self.codec.cmd_set_list_step_count, count)
+    
+    async def get_list_step_count(self):
+        return await self.send_command(self.codec.cmd_get_list_step_count)
+    
+    async def set_list_step(self, mode, step, value, seconds):
+        await self.send_command(self.codec.cmd_set_list_step[mode], (step, value, seconds))
+    
+    async def get_list_step(self, mode, step):
+        return await self.send_command(self.codec.cmd_get_list_step[mode], step)
+    
+    async def set_list_file_name(self, name):
+        await self.send_command(self.codec.cmd_set_list_file_name, name)
+    
+    async def get_list_file_name(self):
+        return await self.send_command(self.codec.cmd_get_list_file_name)
+    
+    async def set_list_partition(self, partition):
+        await self.send_command(self.codec.cmd_set_list_partition, partition)
+    
+    async def get_list_partition(self):
+        return await self.send_command(self.codec.cmd_get_list_partition)
+    
+    async def save_list(self, slot):
+        await self.send_command(self.codec.cmd_save_list, slot)
+    
+    async def recall_list(self, slot):
+        await self.send_command(self.codec.cmd_recall_list, slot)
+    
+    async def set_trigger_source(self, source):
+        await self.send_command(self.codec.cmd_set_trigger_source, source)
+    
+    async def get_trigger_source(self):
+        return await self.send_command(self.codec.cmd_get_trigger_source)
+    
+    async def trigger(self): await self.send_command(self.codec.cmd_trigger)
+    
+    async def set_function_mode(self, mode):
+        await self.send_command(self.codec.cmd_set_function_mode, mode)
+    
+    async def get_function_mode(self):
+        return await self.send_command(self.codec.cmd_get_function_mode)
+    
+    async def upload_list(self, mode, steps, repeat=False, name=None):
+        if not 2 <= len(steps) <= self.codec.MAX_LIST_STEPS:
+            raise ValueError('LIST NEEDS 2 TO %d STEPS' % self.codec.MAX_LIST_STEPS)
+        await self.set_list_mode(mode)
+        await self.set_list_repeat(repeat)
+        await self.set_list_step_count(len(steps))
+        for step, (value, seconds) in enumerate(steps, 1):
+            await self.set_list_step(mode, step, value, seconds)
+        if name is not None:
+            await self.set_list_file_name(name)
+        self.list_duration = sum(seconds for value, seconds in steps)
+    
+    async def run_list(self, duration=None, disable=True):
+        if duration is None:
+            duration = self.list_duration
+            if duration is None:
+                raise ValueError('NO LIST UPLOADED, GIVE A DURATION')
+        await self.set_trigger_source('BUS')
+        await self.set_function_mode('LIST')
+        await self.enable_load()
+        loop = asyncio.get_running_loop()
+        samples = []
+        try:
+            await self.trigger()
+            start = loop.time()
+            while True:
+                elapsed = loop.time() - start
+                if elapsed > duration:
+                    break
+                counts = await self.read_present_counts()
+                if counts is not None:
+                    samples.append((elapsed, counts[0] / 1000.0, counts[1] / 10000.0, counts[2] / 1000.0))
+        finally:
+            if disable:
+                await self.disable_load()
+        return samples
+    
+    def close(self):
+        self.transport.close()
+
+class AsyncBk9129BBatch(Bk9129BBatch):
+    """    Bk9129BBatch for the async supply, use it with 'async with supply.batch() as batch:'.
+    The lines are planned the same way, only sending them is awaited."""
+    
+    def __enter__(self):
+        raise TypeError('USE async with ON AN ASYNC BATCH')
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.send()
+    
+    async def send(self):
+        """Send the collected operations to the supply, update its shadow state and clear the batch."""
+        await self.supply.send(self.plan())
+
+class AsyncBkTrippleSupply_9129B(object):
+    """    asyncio driver for the BK9129B power supply, the methods of BkTrippleSupply_9129B but awaitable.
+    Create with 'await AsyncBkTrippleSupply_9129B.open(device)', device is the serial port name.
+    Writes are synchronized with *OPC? (pacing='opc') or followed by cmd_delay (pacing='fixed').
+    The shadow state and the commands for each operation come from a Bk9129BState, as on the
+    blocking driver, and outputs are not turned on while an interlock trip is latched."""
+    
+    sample_offset = 0.0     # Seconds from the middle of the turnaround to the reading, see bkinsts.sample_time()
+    interlock = StateAttribute('interlock')     # interlock.Interlock guarding the outputs
+    # Shadow state, see Bk9129BState
+    cache = StateAttribute('cache')
+    selected_channel = StateAttribute('selected_channel')
+    voltage_setpoint = StateAttribute('voltage_setpoint')
+    current_setpoint = StateAttribute('current_setpoint')
+    output_state = StateAttribute('output_state')
+    
+    def __init__(self, transport, pacing='opc', cache=True, timeout=1.0):
+        if pacing not in ('opc', 'fixed'):
+            raise ValueError('UNKNOWN PACING MODE ' + str(pacing))
+        self.transport = transport
+        self.pacing = pacing
+        self.cmd_delay = 0.1    # Seconds to wait after each command when pacing is 'fixed'
+        self.timeout = timeout  # Seconds to wait for a response line
+        self.state = Bk9129BState(cache)
+        self.lock = asyncio.Lock()
+        self.sample_t = None    # Estimated time.monotonic() the last query's reading was taken
+    
+    @classmethod
+    async def open(cls, device, baudrate=9600, **kwargs):
+        transport = await AsyncSerialTransport.open(device, baudrate)
+        supply = cls(transport, **kwargs)
+        if 'B&K Precision, 9129B' not in await supply.query("*IDN?"): # Verify expected instrument is present.
+            transport.close()
+            raise NameError('NO SUPPORTED POWER SUPPLIES FOUND')
+        await supply.write("*PSC ON")
+        await supply.write("*CLS")
+        await supply.write("*RST")
+        await supply.write("SYST:REM")
+        supply.invalidate_cache()
+        return supply
+    
+    async def raw_query(self, command):
+        self.transport.reset_input_buffer()
+        data = (command + '\n').encode()
+        start = time.monotonic()
+        self.transport.write(data)
+        response = await self.transport.read_until(b'\n', self.timeout)
+        self.sample_t = sample_time(start, time.monotonic(), len(data), len(response), self.transport.baudrate, self.sample_offset)
+        return response.decode().strip()
+    
+    async def query(self, command):
+        async with self.lock:
+            return await self.raw_query(command)
+    
+    async def write(self, command):
+        self.state.refuse(command)
+        async with self.lock:
+            if self.pacing == 'opc':
+                await self.raw_query(command + ';*OPC?')
+            else:
+                self.transport.write((command + '\n').encode())
+                await asyncio.sleep(self.cmd_delay)
+    
+    async def send(self, plan):
+        # Send the commands of a Bk9129BState plan, then record the state they leave
+        for command in plan.commands:
+            await self.write(command)
+        self.state.done(plan)
+    
+    async def errors(self):
+        errors = []
+        for i in range(20):
+            err = await self.query("SYST:ERR?")
+            if err.startswith('0') or err.startswith('+0'):
+                break
+            errors.append(err)
+        return errors
+    
+    def invalidate_cache(self):
+        """Forget all shadow state, the next operations are sent unconditionally."""
+        self.state.invalidate_cache()
+    
+    async def resync(self):
+        self.state.invalidate_cache()
+        self.state.resync(await self.query(self.state.RESYNC_QUERY))
+    
+    async def select_channel(self, chan):
+        await self.send(self.state.select_channel(chan))
+    
+    async def enable_output_all(self):
+        await self.send(self.state.enable_output_all())
+    
+    async def enable_output_ch(self, chan):
+        await self.send(self.state.enable_output_ch(chan))
+    
+    async def disable_output_all(self):
+        await self.send(self.state.disable_output_all())
+    
+    async def disable_output_ch(self, chan):
+        await self.send(self.state.disable_output_ch(chan))
+    
+    async def read_output_state_all(self):
+        """Reads the output state of every channel back from the supply, returns (CH1, CH2, CH3) booleans."""
+        self.state.selected_channel = None
+        return self.state.output_states(await self.query(self.state.OUTPUT_STATE_QUERY))
+    
+    async def set_current_ch(self, chan, current):
+        await self.send(self.state.set_current_ch(chan, current))
+    
+    async def set_voltage_ch(self, chan, voltage):
+        await self.send(self.state.set_voltage_ch(chan, voltage))
+    
+    async def get_current_setpoint_ch(self, chan):
+        current = self.state.known_setpoint(self.state.current_setpoint, chan)
+        if current is None:
+            await self.select_channel(chan)
+            current = float(await self.query("CURRent?"))
+            self.state.update_shadow(self.state.current_setpoint, chan, current)
+        return current
+    
+    async def get_voltage_setpoint_ch(self, chan):
+        voltage = self.state.known_setpoint(self.state.voltage_setpoint, chan)
+        if voltage is None:
+            await self.select_channel(chan)
+            voltage = float(await self.query("VOLTage?"))
+            self.state.update_shadow(self.state.voltage_setpoint, chan, voltage)
+        return voltage
+    
+    async def read_voltage_ch(self, chan):
+        await self.select_channel(chan)
+        return float(await self.query("VOLTage?"))
+    
+    async def measure_voltage_all(self):
+        return tuple(float(x) for x in (await self.query("MEASure:VOLTage:ALL?")).split(','))
+    
+    async def measure_current_all(self):
+        return tuple(float(x) for x in (await self.query("MEASure:CURRent:ALL?")).split(','))
+    
+    async def measure_all(self):
+        response = await self.query("MEASure:VOLTage:ALL?;:MEASure:CURRent:ALL?;:MEASure:POWer:ALL?")
+        return ChannelMeasurements(*[tuple(float(x) for x in part.split(',')) for part in response.split(';')])
+    
+    def batch(self):
+        """Returns an AsyncBk9129BBatch, use as 'async with supply.batch() as batch:'."""
+        return AsyncBk9129BBatch(self)
+    
+    async def apply_all(self, voltages, currents=None):
+        """Sets all three channel voltages (and optionally currents) at once with APPLy, arguments are 3 element sequences"""
+        async with self.batch() as b:
+            for chan in range(1, 4):
+                b.set_voltage_ch(chan, voltages[chan - 1])
+                if currents is not None:
+                    b.set_current_ch(chan, currents[chan - 1])
+    
+    async def close(self):
+        await self.disable_output_all()
+        await self.write("SYST:LOC")       # Put the power supply back into local control
+        self.transport.close()
+
+class AsyncTc0521(object):
+    '''asyncio driver for the TC0521 thermocouple meter, the methods of Tc0521 but awaitable.
+    Create with 'await AsyncTc0521.open(com_port)', a com_port of None finds the meter with discover.
+    The status attributes (battery, units, t1 ...) are a read-only view of the last reading.'''
+    
+    sample_offset = 0.0     # Seconds from the middle of the turnaround to the reading, see bkinsts.sample_time()
+    
+    def __init__(self, transport, timeout=1.0):
+        self.transport = transport
+        self.timeout = timeout      # Seconds to wait for a status frame
+        self.reading = None
+        self.raw_data = None
+        self.sample_t = None        # Estimated time.monotonic() the last reading was taken
+        self.lock = asyncio.Lock()
+    
+    @classmethod
+    async def open(cls, com_port=None, **kwargs):
+        if com_port is None:
+            import discover
+            com_port = await asyncio.get_running_loop().run_in_executor(None, discover.find_port, 'TC0521')
+            if com_port is None:
+                raise NameError('NO TC0521 FOUND.')
+        transport = await AsyncSerialTransport.open(com_port)
+        return cls(transport, **kwargs)
+    
+    async def send_command(self, command):
+        async with self.lock:
+            self.transport.reset_input_buffer()
+            self.transport.write(command)
+    
+    async def identify(self):
+        for i in range(30):
+            await self.send_command(Tc0521.command_B_backlight)
+            await asyncio.sleep(0.5)
+    
+    def f_to_c(self, temp):
+        # meter always reports temperature in F, convert to C if applicable.
+        if (self.units == 'F') or (temp == None):
+            return temp
+        return (temp - 32.0) * 5.0 / 9.0
+    
+    async def get_reading(self):
+        async with self.lock:
+            command = Tc0521.command_A_status
+            self.transport.reset_input_buffer()
+            start = time.monotonic()
+            self.transport.write(command)
+            self.raw_data = await self.transport.read_exactly(STATUS_FRAME_LENGTH, self.timeout)
+            self.sample_t = sample_time(start, time.monotonic(), len(command), STATUS_FRAME_LENGTH,
+                                        self.transport.baudrate, self.sample_offset)
+            self.reading = decode_status(self.raw_data)
+            return self.reading
+    
+    async def get_status(self):
+        if not (await self.get_reading()).checksum_ok:
+            print("WARNING: CHECKSUM MISMATCH, NULLIFYING ALL DATA.  RETRY READ.")
+            return True
+        return False
+    
+    async def recall(self, experimental=False):
+        '''EXPERIMENTAL: download the meter's recorded memory (REC), 'async for reading in
+        meter.recall(experimental=True)' yields the stored records as Tc0521Reading.  Same
+        unverified record format, framing and end of download rules as Tc0521RecallReader,
+        records with a bad checksum are skipped.'''
+        if not experimental:
+            raise RuntimeError('TC0521 RECALL FORMAT IS UNVERIFIED, PASS experimental=True TO USE IT')
+        async with self.lock:
+            buffer = bytearray()
+            self.transport.reset_input_buffer()
+            self.transport.write(Tc0521.command_P_load)
+            while True:
+                frame, skipped = take_frame(buffer)
+                if frame is None:
+                    try:
+                        buffer += await self.transport.read_available(self.timeout)
+                    except asyncio.TimeoutError:
+                        return
+                    continue
+                if (sum(frame[1:STATUS_CHECKSUM_BYTE]) & 0xFF) != frame[STATUS_CHECKSUM_BYTE]:
+                    continue
+                reading = decode_status(frame)
+                if not reading.recall_mode:
+                    return
+                yield reading
+    
+    def close(self):
+        self.transport.close()
+
+# The status attributes of AsyncTc0521 are a read-only view of the last Tc0521Reading, as on Tc0521
+for field in Tc0521Reading._fields:
+    setattr(AsyncTc0521, field, reading_property(field))
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""Throughput, latency and parse cost benchmarks for the instrument drivers.
+
+Runs the drivers against the instsim simulators at a realistic baud rate and reports, for every
+benchmark, commands per second and p50/p99 per command latency.  Results are written as JSON
+and can be compared against a stored baseline to catch regressions:
+
+    python bench.py --output results.json
+    python bench.py --save-baseline baseline.json
+    python bench.py --baseline baseline.json     # exits 1 if anything regressed"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+import instsim
+from bkinsts import BkTrippleSupply_9129B, BkDcLoad_8500
+from tc0521 import Tc0521, decode_status
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def measure(operation, iterations, min_time=0.0):
+    """Call operation iterations times (at least min_time seconds), returns a result dict with latencies in microseconds."""
+    perf_counter = time.perf_counter
+    latencies = []
+    start = perf_counter()
+    while len(latencies) < iterations or perf_counter() - start < min_time:
+        t0 = perf_counter()
+        operation()
+        latencies.append(perf_counter() - t0)
+    elapsed = perf_counter() - start
+    latencies.sort()
+    return {
+        'count': len(latencies),
+        'ops_per_s': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_us': percentile(latencies, 0.50) * 1e6,
+        'p99_us': percentile(latencies, 0.99) * 1e6,
+        'mean_us': sum(latencies) / len(latencies) * 1e6,
+    }
+
+# Benchmarks, each returns a dict of name -> result
+
+def bench_8500(args):
+    load = BkDcLoad_8500(port=instsim.Sim8500Serial(baudrate=args.baudrate, latency=args.latency), cache=False)
+    load.set_mode('CC')
+    results = {
+        '8500.get_present_values': measure(load.get_present_values, args.iterations),
+        '8500.set_current_setpoint': measure(lambda: load.set_current_setpoint(1.0), args.iterations),
+    }
+    
+    # Codec cost alone, no transport
+    codec = BkDcLoad_8500(port=instsim.Sim8500Serial(baudrate=None), cache=False)
+    codec.get_present_values()     # Leaves a front panel response in rx_buff
+    cmd = codec.cmd_get_present_values
+    results['8500.encode'] = measure(lambda: codec.encode_command(codec.cmd_set_cc_mode_current, 1.2345), args.parse_iterations)
+    results['8500.decode_front_panel'] = measure(lambda: codec.decode_response(cmd, None), args.parse_iterations)
+    return results
+
+def bench_tc0521(args):
+    meter = Tc0521(port=instsim.SimTc0521Serial(baudrate=args.baudrate, latency=args.latency))
+    frame = bytes(instsim.SimTc0521Serial().status_frame())
+    return {
+        'tc0521.get_status': measure(meter.get_status, args.iterations),
+        'tc0521.decode_status': measure(lambda: decode_status(frame), args.parse_iterations),
+    }
+
+def bench_9129b(args):
+    results = {}
+    for pacing in args.pacing:
+        # The simulated link runs at the same baud rate as the serial instruments
+        rm = instsim.SimResourceManager(latency=args.scpi_latency, baudrate=args.baudrate)
+        supply = BkTrippleSupply_9129B('SIM', pacing=pacing, rm=rm, baudrate=args.baudrate or 9600, cache=False)
+        results['9129b.' + pacing + '.set_voltage_ch'] = measure(lambda: supply.set_voltage_ch(1, 5.0), args.scpi_iterations)
+        results['9129b.' + pacing + '.read_voltage_ch'] = measure(lambda: supply.read_voltage_ch(1), args.scpi_iterations)
+        results['9129b.' + pacing + '.measure_all'] = measure(supply.measure_all, args.scpi_iterations)
+        results['9129b.' + pacing + '.apply_all'] = measure(lambda: supply.apply_all((5.0, 3.3, 1.8), (1.0, 1.0, 1.0)), args.scpi_iterations)
+    return results
+
+BENCHMARKS = {'8500': bench_8500, 'tc0521': bench_tc0521, '9129b': bench_9129b}
+
+def compare(results, baseline, tolerance):
+    """Returns a list of regression descriptions, comparing p50 latency and throughput."""
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['p50_us'] > base['p50_us'] * (1.0 + tolerance):
+            regressions.append('%s: p50 %.1f us vs baseline %.1f us' % (name, result['p50_us'], base['p50_us']))
+        if result['ops_per_s'] < base['ops_per_s'] * (1.0 - tolerance):
+            regressions.append('%s: %.1f ops/s vs baseline %.1f ops/s' % (name, result['ops_per_s'], base['ops_per_s']))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the instrument drivers against simulated instruments.')
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS), help='benchmarks to run (default all)')
+    parser.add_argument('--baudrate', type=int, default=9600, help='simulated serial baud rate, 0 for no wire time')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated serial instrument latency in seconds')
+    parser.add_argument('--scpi-latency', type=float, default=0.002, help='simulated 9129B processing time per line in seconds')
+    parser.add_argument('--pacing', nargs='+', default=['adaptive', 'opc', 'fixed'], help='9129B pacing modes to benchmark')
+    parser.add_argument('--iterations', type=int, default=50, help='serial transactions per benchmark')
+    parser.add_argument('--scpi-iterations', type=int, default=20, help='9129B operations per benchmark')
+    parser.add_argument('--parse-iterations', type=int, default=20000, help='encode/decode calls per benchmark')
+    parser.add_argument('--output', help='write JSON results to this file (default stdout)')
+    parser.add_argument('--baseline', help='compare against this JSON results file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression against the baseline')
+    parser.add_argument('--save-baseline', help='write the results to this file as the new baseline')
+    args = parser.parse_args(argv)
+    args.baudrate = args.baudrate or None
+    
+    results = {}
+    for name in (args.only or sorted(BENCHMARKS)):
+        results.update(BENCHMARKS[name](args))
+    
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'baudrate': args.baudrate,
+        'results': results,
+    }
+    text = json.dumps(report, indent=1, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            f.write(text + '\n')
+    
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION: ' + regression, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+import collections
+import concurrent.futures
+import threading
+import time
+
+import serial   # From official package 'pyserial'
+
+from bkinsts import BkDcLoad_8500
+
+def status_opcodes(cmds):
+    # Opcodes of the commands the load answers with a status packet only
+    opcodes = set()
+    for cmd in cmds:
+        if 'command' not in cmd:
+            opcodes |= status_opcodes(cmd.values())
+        elif cmd['command_return'] == 'status_packet':
+            opcodes.add(cmd['command'])
+    return opcodes
+
+STATUS_OPCODES = status_opcodes(getattr(BkDcLoad_8500, name) for name in dir(BkDcLoad_8500) if name.startswith('cmd_'))
+
+class BusRequest(object):
+    # One request waiting for its response on the bus
+    def __init__(self, opcode, rx_view):
+        self.opcode = opcode
+        self.rx_view = rx_view
+        self.done = threading.Event()
+        self.abandoned = None   # time.monotonic() a timed out request stops waiting for its late answer
+        self.candidate = None   # Packet drained as an earlier request's late answer that this request also accepts
+        
+    def accepts(self, packet):
+        # Settings are answered with a status packet, readbacks with their own opcode or an error status
+        if self.opcode in STATUS_OPCODES:
+            return packet[2] == BkDcLoad_8500.STATUS_DATA
+        if packet[2] == BkDcLoad_8500.STATUS_DATA:
+            return packet[3] != BkDcLoad_8500.STATUS_SUCCESS
+        return packet[2] == self.opcode
+
+class Bk8500Bus(object):
+    """    Shares one serial port between several BK8500 loads on a multi-drop RS-232/RS-485 bus.
+    
+        bus = Bk8500Bus('/dev/ttyUSB0')
+        loads = [bus.load(address) for address in (1, 2, 3)]
+        values = bus.map(BkDcLoad_8500.get_present_values, loads)
+    
+    The bus owns the port and a reader thread frames every response packet and hands it to the
+    oldest outstanding request for the address in byte 1.  Requests from different loads are
+    written as soon as they are made, so loads driven from several threads (or through map())
+    are pipelined on the wire instead of each waiting out a full round trip.
+    Every request knows the response it expects: a status packet for a setting, its own opcode
+    (or an error status) for a readback.  A timed out request stays queued for two more timeouts
+    so its late answer is drained (counted in stale) instead of being taken by the next
+    request.  When the late answer never comes (lost or corrupt) the next answer is drained in its
+    place, so the request it was for keeps it as a candidate and takes it if nothing else arrives
+    before its own timeout, instead of every following request losing its answer in turn.
+    Packets failing their checksum are dropped, the request they answered times out like a short read.  A corrupt run of bytes is counted once in corrupt, however many bytes
+    are skipped (dropped_bytes) to get back in step."""
+    
+    instrumentation = None  # insttrace.Instrumentation, set by insttrace.instrument()
+    
+    def __init__(self, device=None, baudrate=9600, port=None, timeout=1.0):
+        if port is not None:
+            # Already open serial.Serial like object, e.g. an instsim.Sim8500Bus
+            self.port = port
+        else:
+            self.port = serial.Serial(port=device, baudrate=baudrate, timeout=0.05, write_timeout=5)
+        self.timeout = timeout      # Seconds to wait for a response
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.pending = {}           # Address -> deque of BusRequest, oldest first
+        self.executor = None
+        
+        self.responses = 0          # Packets matched to a request
+        self.unmatched = 0          # Packets with no request waiting for them
+        self.stale = 0              # Late answers to timed out requests, drained
+        self.corrupt = 0            # Corrupt or misaligned stretches resynchronized on
+        self.dropped_bytes = 0      # Bytes skipped while resynchronizing
+        self.timeouts = 0           # Requests that got no response in time
+        
+        self.port.reset_input_buffer()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='Bk8500Bus', daemon=True)
+        self.thread.start()
+    
+    def load(self, address, cache=True):
+        """Returns a BkDcLoad_8500 for the load at address on this bus."""
+        return BkDcLoad_8500(bus=self, address=address, cache=cache)
+    
+    def transact(self, address, tx_buff, rx_view):
+        """Send a packet to address and wait for its response in rx_view, zero filled on timeout."""
+        request = BusRequest(tx_buff[2], rx_view)
+        with self.lock:
+            self.pending.setdefault(address, collections.deque()).append(request)
+        with self.write_lock:
+            self.port.write(tx_buff)
+            self.port.flush()
+        if request.done.wait(self.timeout):
+            return
+        with self.lock:
+            if request.done.is_set():
+                return      # Answered while the lock was being taken
+            if request.candidate is not None:
+                # The answer drained as stale was this one's, the late answer it was taken for never came
+                self.pending[address].remove(request)
+                rx_view[:] = request.candidate
+                self.stale -= 1
+                self.responses += 1
+                return
+            # Left in the queue to soak up its answer should it still come
+            request.abandoned = time.monotonic() + 2 * self.timeout
+            self.timeouts += 1
+        rx_view[:] = bytes(len(rx_view))
+        if self.instrumentation is not None:
+            self.instrumentation.retry(self)
+    
+    def dispatch(self, packet):
+        now = time.monotonic()
+        with self.lock:
+            queue = self.pending.get(packet[1])
+            while queue:
+                request = queue[0]
+                if request.abandoned is not None and (request.abandoned < now or not request.accepts(packet)):
+                    queue.popleft()     # Its answer never came
+                    continue
+                break
+            if not queue or not request.accepts(packet):
+                self.unmatched += 1
+                return
+            queue.popleft()
+            if request.abandoned is not None:
+                self.stale += 1
+                waiting = next((later for later in queue if later.abandoned is None), None)
+                if waiting is not None and waiting.accepts(packet):
+                    waiting.candidate = packet
+                return
+            request.rx_view[:] = packet
+            self.responses += 1
+        request.done.set()
+    
+    def run(self):
+        length = BkDcLoad_8500.PACKET_LENGTH
+        buffer = bytearray()
+        in_step = True      # False from a bad packet until the next good one
+        while self.running:
+            data = self.port.read(self.port.in_waiting or 1)
+            if not data:
+                continue
+            buffer += data
+            while True:
+                start = buffer.find(BkDcLoad_8500.START_BYTE)
+                if start < 0:
+                    self.dropped_bytes += len(buffer)
+                    del buffer[:]
+                    break
+                self.dropped_bytes += start
+                del buffer[:start]
+                if len(buffer) < length:
+                    break
+                if (sum(buffer[:length - 1]) & 0xFF) != buffer[length - 1]:
+                    # Misaligned or corrupt, resynchronize on the next start byte
+                    if in_step:
+                        in_step = False
+                        self.corrupt += 1
+                        if self.instrumentation is not None:
+                            self.instrumentation.checksum_failure(self)
+                    self.dropped_bytes += 1
+                    del buffer[:1]
+                    continue
+                in_step = True
+                packet = bytes(buffer[:length])
+                del buffer[:length]
+                self.dispatch(packet)
+    
+    def map(self, function, loads):
+        """Call function(load) for every load concurrently so their requests overlap on the bus.
+        Returns the results in the order of loads."""
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(thread_name_prefix='Bk8500Bus')
+        return list(self.executor.map(function, loads))
+    
+    def close(self):
+        self.running = False
+        self.thread.join()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        self.port.close()
@@ -1,106 +1,713 @@
 #!/usr/bin/env python3
 
-import pyvisa
+import re
 import sys
 import time
-import serial
+import struct
+import threading
+import collections
+import contextlib
 
 device_default = 'COM9'
+
+# Process wide pyvisa ResourceManager shared by every supply, created on first use.  pyvisa is only
+# imported then, scripts that only drive the 8500 never load it.
+shared_rm = None
+shared_rm_lock = threading.Lock()
+
+def resource_manager():
+    """Returns the process wide pyvisa ResourceManager."""
+    global shared_rm
+    with shared_rm_lock:
+        if shared_rm is None:
+            import pyvisa
+            shared_rm = pyvisa.ResourceManager()
+        return shared_rm
+
+def sample_time(start, end, sent, received, baudrate, offset=0.0):
+    """Estimate the time.monotonic() an instrument took a reading from the start and end of its transaction.
+    The wire time of the sent and received bytes (8N1, ten bits a byte) is taken off each end and the
+    reading is placed in the middle of the instrument's turnaround that is left.  offset is added for
+    instruments known to answer from an earlier (negative) or later reading."""
+    wire = 10.0 / baudrate if baudrate else 0.0
+    arrived = min(start + sent * wire, end)
+    replied = max(end - received * wire, arrived)
+    return (arrived + replied) * 0.5 + offset
+
+class SampleStamp(object):
+    """    sample_t descriptor that keeps the stamp per thread, so a thread reading sample_t after a
+    call gets the stamp of its own transaction even while other threads use the driver.  A
+    thread that has made no transaction sees the latest stamp of any thread."""
+    
+    def __get__(self, obj, owner):
+        if obj is None:
+            return self
+        stamps = obj.__dict__.get('sample_stamps')
+        if stamps is None:
+            return None
+        return getattr(stamps, 't', obj.__dict__.get('sample_latest'))
+        
+    def __set__(self, obj, value):
+        stamps = obj.__dict__.get('sample_stamps')
+        if stamps is None:
+            stamps = obj.__dict__.setdefault('sample_stamps', threading.local())
+        stamps.t = value
+        obj.__dict__['sample_latest'] = value
+        
+def own_sample_t(driver):
+    """The sample_t of the calling thread's own last transaction on driver, None if it has made none."""
+    driver = getattr(driver, 'pacer', driver)   # The 9129B stamps its queries in the pacer
+    stamps = getattr(driver, '__dict__', {}).get('sample_stamps')
+    return None if stamps is None else getattr(stamps, 't', None)
+
+# SCPI commands that turn a 9129B output on, refused while an interlock trip is latched
+OUTPUT_ON = re.compile(r'OUTP(?:UT)?(?::STAT(?:E)?)?(?::ALL)?\s+(?:ON|1)\b', re.IGNORECASE)
+
+# All channel readback of the 9129B, each field is a (CH1, CH2, CH3) tuple
+ChannelMeasurements = collections.namedtuple('ChannelMeasurements', ['voltage', 'current', 'power'])
+
+class PriorityLock(object):
+    """    Lock whose priority() holders go ahead of every thread waiting on a normal acquire.
+    While a priority holder is waiting, preempted is set so a holder sleeping only to pace the
+    instrument can cut the sleep short and hand over the port.
+    Normal acquires are served first come first served from a ticket queue, so a thread polling
+    in a loop (a stream or interlock watcher) cannot take the lock straight back on release and
+    keep a script's command waiting forever."""
+    
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.locked = False
+        self.priority_waiting = 0
+        self.next_ticket = 0    # Ticket handed to the next normal acquire
+        self.serving = 0        # Ticket whose holder is next in line for the lock
+        self.preempted = threading.Event()
+        
+    def acquire(self):
+        with self.cond:
+            ticket = self.next_ticket
+            self.next_ticket += 1
+            while self.locked or self.priority_waiting or ticket != self.serving:
+                self.cond.wait()
+            self.serving += 1
+            self.locked = True
+            
+    def release(self):
+        with self.cond:
+            self.locked = False
+            self.cond.notify_all()
+            
+    def __enter__(self):
+        self.acquire()
+        return self
+        
+    def __exit__(self, *exc):
+        self.release()
+        
+    @contextlib.contextmanager
+    def priority(self):
+        with self.cond:
+            self.priority_waiting += 1
+            self.preempted.set()
+            while self.locked:
+                self.cond.wait()
+            self.priority_waiting -= 1
+            if not self.priority_waiting:
+                self.preempted.clear()
+            self.locked = True
+        try:
+            yield self
+        finally:
+            self.release()
 	
+class ScpiPacer(object):
+    """    Paces writes to a SCPI instrument so each command is given only as long as it needs.
+    Modes:
+        'fixed'     sleep fixed_delay after every write (the original behaviour)
+        'opc'       follow every write with *OPC? and continue as soon as the instrument answers
+        'adaptive'  synchronize with *OPC? for the first learn_count writes of each command header,
+                    then sleep the worst measured latency times margin (never less than min_delay)
+    Queries need no pacing, the response itself is the synchronization."""
+    
+    instrumentation = None      # insttrace.Instrumentation, set by insttrace.instrument()
+    trace_name = 'ScpiPacer'
+    sample_t = SampleStamp()    # Estimated time.monotonic() the last query's reading was taken, see sample_time()
+    sample_offset = 0.0
+    
+    def __init__(self, resource, mode='adaptive', fixed_delay=0.1, min_delay=0.005, learn_count=3, margin=1.5, baudrate=None):
+        if mode not in ('fixed', 'opc', 'adaptive'):
+            raise ValueError('UNKNOWN PACING MODE ' + str(mode))
+        self.resource = resource
+        self.lock = PriorityLock()      # One command at a time, priority writes go first
+        self.mode = mode
+        self.fixed_delay = fixed_delay  # Seconds, used in 'fixed' mode and when *OPC? fails
+        self.min_delay = min_delay      # Seconds, safety floor for learned delays
+        self.learn_count = learn_count  # *OPC? synchronized samples taken per header before trusting it
+        self.margin = margin            # Multiplier applied to the worst measured latency
+        self.latencies = {}             # Command header -> list of measured latencies in seconds
+        self.baudrate = baudrate        # Serial link speed for the wire time correction, None for none
+        
+    def header(self, command):
+        # Latency is learned per header, a semicolon joined line is keyed on all of its headers
+        return ';'.join(part.strip().split(' ', 1)[0] for part in command.upper().split(';'))
+        
+    def sync(self):
+        """Block until the instrument has finished all pending operations.  Returns True on success."""
+        try:
+            return self.resource.query("*OPC?").strip() == '1'
+        except Exception:
+            return False
+            
+    def delay(self, command):
+        """Returns the learned delay for a command, or None if it is still being learned."""
+        samples = self.latencies.get(self.header(command))
+        if samples is None or len(samples) < self.learn_count:
+            return None
+        return max(self.min_delay, max(samples) * self.margin)
+        
+    def sleep(self, seconds):
+        # Cut short when a priority write is waiting for the port, the time actually slept is reported
+        if self.instrumentation is not None:
+            start = time.perf_counter()
+            self.lock.preempted.wait(seconds)
+            self.instrumentation.sleep(self, time.perf_counter() - start)
+        else:
+            self.lock.preempted.wait(seconds)
+            
+    def write(self, command, priority=False):
+        """Send a command, priority=True goes ahead of writes and queries waiting in other threads.
+        Returns the time.monotonic() the command was on the wire, before any pacing wait."""
+        with (self.lock.priority() if priority else self.lock):
+            if self.instrumentation is not None:
+                start = time.perf_counter()
+                sent = self.paced_write(command)
+                self.instrumentation.command(self, self.header(command), time.perf_counter() - start)
+                return sent
+            return self.paced_write(command)
+            
+    def paced_write(self, command):
+        if self.mode == 'fixed':
+            self.resource.write(command)
+            sent = time.monotonic()
+            self.sleep(self.fixed_delay)
+            return sent
+            
+        if self.mode == 'adaptive':
+            delay = self.delay(command)
+            if delay is not None:
+                self.resource.write(command)
+                sent = time.monotonic()
+                self.sleep(delay)
+                return sent
+                
+        start = time.perf_counter()
+        self.resource.write(command)
+        sent = time.monotonic()
+        if self.sync():
+            self.latencies.setdefault(self.header(command), []).append(time.perf_counter() - start)
+        else:
+            # Instrument did not acknowledge, clear the error queue and fall back to the fixed delay
+            if self.instrumentation is not None:
+                self.instrumentation.retry(self)
+            self.errors()
+            self.sleep(self.fixed_delay)
+        return sent
+            
+    def query(self, command, priority=False):
+        with (self.lock.priority() if priority else self.lock):
+            start = time.monotonic()
+            response = self.resource.query(command)
+            end = time.monotonic()
+            self.sample_t = sample_time(start, end, len(command) + 1, len(response), self.baudrate, self.sample_offset)
+            if self.instrumentation is not None:
+                self.instrumentation.command(self, self.header(command), end - start)
+            return response
+        
+    def errors(self):
+        """Drain the instrument error queue, returns a list of error strings (empty if none)."""
+        errors = []
+        for i in range(20):     # The error queue is finite, bound the loop in case the instrument misbehaves
+            try:
+                err = self.resource.query("SYST:ERR?").strip()
+            except Exception:
+                break
+            if err.startswith('0') or err.startswith('+0'):
+                break
+            errors.append(err)
+        return errors
+        
+class StateAttribute(object):
+    """    Driver attribute kept in the driver's Bk9129BState (self.state), so the blocking and
+    async 9129B drivers expose the shadow state and interlock as their own attributes."""
+    
+    def __init__(self, name):
+        self.name = name
+        
+    def __get__(self, obj, owner):
+        if obj is None:
+            return self
+        return getattr(obj.state, self.name)
+        
+    def __set__(self, obj, value):
+        setattr(obj.state, self.name, value)
+        
+# Commands a Bk9129BState operation needs, the shadow state updates they make and the channel they leave selected
+Bk9129BPlan = collections.namedtuple('Bk9129BPlan', ['commands', 'updates', 'channel'])
+
+class Bk9129BState(object):
+    """    Shadow state of a BK9129B and the commands each operation needs, with no transport.
+    Shared by BkTrippleSupply_9129B and aioinsts.AsyncBkTrippleSupply_9129B, as an unconnected
+    BkDcLoad_8500 is for the load.  An operation returns a Bk9129BPlan, its commands are empty when
+    the shadow state says nothing would change, and the driver passes the plan to done() once the
+    commands are all sent to record the new state.  The selected channel is unknown while the
+    commands are in flight.  cache=False keeps no shadow state, every operation is sent."""
+    
+    CHANNELS = (1, 2, 3)
+    # Compound queries reading back every channel in one transaction, the supply is left on CH3
+    OUTPUT_STATE_QUERY = ";:".join("INST:SEL CH%d;:SOUR:CHAN:OUTP:STAT?" % chan for chan in CHANNELS)
+    RESYNC_QUERY = ";:".join("INST:SEL CH%d;:VOLT?;:CURR?;:SOUR:CHAN:OUTP:STAT?" % chan for chan in CHANNELS)
+    
+    interlock = None        # interlock.Interlock guarding the outputs, set through the driver
+    
+    def __init__(self, cache=True):
+        self.cache = cache
+        self.invalidate_cache()
+    
+    def invalidate_cache(self):
+        """Forget all shadow state, the next operations are sent unconditionally."""
+        self.selected_channel = None
+        self.voltage_setpoint = {}  # Channel -> volts
+        self.current_setpoint = {}  # Channel -> amps
+        self.output_state = {}      # Channel -> True/False
+    
+    def refuse(self, command=None):
+        """Raises interlock.InterlockTripped if command (any output on when None) turns an output
+        on while an interlock trip is latched."""
+        if self.interlock is not None and (command is None or OUTPUT_ON.search(command)):
+            self.interlock.refuse('supply')
+    
+    def cached(self, shadow, chan, value):
+        return self.cache and shadow.get(chan) == value
+    
+    def update_shadow(self, shadow, chan, value):
+        if self.cache:
+            shadow[chan] = value
+    
+    def select(self, chan):
+        # The channel select chan needs, none if it is already selected
+        if self.cache and self.selected_channel == chan:
+            return []
+        return ["INSTrument:SELect CH" + str(chan)]
+    
+    def plan(self, commands, updates=(), chan=None):
+        """Returns a Bk9129BPlan of commands, the (shadow, channel, value) updates they make and the
+        channel they leave selected (None for unchanged)."""
+        if chan is not None:
+            self.selected_channel = None    # Unknown until the commands complete
+        return Bk9129BPlan(commands, list(updates), chan)
+    
+    def done(self, plan):
+        """Record the state a plan's commands left the supply in, call once they are all sent."""
+        for shadow, chan, value in plan.updates:
+            self.update_shadow(shadow, chan, value)
+        if self.cache and plan.channel is not None:
+            self.selected_channel = plan.channel
+    
+    def select_channel(self, chan):
+        return self.plan(self.select(chan), chan=chan)
+    
+    def enable_output_all(self):
+        self.refuse()
+        if self.cache and all(self.output_state.get(chan) is True for chan in self.CHANNELS):
+            return self.plan([])
+        return self.plan(["OUTPut:STATe:ALL ON"], [(self.output_state, chan, True) for chan in self.CHANNELS])
+    
+    def enable_output_ch(self, chan):
+        self.refuse()
+        if self.cached(self.output_state, chan, True):
+            return self.plan([])
+        return self.plan(self.select(chan) + ["SOURce:CHANnel:OUTPut:STATe ON"], [(self.output_state, chan, True)], chan)
+    
+    def disable_output_all(self):
+        # Always sent, regardless of the shadow state
+        return self.plan(["OUTPut:STATe:ALL OFF"], [(self.output_state, chan, False) for chan in self.CHANNELS])
+    
+    def disable_output_ch(self, chan):
+        return self.plan(self.select(chan) + ["SOURce:CHANnel:OUTPut:STATe OFF"], [(self.output_state, chan, False)], chan)
+    
+    def set_current_ch(self, chan, current):
+        if self.cached(self.current_setpoint, chan, current):
+            return self.plan([])
+        return self.plan(self.select(chan) + ["CURRent " + str(current) + "A"], [(self.current_setpoint, chan, current)], chan)
+    
+    def set_voltage_ch(self, chan, voltage):
+        if self.cached(self.voltage_setpoint, chan, voltage):
+            return self.plan([])
+        return self.plan(self.select(chan) + ["VOLTage " + str(voltage) + "V"], [(self.voltage_setpoint, chan, voltage)], chan)
+    
+    def known_setpoint(self, shadow, chan):
+        """The setpoint held in the shadow state, None if it has to be read from the supply."""
+        return shadow.get(chan) if self.cache else None
+    
+    def output_states(self, response):
+        """Record the response to OUTPUT_STATE_QUERY, returns (CH1, CH2, CH3) booleans."""
+        states = tuple(state.strip() in ('1', 'ON') for state in response.split(';'))
+        for chan, state in zip(self.CHANNELS, states):
+            self.update_shadow(self.output_state, chan, state)
+        if self.cache:
+            self.selected_channel = self.CHANNELS[-1]
+        return states
+    
+    def resync(self, response):
+        """Replace the shadow state with the response to RESYNC_QUERY."""
+        self.invalidate_cache()
+        fields = [field.strip() for field in response.split(';')]
+        for i, chan in enumerate(self.CHANNELS):
+            voltage, current, state = fields[3 * i:3 * i + 3]
+            self.update_shadow(self.voltage_setpoint, chan, float(voltage))
+            self.update_shadow(self.current_setpoint, chan, float(current))
+            self.update_shadow(self.output_state, chan, state in ('1', 'ON'))
+        if self.cache:
+            self.selected_channel = self.CHANNELS[-1]
+
 class BkTrippleSupply_9129B(object):
     """    This class creates an instance to control the BK9129B tripple output power supply.
-    Reference programming manual is here: 
-    https://bkpmedia.s3.amazonaws.com/downloads/programming_manuals/en-us/9129B_programming_manual.pdf"""
-	
-    def __init__(self, device=device_default, baudrate=9600):
-        self.cmd_delay = 0.1    # Time in seconds to wait after sending each command, manual warns to add an unspecified delay after commands
-        self.rm = pyvisa.ResourceManager()
-        self.ps = self.rm.open_resource(device, baudrate=baudrate)
+    Reference programming manual is here:
+    https://bkpmedia.s3.amazonaws.com/downloads/programming_manuals/en-us/9129B_programming_manual.pdf
+    
+    Writes are paced by a ScpiPacer.  The default 'opc' waits for *OPC? after every write: over the
+    serial link the learned 'adaptive' delay (the *OPC? round trip times a margin) is longer than the
+    round trip itself, see bench.py.  pacing='fixed' restores the original cmd_delay sleep after every command.
+    
+    A shadow copy of the selected channel, setpoints and output states is kept in a Bk9129BState so
+    writes that would not change anything are skipped.  Changes made from the front panel are not seen,
+    call invalidate_cache() or resync() after handing the supply back to an operator.  cache=False
+    disables the shadow state.
+    
+    attach=True is a warm attach to a supply that is already set up: the identity is checked and the
+    present state read into the shadow copy instead of resetting it (*PSC/*CLS/*RST).  Pair it with
+    detach(), which leaves the outputs as they are."""
+    
+    instrumentation = None  # insttrace.Instrumentation, set by insttrace.instrument()
+    interlock = StateAttribute('interlock')     # interlock.Interlock guarding the outputs, set by the Interlock
+    # Shadow state, see Bk9129BState
+    cache = StateAttribute('cache')
+    selected_channel = StateAttribute('selected_channel')
+    voltage_setpoint = StateAttribute('voltage_setpoint')
+    current_setpoint = StateAttribute('current_setpoint')
+    output_state = StateAttribute('output_state')
+    
+    def __init__(self, device=device_default, baudrate=9600, pacing='opc', min_delay=0.005, cache=True, rm=None, attach=False):
+        # rm replaces the shared pyvisa resource manager, e.g. with an instsim.SimResourceManager
+        self.device = device
+        self.baudrate = baudrate
+        self.state = Bk9129BState(cache)
+        self.cmd_delay = 0.1    # Time in seconds to wait after sending each command when pacing is 'fixed', manual warns to add an unspecified delay after commands
+        self.rm = rm if rm is not None else resource_manager()
+        self.ps = self.rm.open_resource(device, baud_rate=baudrate)
+        self.pacer = ScpiPacer(self.ps, mode=pacing, fixed_delay=self.cmd_delay, min_delay=min_delay, baudrate=baudrate)
         if 'B&K Precision, 9129B' in self.ps.query("*IDN?"): # Verify expected instrument is present.
             #print('Found 9129B PSU')
-            self.ps.write("*PSC ON")
-            time.sleep(self.cmd_delay)
-            self.ps.write("*CLS")
-            time.sleep(self.cmd_delay)
-            self.ps.write("*RST")
-            time.sleep(self.cmd_delay)
-            self.ps.write("SYST:REM")
-            time.sleep(self.cmd_delay)
+            if attach:
+                # Warm attach, take over the supply as it is
+                self.write("SYST:REM")
+                self.resync()
+            else:
+                self.write("*PSC ON")
+                self.write("*CLS")
+                self.write("*RST")
+                self.write("SYST:REM")
+                self.invalidate_cache()
             
             #self.esr = self.ps.query("SYST:ERR?") # Cofirm no errors
             #print("ESR=" + self.esr)
         else:
             self.ps.close()
             sys.exit('NO SUPPORTED POWER SUPPLIES FOUND')
-        
+    
     def open(self):
         """Re-open the power supply instance."""
-        self.ps = self.rm.open_resource(device, baud_rate=9600)
-        self.ps.write("*CLS")
-        time.sleep(self.cmd_delay)
-        self.ps.write("*RST")
-        time.sleep(self.cmd_delay)
-        self.ps.write("SYST:REM")
-        time.sleep(self.cmd_delay)
+        self.ps = self.rm.open_resource(self.device, baud_rate=self.baudrate)
+        self.pacer.resource = self.ps
+        self.write("*CLS")
+        self.write("*RST")
+        self.write("SYST:REM")
+        self.invalidate_cache()
         
         #self.esr = self.ps.query("SYST:ERR?") # Cofirm no errors
         #print("ESR=" + self.esr)
-            
+    
+    @property
+    def sample_t(self):
+        """Estimated time.monotonic() the last query's reading was taken (read_voltage_ch, measure_all ...)."""
+        return self.pacer.sample_t
+    
+    def write(self, command, priority=False):
+        """Send a command and wait only as long as the pacer says the supply needs.
+        Returns the time.monotonic() it was sent.  A command turning an output on raises
+        interlock.InterlockTripped while an interlock trip is latched."""
+        self.state.refuse(command)
+        return self.pacer.write(command, priority)
+    
+    def send(self, plan):
+        # Send the commands of a Bk9129BState plan, then record the state they leave
+        for command in plan.commands:
+            self.write(command)
+        self.state.done(plan)
+    
+    def errors(self):
+        """Returns the list of errors queued on the supply (SYST:ERR?), empty if none."""
+        with self.pacer.lock:
+            return self.pacer.errors()
+    
+    def invalidate_cache(self):
+        """Forget all shadow state, the next operations are sent unconditionally."""
+        self.state.invalidate_cache()
+    
+    def resync(self):
+        """Read the selected channel, setpoints and output states back from the supply into the shadow state."""
+        self.state.invalidate_cache()
+        self.state.resync(self.pacer.query(self.state.RESYNC_QUERY))
+    
+    def select_channel(self, chan):
+        """Select the channel subsequent channel commands apply to, skipped if already selected"""
+        self.send(self.state.select_channel(chan))
+    
     def set_voltage_ch1(self):
         pass
-        
+    
     def enable_output_all(self):
         """Enables all three outputs of the supply"""
-        self.ps.write("OUTPut:STATe:ALL ON")
-        time.sleep(self.cmd_delay)
-        
+        self.send(self.state.enable_output_all())
+    
     def enable_output_ch(self, chan):
         """Enables specified channel output, argument is integer for channel number"""
-        self.ps.write("INSTrument:SELect CH" + str(chan))
-        time.sleep(self.cmd_delay)
-        self.ps.write("SOURce:CHANnel:OUTPut:STATe ON")
-        time.sleep(self.cmd_delay)
-        
-    def disable_output_all(self):
-        """Disables all three outputs of the supply"""
-        self.ps.write("OUTPut:STATe:ALL OFF")
-        time.sleep(self.cmd_delay)
-        
+        self.send(self.state.enable_output_ch(chan))
+    
+    def disable_output_all(self, priority=False):
+        """Disables all three outputs of the supply.  Always sent, regardless of the shadow state.
+        priority=True sends it ahead of commands other threads are waiting to send (interlocks).
+        Returns the time.monotonic() the command was sent."""
+        plan = self.state.disable_output_all()
+        sent = self.write(plan.commands[0], priority)
+        self.state.done(plan)
+        return sent
+    
     def disable_output_ch(self, chan):
-        """Disables specified channel output, argument is integer for channel number"""
-        self.ps.write("INSTrument:SELect CH" + str(chan))
-        time.sleep(self.cmd_delay)
-        self.ps.write("SOURce:CHANnel:OUTPut:STATe OFF")
-        time.sleep(self.cmd_delay)
-        
+        """Disables specified channel output, argument is integer for channel number.  Always sent, regardless of the shadow state."""
+        self.send(self.state.disable_output_ch(chan))
+    
+    def read_output_state_all(self, priority=False):
+        """Reads the output state of every channel back from the supply, not the shadow state.
+        Returns (CH1, CH2, CH3) booleans."""
+        self.state.selected_channel = None    # Left on CH3 once the query completes
+        return self.state.output_states(self.pacer.query(self.state.OUTPUT_STATE_QUERY, priority))
+    
     def set_current_ch(self, chan, current):
         """Sets specified channel current limit, argument is integer for channel number and float for current in amps"""
-        self.ps.write("INSTrument:SELect CH" + str(chan))
-        time.sleep(self.cmd_delay)
-        self.ps.write("CURRent " + str(current) + "A")
-        time.sleep(self.cmd_delay)
-        
+        self.send(self.state.set_current_ch(chan, current))
+    
     def set_voltage_ch(self, chan, voltage):
         """Sets specified channel voltage limit, argument is integer for channel number and float for voltage in volts"""
-        self.ps.write("INSTrument:SELect CH" + str(chan))
-        time.sleep(self.cmd_delay)
-        self.ps.write("VOLTage " + str(voltage) + "V")
-        time.sleep(self.cmd_delay)
-        
+        self.send(self.state.set_voltage_ch(chan, voltage))
+    
+    def get_current_setpoint_ch(self, chan):
+        """Returns a float of specified channel current limit, answered from the shadow state when known"""
+        current = self.state.known_setpoint(self.state.current_setpoint, chan)
+        if current is None:
+            self.select_channel(chan)
+            current = float(self.pacer.query("CURRent?"))
+            self.state.update_shadow(self.state.current_setpoint, chan, current)
+        return current
+    
+    def get_voltage_setpoint_ch(self, chan):
+        """Returns a float of specified channel voltage limit, answered from the shadow state when known"""
+        voltage = self.state.known_setpoint(self.state.voltage_setpoint, chan)
+        if voltage is None:
+            self.select_channel(chan)
+            voltage = float(self.pacer.query("VOLTage?"))
+            self.state.update_shadow(self.state.voltage_setpoint, chan, voltage)
+        return voltage
+    
     def read_voltage_ch(self, chan):
         """Returns a float of specified channel voltage output, argument is integer for channel number"""
-        self.ps.write("INSTrument:SELect CH" + str(chan))
-        time.sleep(self.cmd_delay)
-        return float(self.ps.query("VOLTage?"))
-        
+        self.select_channel(chan)
+        return float(self.pacer.query("VOLTage?"))
+    
+    def measure_voltage_all(self):
+        """Returns a tuple of measured output voltage for all three channels in one query"""
+        return tuple(float(x) for x in self.pacer.query("MEASure:VOLTage:ALL?").split(','))
+    
+    def measure_current_all(self):
+        """Returns a tuple of measured output current for all three channels in one query"""
+        return tuple(float(x) for x in self.pacer.query("MEASure:CURRent:ALL?").split(','))
+    
+    def measure_all(self):
+        """Returns a ChannelMeasurements of measured voltage, current and power for all three channels.
+        The three all-channel MEASure queries are sent as one compound query, so this is a single transaction
+        and needs no channel select."""
+        response = self.pacer.query("MEASure:VOLTage:ALL?;:MEASure:CURRent:ALL?;:MEASure:POWer:ALL?")
+        fields = [tuple(float(x) for x in part.split(',')) for part in response.strip().split(';')]
+        return ChannelMeasurements(*fields)
+    
+    def batch(self):
+        """Returns a Bk9129BBatch that collects setpoint and output operations and sends them in as few lines as possible.
+        Use as a context manager, the batch is sent when the block exits without an exception."""
+        return Bk9129BBatch(self)
+    
+    def apply_all(self, voltages, currents=None):
+        """Sets all three channel voltages (and optionally currents) at once with APPLy, arguments are 3 element sequences"""
+        with self.batch() as b:
+            for chan in range(1, 4):
+                b.set_voltage_ch(chan, voltages[chan - 1])
+                if currents is not None:
+                    b.set_current_ch(chan, currents[chan - 1])
+    
     def close(self):
         """Close the power supply instance."""
         self.disable_output_all()
-        self.ps.write("SYST:LOC")       # Put the power supply back into local control
-        time.sleep(self.cmd_delay)
+        self.write("SYST:LOC")       # Put the power supply back into local control
         #self.esr = self.ps.query("SYST:ERR?") # Cofirm no errors
         #print("ESR=" + self.esr)
         self.ps.close()                     # Close the COM port
+    
+    def detach(self):
+        """Close the connection and leave the supply running as it is, the counterpart of attach=True."""
+        self.ps.close()
+
+class Bk9129BBatch(object):
+    """    Collects 9129B operations and sends them as a few semicolon joined SCPI lines.
+    When all three channels get the same kind of setting it is sent with a single APPLy:VOLTage,
+    APPLy:CURRent or OUTPut:STATe:ALL command, otherwise each channel gets one INSTrument:SELect
+    followed by its settings.  Short form headers are used to keep the lines small.
+    Outputs being turned off are sent before new setpoints, outputs being turned on after, so a
+    channel is never enabled with a stale setpoint.  Operations that match the supply's shadow
+    state are dropped."""
+    
+    CHANNELS = (1, 2, 3)
+    MAX_LINE_LENGTH = 120   # Characters per line, keeps well inside the supply's input buffer
+    
+    def __init__(self, supply):
+        self.supply = supply
+        self.state = supply.state
+        self.clear()
+    
+    def clear(self):
+        """Discard all collected operations."""
+        self.voltage = {}
+        self.current = {}
+        self.output = {}
+        self.output_all = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.send()
+    
+    def set_voltage_ch(self, chan, voltage):
+        self.voltage[chan] = voltage
+    
+    def set_current_ch(self, chan, current):
+        self.current[chan] = current
+    
+    def enable_output_ch(self, chan):
+        self.output[chan] = True
+    
+    def disable_output_ch(self, chan):
+        self.output[chan] = False
+    
+    def enable_output_all(self):
+        self.output = dict.fromkeys(self.CHANNELS, True)
+    
+    def disable_output_all(self):
+        self.output = dict.fromkeys(self.CHANNELS, False)
+    
+    def commands(self):
+        """Returns the list of SCPI commands the batch will send, in order."""
+        commands = []
+        self.last_selected = self.state.selected_channel
+        
+        # Outputs going off first
+        off = [chan for chan in self.CHANNELS if self.output.get(chan) is False]
+        if len(off) == len(self.CHANNELS):
+            commands.append("OUTP:STAT:ALL OFF")
+        else:
+            for chan in off:
+                self.select(commands, chan)
+                commands.append("SOUR:CHAN:OUTP:STAT OFF")
+        
+        # Setpoints, using APPLy when every channel is given a value
+        per_channel = dict((chan, []) for chan in self.CHANNELS)
+        if len(self.voltage) == len(self.CHANNELS):
+            commands.append("APPL:VOLT " + ','.join(str(self.voltage[chan]) for chan in self.CHANNELS))
+        else:
+            for chan in self.voltage:
+                per_channel[chan].append("VOLT " + str(self.voltage[chan]) + "V")
+        if len(self.current) == len(self.CHANNELS):
+            commands.append("APPL:CURR " + ','.join(str(self.current[chan]) for chan in self.CHANNELS))
+        else:
+            for chan in self.current:
+                per_channel[chan].append("CURR " + str(self.current[chan]) + "A")
+        
+        # Outputs going on last, after that channel's setpoints
+        on = [chan for chan in self.CHANNELS if self.output.get(chan) is True]
+        if len(on) != len(self.CHANNELS):
+            for chan in on:
+                per_channel[chan].append("SOUR:CHAN:OUTP:STAT ON")
+        for chan in self.CHANNELS:
+            if per_channel[chan]:
+                self.select(commands, chan)
+                commands.extend(per_channel[chan])
+        if len(on) == len(self.CHANNELS):
+            commands.append("OUTP:STAT:ALL ON")
+        
+        return commands
+    
+    def select(self, commands, chan):
+        if chan != self.last_selected:
+            commands.append("INST:SEL CH" + str(chan))
+            self.last_selected = chan
+    
+    def lines(self):
+        """Returns the batch packed into semicolon joined lines.
+        Every command after the first on a line gets a leading colon so it is parsed from the root node."""
+        lines = []
+        line = ''
+        for command in self.commands():
+            if line and len(line) + len(command) + 2 > self.MAX_LINE_LENGTH:
+                lines.append(line)
+                line = ''
+            line = command if not line else line + ';:' + command
+        if line:
+            lines.append(line)
+        return lines
+    
+    def drop_cached(self):
+        """Remove operations that would not change the supply's shadow state."""
+        state = self.state
+        for shadow, pending in ((state.voltage_setpoint, self.voltage), (state.current_setpoint, self.current), (state.output_state, self.output)):
+            for chan in list(pending):
+                if state.cached(shadow, chan, pending[chan]):
+                    del pending[chan]
+    
+    def plan(self):
+        """Returns the Bk9129BPlan of the batch, its commands are the lines, and clears the batch.
+        The driver sends it like the plan of any other operation."""
+        state = self.state
+        if any(self.output.values()):
+            state.refuse()
+        self.drop_cached()
+        lines = self.lines()
+        updates = [(shadow, chan, pending[chan]) for shadow, pending in
+                   ((state.voltage_setpoint, self.voltage), (state.current_setpoint, self.current), (state.output_state, self.output))
+                   for chan in pending]
+        self.clear()
+        return state.plan(lines, updates, self.last_selected)
+    
+    def send(self):
+        """Send the collected operations to the supply, update its shadow state and clear the batch."""
+        self.supply.send(self.plan())
         
 class BkDcLoad_8500(object):
     """    This class creates an instance to control the BK8500 DC programmable load.
@@ -128,7 +735,27 @@ class BkDcLoad_8500(object):
     GET_CW_MODE_POWER = 0x2F
     SET_CR_MODE_RESISTANCE = 0x30
     GET_CR_MODE_RESISTANCE = 0x31
-    # Transient and List operations not implemented (0x32 - 0x4D)
+    # Transient operations not implemented (0x32 - 0x39)
+    SET_LIST_MODE = 0x3A
+    GET_LIST_MODE = 0x3B
+    SET_LIST_REPEAT = 0x3C
+    GET_LIST_REPEAT = 0x3D
+    SET_LIST_STEP_COUNT = 0x3E
+    GET_LIST_STEP_COUNT = 0x3F
+    SET_LIST_STEP_CURRENT = 0x40
+    GET_LIST_STEP_CURRENT = 0x41
+    SET_LIST_STEP_VOLTAGE = 0x42
+    GET_LIST_STEP_VOLTAGE = 0x43
+    SET_LIST_STEP_POWER = 0x44
+    GET_LIST_STEP_POWER = 0x45
+    SET_LIST_STEP_RESISTANCE = 0x46
+    GET_LIST_STEP_RESISTANCE = 0x47
+    SET_LIST_FILE_NAME = 0x48
+    GET_LIST_FILE_NAME = 0x49
+    SET_LIST_PARTITION = 0x4A
+    GET_LIST_PARTITION = 0x4B
+    SAVE_LIST = 0x4C
+    RECALL_LIST = 0x4D
     # 0x4E and 0x4F technically called battery testing, but is functionally under voltage lockout.
     SET_UVLO_VOLTAGE = 0x4E
     GET_UVLO_VOLTAGE = 0x4F
@@ -136,15 +763,25 @@ class BkDcLoad_8500(object):
     # Communication address not implemented (0x54)
     # SET_LOCAL = 0x55 # Disables 'LOCAL' key on front panel, do not implement...
     # Remote sensing not implemented (0x56 - 0x57)
-    # Triggering not implemented (no transient implemented) (0x58 - 0x5A)
+    SET_TRIGGER_SOURCE = 0x58
+    GET_TRIGGER_SOURCE = 0x59
+    TRIGGER = 0x5A
     # Store/Recall not implemented (0x5B - 0x5C)
-    # SET_FUNCTION_MODE = 0x5D # Only constant modes implemented in this library
-    # GET_FUNCTION_MODE = 0x5E
+    SET_FUNCTION_MODE = 0x5D # Only fixed (constant) and list modes used by this library
+    GET_FUNCTION_MODE = 0x5E
     GET_VALUES = 0x5F
     # Calibration not implemented (0x60 - 0x69)
     GET_MFG_INFO = 0x6A
     # Barcode info not implemented (0x6B)
     
+    # Code tables for the one byte settings
+    TRIGGER_SOURCE_CODES = {'IMMEDIATE': 0x00, 'EXTERNAL': 0x01, 'BUS': 0x02}
+    TRIGGER_SOURCE_NAMES = {0x00: 'IMMEDIATE', 0x01: 'EXTERNAL', 0x02: 'BUS'}
+    FUNCTION_MODE_CODES = {'FIXED': 0x00, 'SHORT': 0x01, 'TRANSIENT': 0x02, 'LIST': 0x03, 'BATTERY': 0x04}
+    FUNCTION_MODE_NAMES = {0x00: 'FIXED', 0x01: 'SHORT', 0x02: 'TRANSIENT', 0x03: 'LIST', 0x04: 'BATTERY'}
+    LIST_REPEAT_CODES = {False: 0x00, True: 0x01}     # Run once or repeat until stopped
+    LIST_REPEAT_NAMES = {0x00: False, 0x01: True}
+    
     # Device constants
     START_BYTE = 0xAA
     INSTRUMENT_ADDRESS = 0x00 # Unless you've changed it...
@@ -158,6 +795,8 @@ class BkDcLoad_8500(object):
     STATUS_BAD_COMMAND = 0xC0
     STATUS_SUCCESS = 0x80
     STATUS_BAD_PACKET = 0x00 # This is mine...general catchall for malformed packet
+    STATUS_NAMES = {STATUS_BAD_CHECKSUM: 'BAD CHECKSUM', STATUS_BAD_PARAMETER: 'BAD PARAMETER', STATUS_UNKNOWN_COMMAND: 'UNKNOWN COMMAND',
+                    STATUS_BAD_COMMAND: 'BAD COMMAND', STATUS_BAD_PACKET: 'BAD OR MISSING RESPONSE'}
     
     # Command Dictionaries
     cmd_remote_control = {'command': SET_REMOTE, 'command_arg': [0x01], 'arg_format': None, 'command_return': 'status_packet'}
@@ -184,12 +823,82 @@ class BkDcLoad_8500(object):
     cmd_get_uvlo_voltage = {'command': GET_UVLO_VOLTAGE, 'command_arg': [], 'arg_format': None, 'command_return': 'four_byte_1mv_units'}
     cmd_get_present_values = {'command': GET_VALUES, 'command_arg': [], 'arg_format': None, 'command_return': 'front_panel_struct'}
     cmd_get_mfg_info = {'command': GET_MFG_INFO, 'command_arg': [], 'arg_format': None, 'command_return': 'mfg_info_struct'}
+    cmd_set_list_mode = {'command': SET_LIST_MODE, 'command_arg': [], 'arg_format': 'op_mode', 'command_return': 'status_packet'}
+    cmd_get_list_mode = {'command': GET_LIST_MODE, 'command_arg': [], 'arg_format': None, 'command_return': 'op_mode'}
+    cmd_set_list_repeat = {'command': SET_LIST_REPEAT, 'command_arg': [], 'arg_format': 'byte_code', 'codes': LIST_REPEAT_CODES, 'command_return': 'status_packet'}
+    cmd_get_list_repeat = {'command': GET_LIST_REPEAT, 'command_arg': [], 'arg_format': None, 'names': LIST_REPEAT_NAMES, 'command_return': 'byte_code'}
+    cmd_set_list_step_count = {'command': SET_LIST_STEP_COUNT, 'command_arg': [], 'arg_format': 'two_byte', 'command_return': 'status_packet'}
+    cmd_get_list_step_count = {'command': GET_LIST_STEP_COUNT, 'command_arg': [], 'arg_format': None, 'command_return': 'two_byte'}
+    cmd_set_list_file_name = {'command': SET_LIST_FILE_NAME, 'command_arg': [], 'arg_format': 'file_name', 'command_return': 'status_packet'}
+    cmd_get_list_file_name = {'command': GET_LIST_FILE_NAME, 'command_arg': [], 'arg_format': None, 'command_return': 'file_name'}
+    cmd_set_list_partition = {'command': SET_LIST_PARTITION, 'command_arg': [], 'arg_format': 'one_byte', 'command_return': 'status_packet'}
+    cmd_get_list_partition = {'command': GET_LIST_PARTITION, 'command_arg': [], 'arg_format': None, 'command_return': 'one_byte'}
+    cmd_save_list = {'command': SAVE_LIST, 'command_arg': [], 'arg_format': 'one_byte', 'command_return': 'status_packet'}
+    cmd_recall_list = {'command': RECALL_LIST, 'command_arg': [], 'arg_format': 'one_byte', 'command_return': 'status_packet'}
+    cmd_set_trigger_source = {'command': SET_TRIGGER_SOURCE, 'command_arg': [], 'arg_format': 'byte_code', 'codes': TRIGGER_SOURCE_CODES, 'command_return': 'status_packet'}
+    cmd_get_trigger_source = {'command': GET_TRIGGER_SOURCE, 'command_arg': [], 'arg_format': None, 'names': TRIGGER_SOURCE_NAMES, 'command_return': 'byte_code'}
+    cmd_trigger = {'command': TRIGGER, 'command_arg': [], 'arg_format': None, 'command_return': 'status_packet'}
+    cmd_set_function_mode = {'command': SET_FUNCTION_MODE, 'command_arg': [], 'arg_format': 'byte_code', 'codes': FUNCTION_MODE_CODES, 'command_return': 'status_packet'}
+    cmd_get_function_mode = {'command': GET_FUNCTION_MODE, 'command_arg': [], 'arg_format': None, 'names': FUNCTION_MODE_NAMES, 'command_return': 'byte_code'}
+    
+    # List steps, per list mode.  Set takes (step, value, seconds), get takes the step number and returns (value, seconds)
+    cmd_set_list_step = {
+        'CC': {'command': SET_LIST_STEP_CURRENT, 'command_arg': [], 'arg_format': 'list_step', 'value_format': 'four_byte_0ma1_units', 'command_return': 'status_packet'},
+        'CV': {'command': SET_LIST_STEP_VOLTAGE, 'command_arg': [], 'arg_format': 'list_step', 'value_format': 'four_byte_1mv_units', 'command_return': 'status_packet'},
+        'CW': {'command': SET_LIST_STEP_POWER, 'command_arg': [], 'arg_format': 'list_step', 'value_format': 'four_byte_1mw_units', 'command_return': 'status_packet'},
+        'CR': {'command': SET_LIST_STEP_RESISTANCE, 'command_arg': [], 'arg_format': 'list_step', 'value_format': 'four_byte_1mo_units', 'command_return': 'status_packet'},
+    }
+    cmd_get_list_step = {
+        'CC': {'command': GET_LIST_STEP_CURRENT, 'command_arg': [], 'arg_format': 'two_byte', 'value_format': 'four_byte_0ma1_units', 'command_return': 'list_step'},
+        'CV': {'command': GET_LIST_STEP_VOLTAGE, 'command_arg': [], 'arg_format': 'two_byte', 'value_format': 'four_byte_1mv_units', 'command_return': 'list_step'},
+        'CW': {'command': GET_LIST_STEP_POWER, 'command_arg': [], 'arg_format': 'two_byte', 'value_format': 'four_byte_1mw_units', 'command_return': 'list_step'},
+        'CR': {'command': GET_LIST_STEP_RESISTANCE, 'command_arg': [], 'arg_format': 'two_byte', 'value_format': 'four_byte_1mo_units', 'command_return': 'list_step'},
+    }
     
     # All data is little endian (lower MSB first)
     
-    # Buffer initialization
-    rx_buff = [0x00] * PACKET_LENGTH
-    tx_buff = [0x00] * PACKET_LENGTH
+    # Precompiled packet layouts, offsets are from the start of the 26 byte packet
+    FOUR_BYTE_UNITS = struct.Struct('<I')       # Bytes 3-6 of set/get unit value commands
+    FRONT_PANEL_VALUES = struct.Struct('<III')  # Bytes 3-14: voltage (1mV), current (0.1mA), power (1mW)
+    OPERATION_STATE_OFFSET = 15                 # GET_VALUES operation state register
+    LOAD_ON_BIT = 0x08                          # Operation state register bit 3, the input is on
+    MFG_INFO = struct.Struct('<4sxBB10s')       # Bytes 3-19: model, reserved, firmware minor, firmware major, serial
+    TWO_BYTE_UNITS = struct.Struct('<H')        # Bytes 3-4: list step count or step number
+    LIST_STEP = struct.Struct('<HIH')           # Bytes 3-10: step number, value, step time
+    FILE_NAME_LENGTH = 10                       # Bytes 3-12: list file name, zero padded
+    CMD_DATA_OFFSET = 3
+    CHECKSUM_OFFSET = PACKET_LENGTH - 1
+    EMPTY_PAYLOAD = bytes(PACKET_LENGTH - 4)    # Zero stuffing for bytes 3-24
+    
+    # Counts per unit for each of the four byte argument/return formats
+    UNIT_SCALE = {'four_byte_1mv_units': 1000, 'four_byte_0ma1_units': 10000, 'four_byte_1mw_units': 1000, 'four_byte_1mo_units': 1000}
+    OP_MODE_CODES = {'CC': 0x00, 'CV': 0x01, 'CW': 0x02, 'CR': 0x03}
+    OP_MODE_NAMES = {0x00: 'CC', 0x01: 'CV', 0x02: 'CW', 0x03: 'CR'}
+    LIST_TIME_SCALE = 10000     # List step time counts per second (0.1ms units)
+    MAX_LIST_STEPS = 84         # With the list memory in a single partition
+    
+    # Settings held in the shadow state cache, set opcode -> matching get opcode
+    CACHED_SETTINGS = {
+        SET_MAX_VOLTAGE_LIMIT: GET_MAX_VOLTAGE_LIMIT,
+        SET_MAX_CURRENT_LIMIT: GET_MAX_CURRENT_LIMIT,
+        SET_MAX_POWER_LIMIT: GET_MAX_POWER_LIMIT,
+        SET_OP_MODE: GET_OP_MODE,
+        SET_CC_MODE_CURRENT: GET_CC_MODE_CURRENT,
+        SET_CV_MODE_VOLTAGE: GET_CV_MODE_VOLTAGE,
+        SET_CW_MODE_POWER: GET_CW_MODE_POWER,
+        SET_CR_MODE_RESISTANCE: GET_CR_MODE_RESISTANCE,
+        SET_UVLO_VOLTAGE: GET_UVLO_VOLTAGE,
+    }
+    CACHED_READBACKS = dict((get_op, set_op) for set_op, get_op in CACHED_SETTINGS.items())
+    NOT_CACHED = object()   # Marker for a command the shadow state cannot answer
+    
+    instrumentation = None  # insttrace.Instrumentation, set by insttrace.instrument()
+    interlock = None        # interlock.Interlock guarding the input, set by the Interlock
+    address = INSTRUMENT_ADDRESS
+    sample_t = SampleStamp()    # Estimated time.monotonic() the last response's reading was taken, see sample_time()
+    sample_offset = 0.0
+    bus = None              # bkbus.Bk8500Bus when the load shares a multi-drop bus
+    list_duration = None    # Seconds one pass of the last uploaded list takes
     
     def to_bytes_1mv_units(self, voltage):
         voltage_1mv = int(voltage * 1000)
@@ -224,8 +933,9 @@ class BkDcLoad_8500(object):
         return resistance_1o
         
     def convert_op_mode(self, mode):
-        mode_dict = {0x00: 'CC', 'CC': [0x00], 0x01: 'CV', 'CV': [0x01], 0x02: 'CW', 'CW': [0x02], 0x03: 'CR', 'CR': [0x03]}
-        return mode_dict[mode]
+        if mode in self.OP_MODE_NAMES:
+            return self.OP_MODE_NAMES[mode]
+        return [self.OP_MODE_CODES[mode]]
     
     def calc_checksum(self, packet):
         checksum = 0
@@ -248,6 +958,8 @@ class BkDcLoad_8500(object):
             else:
                 if rx_buff[3] == self.STATUS_BAD_CHECKSUM:
                     print('ERROR: BAD CHECKSUM')
+                    if self.instrumentation is not None:
+                        self.instrumentation.checksum_failure(self)
                 elif rx_buff[3] == self.STATUS_BAD_PARAMETER:
                     print('ERROR: BAD PARAMETER')
                 elif rx_buff[3] == self.STATUS_UNKNOWN_COMMAND:
@@ -262,64 +974,179 @@ class BkDcLoad_8500(object):
             
                 return rx_buff[3]
         
-    def send_command(self, cmd, arg=None): 
-        # Start by formatting argument if applicable
-        if cmd['arg_format'] == 'four_byte_1mv_units':
-            cmd['command_arg'] = self.to_bytes_1mv_units(arg)
-        elif cmd['arg_format'] == 'four_byte_0ma1_units':
-            cmd['command_arg'] = self.to_bytes_0ma1_units(arg)
-        elif cmd['arg_format'] == 'four_byte_1mw_units':
-            cmd['command_arg'] = self.to_bytes_1mw_units(arg)
-        elif cmd['arg_format'] == 'op_mode':
-            cmd['command_arg'] = self.convert_op_mode(arg)
-        else: pass
-    
-        self.tx_buff = []
-        self.tx_buff.append(self.START_BYTE)             # Byte 0
-        self.tx_buff.append(self.INSTRUMENT_ADDRESS)     # Byte 1
-        self.tx_buff.append(cmd['command'])              # Byte 2
-        self.tx_buff = self.tx_buff + cmd['command_arg']      # Bytes 3+
-        self.tx_buff = self.tx_buff + ([self.RESERVED_BYTE] * (self.PACKET_LENGTH - 3 - len(cmd['command_arg']) - 1)) # Zero stuff unused bytes in packet
-        
-        self.tx_buff.append(0x00)                        # Placeholder for checksum
-        
-        self.tx_buff[-1] = self.calc_checksum(self.tx_buff)   # Insert checksum to end of packet
-        
-        # Clear UART buffers
-        self.sp.reset_output_buffer()
-        self.sp.reset_input_buffer()
-        
-        # Send the command, wait for all bytes to send
-        self.sp.write(bytearray(self.tx_buff))
-        self.sp.flush()
-        
-        # Receive response packet
-        self.rx_buff = list(self.sp.read(self.PACKET_LENGTH))
-        
-        if cmd['command_return'] == 'status_packet':
-            if self.check_status(self.rx_buff) != self.STATUS_SUCCESS:
-                assert ValueError
-        elif cmd['command_return'] == 'four_byte_1mv_units':
-            return self.from_bytes_1mv_units(self.rx_buff[3:7])
-        elif cmd['command_return'] == 'four_byte_0ma1_units':
-            return self.from_bytes_0ma1_units(self.rx_buff[3:7])
-        elif cmd['command_return'] == 'four_byte_1mw_units':
-            return self.from_bytes_1mw_units(self.rx_buff[3:7])
-        elif cmd['command_return'] == 'op_mode':
-            return self.convert_op_mode(self.rx_buff[3])
-        elif cmd['command_return'] == 'front_panel_struct':
-            voltage = self.from_bytes_1mv_units(self.rx_buff[3:7])
-            current = self.from_bytes_0ma1_units(self.rx_buff[7:11])
-            power = self.from_bytes_1mw_units(self.rx_buff[11:14])
-            return  {'voltage': voltage, 'current': current, 'power': power}
-        elif cmd['command_return'] == 'mfg_info_struct':
-            model = ''.join([chr(x) for x in self.rx_buff[3:7]])
-            firmware = (int(self.rx_buff[8]) / 100.0) + int(self.rx_buff[9])
-            serial = ''.join([chr(x) for x in self.rx_buff[10:20]])
-            return  {'model': model, 'firmware': firmware, 'serial': serial}    
+    # Argument encoders, each packs the argument into the transmit buffer starting at byte 3
+    
+    def encode_fixed_arg(self, cmd, arg):
+        self.tx_buff[3:3 + len(cmd['command_arg'])] = bytes(cmd['command_arg'])
+        
+    def encode_four_byte_units(self, cmd, arg):
+        self.FOUR_BYTE_UNITS.pack_into(self.tx_buff, self.CMD_DATA_OFFSET, int(arg * self.UNIT_SCALE[cmd['arg_format']]))
+        
+    def encode_op_mode(self, cmd, arg):
+        self.tx_buff[3] = self.OP_MODE_CODES[arg]
+        
+    def encode_byte_code(self, cmd, arg):
+        self.tx_buff[3] = cmd['codes'][arg]
+        
+    def encode_one_byte(self, cmd, arg):
+        self.tx_buff[3] = int(arg)
+        
+    def encode_two_byte(self, cmd, arg):
+        self.TWO_BYTE_UNITS.pack_into(self.tx_buff, self.CMD_DATA_OFFSET, int(arg))
+        
+    def encode_list_step(self, cmd, arg):
+        step, value, seconds = arg
+        time_counts = int(round(seconds * self.LIST_TIME_SCALE))
+        if not 0 < time_counts <= 0xFFFF:
+            raise ValueError('LIST STEP TIME OUT OF RANGE: ' + str(seconds))
+        self.LIST_STEP.pack_into(self.tx_buff, self.CMD_DATA_OFFSET, step, int(value * self.UNIT_SCALE[cmd['value_format']]), time_counts)
+        
+    def encode_file_name(self, cmd, arg):
+        name = arg.encode('latin-1')[:self.FILE_NAME_LENGTH]
+        self.tx_buff[3:3 + len(name)] = name
+    
+    # Return decoders, each unpacks the response held in the receive buffer
+    
+    def decode_status_packet(self, cmd):
+        status = self.check_status(self.rx_buff)
+        if status != self.STATUS_SUCCESS:
+            raise ValueError('LOAD REJECTED COMMAND 0x%02X: %s' % (cmd['command'], self.STATUS_NAMES.get(status, 'STATUS 0x%02X' % status)))
+            
+    def decode_four_byte_units(self, cmd):
+        return self.FOUR_BYTE_UNITS.unpack_from(self.rx_buff, self.CMD_DATA_OFFSET)[0] / self.UNIT_SCALE[cmd['command_return']]
+        
+    def decode_op_mode(self, cmd):
+        return self.OP_MODE_NAMES[self.rx_buff[3]]
+        
+    def decode_byte_code(self, cmd):
+        return cmd['names'].get(self.rx_buff[3])
+        
+    def decode_one_byte(self, cmd):
+        return self.rx_buff[3]
+        
+    def decode_two_byte(self, cmd):
+        return self.TWO_BYTE_UNITS.unpack_from(self.rx_buff, self.CMD_DATA_OFFSET)[0]
+        
+    def decode_list_step(self, cmd):
+        step, value, time_counts = self.LIST_STEP.unpack_from(self.rx_buff, self.CMD_DATA_OFFSET)
+        return value / self.UNIT_SCALE[cmd['value_format']], time_counts / float(self.LIST_TIME_SCALE)
+        
+    def decode_file_name(self, cmd):
+        return bytes(self.rx_view[3:3 + self.FILE_NAME_LENGTH]).rstrip(b'\x00').decode('latin-1')
+        
+    def decode_front_panel_struct(self, cmd):
+        voltage, current, power = self.FRONT_PANEL_VALUES.unpack_from(self.rx_buff, self.CMD_DATA_OFFSET)
+        return {'voltage': voltage / 1000.0, 'current': current / 10000.0, 'power': power / 1000.0}
+        
+    def decode_mfg_info_struct(self, cmd):
+        model, firmware_minor, firmware_major, serial = self.MFG_INFO.unpack_from(self.rx_buff, self.CMD_DATA_OFFSET)
+        return {'model': model.decode('latin-1'), 'firmware': (firmware_minor / 100.0) + firmware_major, 'serial': serial.decode('latin-1')}
+        
+    def decode_unknown(self, cmd):
+        raise ValueError('UNKNOWN RETURN DATA TYPE ' + str(cmd['command_return']))
+        
+    def transact(self):
+        """Send the packet in tx_buff and read the response into rx_buff.  Caller holds the lock."""
+        start = time.monotonic()
+        if self.bus is not None:
+            self.bus.transact(self.address, self.tx_buff, self.rx_view)
         else:
-            print('ERROR: UNKNOWN RETURN DATA TYPE')
-            assert ValueError
+            # Clear UART buffers
+            self.sp.reset_output_buffer()
+            self.sp.reset_input_buffer()
+            
+            # Send the command, wait for all bytes to send
+            self.sp.write(self.tx_buff)
+            self.sp.flush()
+            
+            # Receive response packet, a short read is zero filled so it fails as a bad packet
+            rx_len = self.sp.readinto(self.rx_buff)
+            if rx_len != self.PACKET_LENGTH:
+                self.rx_view[rx_len or 0:] = bytes(self.PACKET_LENGTH - (rx_len or 0))
+        self.sample_t = sample_time(start, time.monotonic(), self.PACKET_LENGTH, self.PACKET_LENGTH, self.baudrate, self.sample_offset)
+        
+    def shadow_value(self, cmd, arg):
+        """The value a setting will read back as once the load has quantized it."""
+        scale = self.UNIT_SCALE.get(cmd['arg_format'])
+        if scale is None:
+            return arg
+        return int(arg * scale) / float(scale)
+        
+    def refuse(self, cmd):
+        """Raises interlock.InterlockTripped if cmd turns the input on while an interlock trip is latched."""
+        if self.interlock is not None and cmd is self.cmd_enable_load:
+            self.interlock.refuse('load')
+        
+    def invalidate_cache(self):
+        """Forget all shadow state, the next settings and readbacks go to the load."""
+        self.shadow = {}    # Set opcode -> last value known to be on the load
+        
+    def resync(self):
+        """Read the mode, setpoints and limits back from the load into the shadow state."""
+        self.invalidate_cache()
+        for cmd in (self.cmd_get_max_voltage_limit, self.cmd_get_max_current_limit, self.cmd_get_max_power_limit, self.cmd_get_mode,
+                    self.cmd_get_cc_mode_current, self.cmd_get_cv_mode_voltage, self.cmd_get_cw_mode_power, self.cmd_get_cr_mode_resistance,
+                    self.cmd_get_uvlo_voltage):
+            self.send_command(cmd)
+        
+    def cached_result(self, cmd, arg):
+        """Returns the shadow state answer for a command, or NOT_CACHED if it has to go to the load."""
+        if self.cache:
+            opcode = cmd['command']
+            if opcode in self.CACHED_SETTINGS:
+                if self.shadow.get(opcode) == self.shadow_value(cmd, arg):
+                    return None
+            elif opcode in self.CACHED_READBACKS and self.CACHED_READBACKS[opcode] in self.shadow:
+                return self.shadow[self.CACHED_READBACKS[opcode]]
+        return self.NOT_CACHED
+        
+    def encode_command(self, cmd, arg):
+        """Build the command packet in tx_buff."""
+        # Bytes 0-1 (start and address) are fixed, fill the command and zero stuff the rest
+        self.tx_buff[2] = cmd['command']
+        self.tx_view[3:self.CHECKSUM_OFFSET] = self.EMPTY_PAYLOAD
+        self.arg_encoders.get(cmd['arg_format'], self.encode_fixed_arg)(cmd, arg)
+        
+        # Insert checksum to end of packet
+        self.tx_buff[self.CHECKSUM_OFFSET] = sum(self.tx_view[:self.CHECKSUM_OFFSET]) & 0xFF
+        
+    def decode_response(self, cmd, arg):
+        """Decode the response in rx_buff and update the shadow state.
+        Raises ValueError when the load answers a setting with an error status (or not at all)."""
+        opcode = cmd['command']
+        if self.cache and opcode in self.CACHED_SETTINGS:
+            # Updated before decoding, a rejected setting leaves the value on the load unknown
+            if self.rx_buff[2] == self.STATUS_DATA and self.rx_buff[3] == self.STATUS_SUCCESS:
+                self.shadow[opcode] = self.shadow_value(cmd, arg)
+            else:
+                self.shadow.pop(opcode, None)
+        result = self.return_decoders.get(cmd['command_return'], self.decode_unknown)(cmd)
+        if self.cache and opcode in self.CACHED_READBACKS and result is not None:
+            self.shadow[self.CACHED_READBACKS[opcode]] = result
+        return result
+        
+    def send_command(self, cmd, arg=None, priority=False): 
+        # priority=True goes ahead of commands other threads are waiting to send (interlocks)
+        self.refuse(cmd)
+        with (self.lock.priority() if priority else self.lock):
+            result = self.cached_result(cmd, arg)
+            if result is not self.NOT_CACHED:
+                return result
+            if self.instrumentation is not None:
+                return self.traced_command(cmd, arg)
+                
+            self.encode_command(cmd, arg)
+            self.transact()
+            return self.decode_response(cmd, arg)
+            
+    def traced_command(self, cmd, arg):
+        """send_command with timing reported to the instrumentation.  Caller holds the lock."""
+        start = time.perf_counter()
+        self.encode_command(cmd, arg)
+        self.transact()
+        result = self.decode_response(cmd, arg)
+        self.instrumentation.command(self, cmd['command'], time.perf_counter() - start)
+        return result
     
     # Short methods for easy control:
     
@@ -329,7 +1156,7 @@ class BkDcLoad_8500(object):
     
     def enable_load(self): self.send_command(self.cmd_enable_load)
     
-    def disable_load(self): self.send_command(self.cmd_disable_load)
+    def disable_load(self, priority=False): self.send_command(self.cmd_disable_load, priority=priority)
     
     def set_max_voltage_limit(self, max_voltage):
         self.send_command(self.cmd_set_max_voltage_limit, max_voltage)
@@ -391,9 +1218,293 @@ class BkDcLoad_8500(object):
         
     def get_mfg_info(self):
         return self.send_command(self.cmd_get_mfg_info)
+        
+    # List mode, the load steps through an uploaded sequence at its own timing once triggered
     
-    def __init__(self, device=device_default, baudrate=9600):
+    def set_list_mode(self, mode):
+        # mode = 'CC', 'CV', 'CW', 'CR'
+        self.send_command(self.cmd_set_list_mode, mode)
+        
+    def get_list_mode(self):
+        return self.send_command(self.cmd_get_list_mode)
+        
+    def set_list_repeat(self, repeat):
+        self.send_command(self.cmd_set_list_repeat, bool(repeat))
+        
+    def get_list_repeat(self):
+        return self.send_command(self.cmd_get_list_repeat)
+        
+    def set_list_step_count(self, count):
+        self.send_command(self.cmd_set_list_step_count, count)
+        
+    def get_list_step_count(self):
+        return self.send_command(self.cmd_get_list_step_count)
+        
+    def set_list_step(self, mode, step, value, seconds):
+        # Steps are numbered from 1, value is in amps, volts, watts or ohms to suit the list mode
+        self.send_command(self.cmd_set_list_step[mode], (step, value, seconds))
+        
+    def get_list_step(self, mode, step):
+        # Returns (value, seconds)
+        return self.send_command(self.cmd_get_list_step[mode], step)
+        
+    def set_list_file_name(self, name):
+        self.send_command(self.cmd_set_list_file_name, name)
+        
+    def get_list_file_name(self):
+        return self.send_command(self.cmd_get_list_file_name)
+        
+    def set_list_partition(self, partition):
+        # partition = 1, 2, 4 or 8 files in the list memory
+        self.send_command(self.cmd_set_list_partition, partition)
+        
+    def get_list_partition(self):
+        return self.send_command(self.cmd_get_list_partition)
+        
+    def save_list(self, slot):
+        self.send_command(self.cmd_save_list, slot)
+        
+    def recall_list(self, slot):
+        self.send_command(self.cmd_recall_list, slot)
+        
+    def set_trigger_source(self, source):
+        # source = 'IMMEDIATE', 'EXTERNAL', 'BUS'
+        self.send_command(self.cmd_set_trigger_source, source)
+        
+    def get_trigger_source(self):
+        return self.send_command(self.cmd_get_trigger_source)
+        
+    def trigger(self): self.send_command(self.cmd_trigger)
+    
+    def set_function_mode(self, mode):
+        # mode = 'FIXED', 'SHORT', 'TRANSIENT', 'LIST', 'BATTERY'.  Set 'FIXED' to go back to set_mode() operation
+        self.send_command(self.cmd_set_function_mode, mode)
+        
+    def get_function_mode(self):
+        return self.send_command(self.cmd_get_function_mode)
+        
+    def upload_list(self, mode, steps, repeat=False, name=None):
+        """Upload a list program, steps is a sequence of (value, seconds) in the units of mode ('CC', 'CV', 'CW', 'CR')."""
+        if not 2 <= len(steps) <= self.MAX_LIST_STEPS:
+            raise ValueError('LIST NEEDS 2 TO %d STEPS' % self.MAX_LIST_STEPS)
+        self.set_list_mode(mode)
+        self.set_list_repeat(repeat)
+        self.set_list_step_count(len(steps))
+        for step, (value, seconds) in enumerate(steps, 1):
+            self.set_list_step(mode, step, value, seconds)
+        if name is not None:
+            self.set_list_file_name(name)
+        self.list_duration = sum(seconds for value, seconds in steps)
+        
+    def run_list(self, duration=None, disable=True):
+        """Trigger the uploaded list and poll present values while the load sequences it.
+        Runs for duration seconds, one pass of the last uploaded list by default.  The load is
+        disabled afterwards unless disable is False, it stays in list function mode.
+        Returns a list of (seconds since the trigger, volts, amps, watts)."""
+        if duration is None:
+            duration = self.list_duration
+            if duration is None:
+                raise ValueError('NO LIST UPLOADED, GIVE A DURATION')
+        self.set_trigger_source('BUS')
+        self.set_function_mode('LIST')
+        self.enable_load()
+        samples = []
+        try:
+            self.trigger()
+            start = time.monotonic()
+            while True:
+                elapsed = time.monotonic() - start
+                if elapsed > duration:
+                    break
+                counts = self.read_present_counts()
+                if counts is not None:
+                    samples.append((elapsed, counts[0] / 1000.0, counts[1] / 10000.0, counts[2] / 1000.0))
+        finally:
+            if disable:
+                self.disable_load()
+        return samples
+        
+    def read_present_counts(self):
+        """Poll GET_VALUES and return the raw (1mV, 0.1mA, 1mW) counts without building a dict.
+        Returns None if the response is malformed or fails its checksum."""
+        with self.lock:
+            self.encode_command(self.cmd_get_present_values, None)
+            self.transact()
+            return self.checked_counts()
+            
+    def write_read_counts(self, cmd, arg):
+        """Send a setting and GET_VALUES back to back in one write and read both responses in one go,
+        one round trip for a control loop iteration instead of two.  Returns (counts, accepted): the
+        raw present counts (None if malformed) and whether the load acknowledged the setting."""
+        self.refuse(cmd)
+        with self.lock:
+            accepted = True
+            if self.cached_result(cmd, arg) is self.NOT_CACHED:
+                self.encode_command(cmd, arg)
+                if self.bus is None:
+                    length = self.PACKET_LENGTH
+                    self.pair_tx[:length] = self.tx_buff
+                    self.encode_command(self.cmd_get_present_values, None)
+                    self.pair_tx[length:] = self.tx_buff
+                    start = time.monotonic()
+                    self.sp.reset_output_buffer()
+                    self.sp.reset_input_buffer()
+                    self.sp.write(self.pair_tx)
+                    self.sp.flush()
+                    rx_len = self.sp.readinto(self.pair_rx) or 0
+                    # The read goes out second and is answered second
+                    self.sample_t = sample_time(start, time.monotonic(), 2 * length, length, self.baudrate, self.sample_offset)
+                    if rx_len != 2 * length:
+                        self.pair_view[rx_len:] = bytes(2 * length - rx_len)
+                    self.rx_view[:] = self.pair_view[:length]
+                    accepted = self.setting_accepted(cmd, arg)
+                    self.rx_view[:] = self.pair_view[length:]
+                    return self.checked_counts(), accepted
+                # The bus matches one response per request, the two go out one after the other
+                self.transact()
+                accepted = self.setting_accepted(cmd, arg)
+            self.encode_command(self.cmd_get_present_values, None)
+            self.transact()
+            return self.checked_counts(), accepted
+            
+    def read_load_state(self, priority=False):
+        """Reads whether the load input is on from the operation state register of GET_VALUES,
+        not the shadow state.  Returns None if the response is malformed."""
+        with (self.lock.priority() if priority else self.lock):
+            self.encode_command(self.cmd_get_present_values, None)
+            self.transact()
+            if self.checked_counts() is None:
+                return None
+            return bool(self.rx_buff[self.OPERATION_STATE_OFFSET] & self.LOAD_ON_BIT)
+            
+    def setting_accepted(self, cmd, arg):
+        # Decodes the status response in rx_buff, caller holds the lock
+        try:
+            self.decode_response(cmd, arg)
+        except ValueError:
+            return False
+        return True
+        
+    def checked_counts(self):
+        # present_counts() with checksum failures reported, caller holds the lock
+        counts = self.present_counts()
+        if counts is None and self.instrumentation is not None:
+            self.instrumentation.checksum_failure(self)
+        return counts
+            
+    def present_counts(self):
+        """Returns the raw GET_VALUES counts held in rx_buff, or None if the response is malformed."""
+        if (self.rx_buff[0] != self.START_BYTE or self.rx_buff[2] != self.GET_VALUES
+                or (sum(self.rx_view[:self.CHECKSUM_OFFSET]) & 0xFF) != self.rx_buff[self.CHECKSUM_OFFSET]):
+            return None
+        return self.FRONT_PANEL_VALUES.unpack_from(self.rx_buff, self.CMD_DATA_OFFSET)
+            
+    def stream(self, capacity=65536, callback=None):
+        """Start background acquisition of present values, returns a running BkLoadStream."""
+        from bkstream import BkLoadStream     # Only pulls in numpy when streaming is used
+        return BkLoadStream(self, capacity=capacity, callback=callback).start()
+    
+    def __init__(self, device=device_default, baudrate=9600, cache=True, port=None, bus=None, address=None):
         # The 8500 instrument requires hardware flow control RTS and DTR signalling.
         # All packets to the 8500 are 26 bytes sent and 26 bytes received
+        # Several loads can share one port through a bkbus.Bk8500Bus, each with its own address
+        
+        # Shadow copy of the mode, setpoints and limits, skips writes that would not change anything
+        # and answers setpoint reads.  Front panel changes are not seen, call invalidate_cache() or resync().
+        self.cache = cache
+        self.invalidate_cache()
+        if address is not None:
+            self.address = address
+        
+        if bus is not None:
+            # The bus owns the port, responses are matched to this load by address
+            self.bus = bus
+            self.sp = None
+        elif port is not None:
+            # Already open serial.Serial like object, e.g. an instsim.Sim8500Serial
+            self.sp = port
+        else:
+            if device is None:
+                # Probe the system ports in parallel (or use the cached mapping) to find a load
+                import discover
+                device = discover.find_port('BK8500')
+                if device is None:
+                    raise NameError('NO BK8500 FOUND.')
+                self.sp = self.open_port(device, baudrate)
+                # Verify a cached mapping is still right, re-probe without the cache if not
+                self.sp.timeout = discover.PROBE_TIMEOUT
+                if not discover.probe_bk8500(self.sp):
+                    self.sp.close()
+                    discover.forget(device)
+                    device = discover.find_port('BK8500', use_cache=False)
+                    if device is None:
+                        raise NameError('NO BK8500 FOUND.')
+                    self.sp = self.open_port(device, baudrate)
+                else:
+                    self.sp.timeout = None
+            else:
+                self.sp = self.open_port(device, baudrate)
+        # Link speed for the wire time correction of sample_t, taken from the port when it has one
+        self.baudrate = getattr(bus.port if bus is not None else self.sp, 'baudrate', baudrate)
+        self.init_codec()
+        
+    @classmethod
+    def unconnected(cls, cache=True, address=None):
+        """An instance with the packet codec and shadow state but no port, for drivers that bring
+        their own transport (aioinsts) and only use encode_command(), decode_response() and friends."""
+        load = cls.__new__(cls)
+        load.cache = cache
+        load.invalidate_cache()
+        if address is not None:
+            load.address = address
+        load.sp = None
+        load.baudrate = None
+        load.init_codec()
+        return load
+        
+    def open_port(self, device, baudrate):
+        import serial   # From official package 'pyserial', only needed for a real port
+        return serial.Serial(port=device, baudrate=baudrate, write_timeout=5)
+        
+    def init_codec(self):
+        # Packet buffers are allocated once and reused for every command
+        self.lock = PriorityLock()
+        self.tx_buff = bytearray(self.PACKET_LENGTH)
+        self.rx_buff = bytearray(self.PACKET_LENGTH)
+        self.tx_view = memoryview(self.tx_buff)
+        self.rx_view = memoryview(self.rx_buff)
+        self.pair_tx = bytearray(2 * self.PACKET_LENGTH)     # Setting and read pipelined by write_read_counts()
+        self.pair_rx = bytearray(2 * self.PACKET_LENGTH)
+        self.pair_view = memoryview(self.pair_rx)
+        self.tx_buff[0] = self.START_BYTE
+        self.tx_buff[1] = self.address
         
-        self.sp = serial.Serial(port=device, baudrate=baudrate, write_timeout=5)
+        # Table lookups for the argument and return formats named in the command dictionaries
+        self.arg_encoders = {
+            None: self.encode_fixed_arg,
+            'four_byte_1mv_units': self.encode_four_byte_units,
+            'four_byte_0ma1_units': self.encode_four_byte_units,
+            'four_byte_1mw_units': self.encode_four_byte_units,
+            'four_byte_1mo_units': self.encode_four_byte_units,
+            'op_mode': self.encode_op_mode,
+            'byte_code': self.encode_byte_code,
+            'one_byte': self.encode_one_byte,
+            'two_byte': self.encode_two_byte,
+            'list_step': self.encode_list_step,
+            'file_name': self.encode_file_name,
+        }
+        self.return_decoders = {
+            'status_packet': self.decode_status_packet,
+            'four_byte_1mv_units': self.decode_four_byte_units,
+            'four_byte_0ma1_units': self.decode_four_byte_units,
+            'four_byte_1mw_units': self.decode_four_byte_units,
+            'four_byte_1mo_units': self.decode_four_byte_units,
+            'op_mode': self.decode_op_mode,
+            'front_panel_struct': self.decode_front_panel_struct,
+            'mfg_info_struct': self.decode_mfg_info_struct,
+            'byte_code': self.decode_byte_code,
+            'one_byte': self.decode_one_byte,
+            'two_byte': self.decode_two_byte,
+            'list_step': self.decode_list_step,
+            'file_name': self.decode_file_name,
+        }
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+import threading
+import numpy as np
+
+class BkLoadStream(object):
+    """    Background high-rate acquisition of BK8500 present values.
+    A dedicated reader thread polls GET_VALUES (0x5F) back to back and decodes voltage,
+    current and power straight into a preallocated ring buffer with monotonic timestamps.
+    Samples can be consumed by iterating the stream, through a callback run on the reader
+    thread, or by peeking at the latest sample.
+    
+    While streaming the reader thread keeps the link busy.  Other commands sent to the same load
+    are still safe: the load's lock serves waiting threads in turn, so each command goes out
+    after at most the one poll in flight and costs the stream one sample.
+    If a read raises, the stream stops and keeps the exception in error, iterating the stream
+    re-raises it once the buffered samples are consumed."""
+    
+    def __init__(self, load, capacity=65536, callback=None):
+        self.load = load
+        self.capacity = capacity
+        self.callback = callback
+        
+        # Ring buffer storage, one column per quantity
+        self.t = np.zeros(capacity, dtype=np.float64)          # time.monotonic() the load took the reading (load.sample_t)
+        self.voltage = np.zeros(capacity, dtype=np.float64)    # Volts
+        self.current = np.zeros(capacity, dtype=np.float64)    # Amps
+        self.power = np.zeros(capacity, dtype=np.float64)      # Watts
+        
+        self.count = 0          # Total samples acquired since start, ring index is count % capacity
+        self.errors = 0         # Malformed or checksum failed responses dropped
+        self.error = None       # Exception that stopped the reader thread
+        self.cond = threading.Condition()
+        self.running = False
+        self.thread = None
+        
+    def start(self):
+        """Start the reader thread.  Returns self so it can be chained."""
+        if not self.running:
+            self.running = True
+            self.error = None
+            self.thread = threading.Thread(target=self.run, name='BkLoadStream', daemon=True)
+            self.thread.start()
+        return self
+        
+    def stop(self):
+        """Stop the reader thread and wait for the in-flight transaction to finish."""
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        with self.cond:
+            self.cond.notify_all()
+            
+    def __enter__(self):
+        return self.start()
+        
+    def __exit__(self, *exc):
+        self.stop()
+        
+    def run(self):
+        load = self.load
+        try:
+            while self.running:
+                counts = load.read_present_counts()
+                if counts is None:
+                    self.errors += 1
+                    continue
+                t = load.sample_t   # When the load took the reading, not when the response ended
+                voltage, current, power = counts[0] / 1000.0, counts[1] / 10000.0, counts[2] / 1000.0
+                
+                # Written and published together, readers never see a half written slot
+                with self.cond:
+                    i = self.count % self.capacity
+                    self.t[i] = t
+                    self.voltage[i] = voltage
+                    self.current[i] = current
+                    self.power[i] = power
+                    self.count += 1
+                    self.cond.notify_all()
+                    
+                if self.callback is not None:
+                    self.callback(t, voltage, current, power)
+        except Exception as e:
+            self.error = e
+        finally:
+            with self.cond:
+                self.running = False
+                self.cond.notify_all()
+                
+    def sample(self, n):
+        """Returns sample number n as (t, voltage, current, power), IndexError once the ring has overwritten it."""
+        with self.cond:
+            return self.read_slot(n)
+            
+    def read_slot(self, n):
+        # Caller holds cond
+        if not max(0, self.count - self.capacity) <= n < self.count:
+            raise IndexError('SAMPLE %d NOT IN THE RING' % n)
+        i = n % self.capacity
+        return (float(self.t[i]), float(self.voltage[i]), float(self.current[i]), float(self.power[i]))
+        
+    def latest(self):
+        """Returns the most recent sample as (t, voltage, current, power), or None before the first sample."""
+        with self.cond:
+            if self.count == 0:
+                return None
+            return self.read_slot(self.count - 1)
+        
+    def snapshot(self, n=None):
+        """Returns copies of the last n samples (default all buffered) as a dict of arrays in time order."""
+        with self.cond:
+            count = self.count
+            available = min(count, self.capacity)
+            n = available if n is None else min(n, available)
+            idx = np.arange(count - n, count) % self.capacity
+            return {'t': self.t[idx], 'voltage': self.voltage[idx], 'current': self.current[idx], 'power': self.power[idx]}
+        
+    def __iter__(self):
+        """Yield samples as they arrive until the stream is stopped.
+        If the consumer falls more than a full ring behind it skips ahead to the oldest sample still held.
+        Re-raises the exception that stopped the reader thread, if any, after the last sample."""
+        n = self.count
+        while True:
+            with self.cond:
+                while n >= self.count and self.running:
+                    self.cond.wait(0.5)
+                if n >= self.count:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                n = max(n, self.count - self.capacity)
+                sample = self.read_slot(n)
+            yield sample
+            n += 1
@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""Instrument broker, keeps the instrument ports open and serves many client scripts.
+
+    python broker.py --supply COM9 --load /dev/ttyUSB0 --tc0521 auto
+
+Each instrument is opened once (the 9129B with a warm attach) and gets a worker thread with
+its own request queue, so calls from any number of clients are serialized per port while
+different ports run in parallel.  Clients talk to the broker over a Unix socket:
+
+    client = BrokerClient()
+    load = client.instrument('load')
+    load.set_current_setpoint(1.5)
+    print(load.get_present_values())
+
+Every message is a 4 byte little-endian length followed by a 5 byte header (request id, code)
+and a marshal encoded body.  Requests carry (instrument, method, args, kwargs), responses the
+return value or an error string.  Named tuples such as Tc0521Reading travel as tagged tuples
+and are rebuilt on the client.
+
+marshal is not secure against malformed or malicious data, only local processes of the same
+user must be able to reach the broker.  The socket is created owner only (under a 0o077
+umask), a malformed message just drops the connection.  A broker refuses to start over the
+socket of one that is still answering."""
+
+import argparse
+import marshal
+import os
+import queue
+import socket
+import struct
+import sys
+import threading
+
+from bkinsts import ChannelMeasurements
+from tc0521 import Tc0521Reading
+
+SOCKET_PATH = os.path.join(os.environ.get('XDG_RUNTIME_DIR', '/tmp'), 'automated-testing-broker.sock')
+
+LENGTH = struct.Struct('<I')
+HEADER = struct.Struct('<IB')   # Request id, code
+MAX_MESSAGE = 1 << 20
+
+# Request codes
+CALL = 0x01
+LIST = 0x02
+# Response codes
+OK = 0x00
+ERROR = 0x01
+
+# Methods clients may not call, the broker owns the connections.  recall is experimental as
+# well (Tc0521.recall, the record format is unverified) and stays blocked until it is checked.
+BLOCKED_METHODS = ('open', 'close', 'detach', 'stream', 'batch', 'identify', 'recall')
+
+# Named tuples sent as (NAMEDTUPLE, type name, values) and rebuilt by the client
+NAMEDTUPLE = b'\x00namedtuple'
+NAMEDTUPLE_TYPES = {'Tc0521Reading': Tc0521Reading, 'ChannelMeasurements': ChannelMeasurements}
+
+def encode_value(value):
+    if isinstance(value, tuple) and hasattr(value, '_fields'):
+        return (NAMEDTUPLE, type(value).__name__, tuple(encode_value(item) for item in value))
+    if isinstance(value, (tuple, list)):
+        return type(value)(encode_value(item) for item in value)
+    if isinstance(value, dict):
+        return dict((key, encode_value(item)) for key, item in value.items())
+    return value
+
+def decode_value(value):
+    if isinstance(value, tuple) and len(value) == 3 and value[0] == NAMEDTUPLE:
+        values = tuple(decode_value(item) for item in value[2])
+        cls = NAMEDTUPLE_TYPES.get(value[1])
+        return cls(*values) if cls is not None else values
+    if isinstance(value, (tuple, list)):
+        return type(value)(decode_value(item) for item in value)
+    if isinstance(value, dict):
+        return dict((key, decode_value(item)) for key, item in value.items())
+    return value
+
+def recv_exactly(sock, n):
+    data = bytearray()
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise EOFError('BROKER CONNECTION CLOSED')
+        data += chunk
+    return bytes(data)
+
+def send_message(sock, request_id, code, body):
+    payload = marshal.dumps(body)
+    sock.sendall(LENGTH.pack(HEADER.size + len(payload)) + HEADER.pack(request_id, code) + payload)
+
+def recv_message(sock):
+    length = LENGTH.unpack(recv_exactly(sock, LENGTH.size))[0]
+    if not HEADER.size <= length <= MAX_MESSAGE:
+        raise ValueError('BAD BROKER MESSAGE LENGTH %d' % length)
+    message = recv_exactly(sock, length)
+    request_id, code = HEADER.unpack_from(message)
+    try:
+        body = marshal.loads(message[HEADER.size:])
+    except (EOFError, TypeError, ValueError):
+        raise ValueError('BAD BROKER MESSAGE BODY')
+    return request_id, code, body
+
+def remove_stale_socket(socket_path):
+    # A socket file left by a server that died is removed, one that still answers is not ours
+    if not os.path.exists(socket_path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+    except OSError:
+        os.unlink(socket_path)
+    else:
+        raise RuntimeError('ALREADY SERVING ON ' + socket_path)
+    finally:
+        probe.close()
+
+def bind_socket(socket_path):
+    """Returns a Unix socket bound to socket_path, refuses to replace a socket that still answers."""
+    remove_stale_socket(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Created owner only, there is no window in which another user can connect
+    umask = os.umask(0o077)
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(umask)
+    return server
+
+def is_call_body(body):
+    # (instrument name, method name, args, kwargs) as sent by BrokerClient.call
+    return (isinstance(body, (tuple, list)) and len(body) == 4 and isinstance(body[0], str) and isinstance(body[1], str)
+            and isinstance(body[2], (tuple, list)) and isinstance(body[3], dict) and all(isinstance(key, str) for key in body[3]))
+
+class PortWorker(object):
+    """Runs every call for one instrument on a dedicated thread, in the order they were queued."""
+    
+    def __init__(self, name, instrument):
+        self.name = name
+        self.instrument = instrument
+        self.queue = queue.Queue()
+        self.calls = 0
+        self.thread = threading.Thread(target=self.run, name='PortWorker-' + name, daemon=True)
+        self.thread.start()
+    
+    def submit(self, method, args, kwargs, reply):
+        # reply(code, body) is called from the worker thread
+        self.queue.put((method, args, kwargs, reply))
+    
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            method, args, kwargs, reply = item
+            self.calls += 1
+            try:
+                if method.startswith('_') or method in BLOCKED_METHODS:
+                    raise AttributeError('METHOD NOT AVAILABLE THROUGH THE BROKER: ' + method)
+                result = getattr(self.instrument, method)(*args, **kwargs)
+                reply(OK, encode_value(result))
+            except Exception as e:
+                reply(ERROR, '%s: %s' % (type(e).__name__, e))
+    
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+class InstrumentBroker(object):
+    """    Serves the instruments in a {name: driver} dict on a Unix socket.
+    A client may pipeline requests, responses carry the request id and come back in the order
+    each port finishes them."""
+    
+    def __init__(self, instruments, socket_path=SOCKET_PATH):
+        self.instruments = instruments
+        self.socket_path = socket_path
+        self.workers = dict((name, PortWorker(name, instrument)) for name, instrument in instruments.items())
+        self.running = False
+        self.server = None
+    
+    def serve_forever(self):
+        self.server = bind_socket(self.socket_path)
+        self.server.listen(64)
+        self.running = True
+        try:
+            while self.running:
+                try:
+                    conn, address = self.server.accept()
+                except OSError:
+                    break   # Socket closed by shutdown()
+                threading.Thread(target=self.handle, args=(conn,), name='BrokerClient', daemon=True).start()
+        finally:
+            self.shutdown()
+    
+    def handle(self, conn):
+        write_lock = threading.Lock()
+        
+        def reply_to(request_id):
+            def reply(code, body):
+                with write_lock:
+                    try:
+                        send_message(conn, request_id, code, body)
+                    except OSError:
+                        pass    # Client went away
+            return reply
+        
+        try:
+            while True:
+                request_id, code, body = recv_message(conn)
+                reply = reply_to(request_id)
+                if code == LIST:
+                    reply(OK, dict((name, type(instrument).__name__) for name, instrument in self.instruments.items()))
+                elif code == CALL:
+                    if not is_call_body(body):
+                        reply(ERROR, 'BAD CALL REQUEST ' + repr(body)[:80])
+                        continue
+                    name, method, args, kwargs = body
+                    worker = self.workers.get(name)
+                    if worker is None:
+                        reply(ERROR, 'UNKNOWN INSTRUMENT ' + str(name))
+                    else:
+                        worker.submit(method, tuple(decode_value(args)), decode_value(kwargs), reply)
+                else:
+                    reply(ERROR, 'UNKNOWN REQUEST CODE %d' % code)
+        except (EOFError, OSError, ValueError):
+            pass
+        finally:
+            conn.close()
+    
+    def shutdown(self):
+        self.running = False
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+        for worker in self.workers.values():
+            worker.stop()
+        self.workers = {}
+
+class BrokerInstrument(object):
+    """Client side proxy, method calls are forwarded to the named instrument on the broker."""
+    
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+    
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        return lambda *args, **kwargs: self.client.call(self.name, method, *args, **kwargs)
+
+class BrokerClient(object):
+    """Connection to an InstrumentBroker, safe to share between threads (calls are serialized)."""
+    
+    def __init__(self, socket_path=SOCKET_PATH):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self.lock = threading.Lock()
+        self.next_id = 0
+    
+    def request(self, code, body):
+        with self.lock:
+            self.next_id = (self.next_id + 1) & 0xFFFFFFFF
+            send_message(self.sock, self.next_id, code, body)
+            request_id, status, result = recv_message(self.sock)
+        if status != OK:
+            raise RuntimeError(result)
+        return decode_value(result)
+    
+    def call(self, instrument, method, *args, **kwargs):
+        return self.request(CALL, (instrument, method, encode_value(args), encode_value(kwargs)))
+    
+    def instruments(self):
+        """Returns {name: driver class name} for the instruments the broker serves."""
+        return self.request(LIST, None)
+    
+    def instrument(self, name):
+        return BrokerInstrument(self, name)
+    
+    def close(self):
+        self.sock.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+
+def open_instruments(args):
+    # Drivers are imported here so the broker only loads the backends it needs
+    instruments = {}
+    if args.sim:
+        import instsim
+        from bkinsts import BkTrippleSupply_9129B, BkDcLoad_8500
+        from tc0521 import Tc0521
+        instruments['supply'] = BkTrippleSupply_9129B('SIM', rm=instsim.SimResourceManager())
+        instruments['load'] = BkDcLoad_8500(port=instsim.Sim8500Serial())
+        instruments['tc0521'] = Tc0521(port=instsim.SimTc0521Serial())
+        return instruments
+    if args.supply:
+        from bkinsts import BkTrippleSupply_9129B
+        instruments['supply'] = BkTrippleSupply_9129B(args.supply, attach=True)
+    if args.load:
+        from bkinsts import BkDcLoad_8500
+        instruments['load'] = BkDcLoad_8500(None if args.load == 'auto' else args.load)
+    if args.tc0521:
+        from tc0521 import Tc0521
+        instruments['tc0521'] = Tc0521(None if args.tc0521 == 'auto' else args.tc0521)
+    return instruments
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Hold the instrument ports open and serve client scripts over a Unix socket.')
+    parser.add_argument('--socket', default=SOCKET_PATH, help='Unix socket path (default %(default)s)')
+    parser.add_argument('--supply', help='9129B VISA resource name')
+    parser.add_argument('--load', help="8500 serial port, or 'auto' to discover it")
+    parser.add_argument('--tc0521', help="TC0521 serial port, or 'auto' to discover it")
+    parser.add_argument('--sim', action='store_true', help='serve simulated instruments instead')
+    args = parser.parse_args(argv)
+    
+    instruments = open_instruments(args)
+    if not instruments:
+        parser.error('no instruments given')
+    broker = InstrumentBroker(instruments, args.socket)
+    print('Serving ' + ', '.join(sorted(instruments)) + ' on ' + args.socket)
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
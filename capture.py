@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""Append-only, memory-mapped columnar capture files for measurement streams.
+
+A capture is a directory holding one raw little-endian file per column, a row counter and a
+meta.json describing the columns.  Column files grow a chunk of rows at a time and are written
+through memory maps, so appending never rewrites data and a reader sees rows as soon as the
+row counter covers them.  The timestamp column is kept in append order, range queries are a
+binary search on it and return NumPy views straight onto the mapped files:
+
+    with CaptureWriter('soak/load1', LOAD_COLUMNS) as capture:
+        while soaking:
+            capture.append(load.get_present_values())
+
+    capture = CaptureReader('soak/load1')
+    window = capture.range(start, start + 3600.0)
+    window['current'].mean()
+
+Timestamps are time.monotonic() like the drivers' sample_t, so captured rows line up with
+streams and timebase.align().  meta.json records the clock and the wall time of monotonic
+zero, CaptureReader.wall_time() turns stamps into time.time() values.  Every writer session
+is recorded in meta.json too, with its boot id and wall offset.  A session after a reboot,
+when monotonic() has started again from zero, stores its stamps shifted onto the timeline of
+the first session, so the t column stays in order and one offset gives every row's wall time.
+Captures written before the clock was recorded used time.time() and are read as such."""
+
+import json
+import math
+import os
+import time
+
+import numpy as np
+
+# Column layouts for the driver readings, the 't' timestamp column is added by the writer
+LOAD_COLUMNS = [('voltage', '<f8'), ('current', '<f8'), ('power', '<f8')]     # BkDcLoad_8500.get_present_values()
+SUPPLY_COLUMNS = [('channel', '<u1'), ('voltage', '<f8'), ('current', '<f8')]  # BkTrippleSupply_9129B readbacks, NaN if not read
+TC0521_COLUMNS = ([(name, '<f8') for name in ('t1', 't2', 't3', 't4', 't1t2')] +   # Tc0521.get_status() / Tc0521Reading
+                  [(name, '<u1') for name in ('overtemp', 'undertemp', 't1_ol', 't2_ol', 't3_ol', 't4_ol',
+                                              't1_unplug', 't2_unplug', 't3_unplug', 't4_unplug', 'checksum_ok')])
+
+TIME_COLUMN = ('t', '<f8')
+CLOCKS = {'monotonic': time.monotonic, 'time': time.time}
+META_FILE = 'meta.json'
+ROWS_FILE = 'rows'
+VERSION = 1
+BOOT_ID_PATH = '/proc/sys/kernel/random/boot_id'
+REBOOT_OFFSET = 1.0     # Seconds the wall offset has to move to be taken for a reboot where there is no boot id
+
+def boot_id():
+    """Identity of the running boot, None where the system does not provide one."""
+    try:
+        with open(BOOT_ID_PATH) as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+def new_session(meta, rows):
+    """Record a writer session starting at row rows in meta, returns its shift: the seconds added
+    to this session's monotonic stamps to put them on the capture's timeline."""
+    sessions = meta.setdefault('sessions', [])
+    if rows and not sessions:
+        # Written before sessions were recorded, on a boot that is not known
+        sessions.append({'row': 0, 'boot_id': None, 'wall_offset': meta['wall_offset'], 'shift': 0.0})
+    boot, wall_offset = boot_id(), time.time() - time.monotonic()
+    shift = 0.0
+    if sessions:
+        last = sessions[-1]
+        if boot is not None and last['boot_id'] is not None:
+            rebooted = boot != last['boot_id']
+        else:
+            rebooted = abs(wall_offset - last['wall_offset']) > REBOOT_OFFSET
+        shift = wall_offset - meta['wall_offset'] if rebooted else last['shift']
+    sessions.append({'row': rows, 'boot_id': boot, 'wall_offset': wall_offset, 'shift': shift})
+    return shift
+
+def column_path(path, name):
+    return os.path.join(path, name + '.col')
+
+class CaptureWriter(object):
+    """    Appends rows to a capture directory, creating it or continuing an existing capture.
+    Rows are dicts or namedtuples (e.g. Tc0521Reading) keyed by column name, anything else in
+    them is ignored.  A missing or None value is stored as NaN in float columns and 0 otherwise.
+    Timestamps default to the capture's clock (time.monotonic() for new captures) and must not
+    go backwards.  They are taken on this boot's clock, shift is added to store them on the
+    capture's timeline (zero unless the capture was started before a reboot)."""
+    
+    def __init__(self, path, columns, chunk_rows=65536):
+        self.path = path
+        self.chunk_rows = chunk_rows
+        os.makedirs(path, exist_ok=True)
+        meta_path = os.path.join(path, META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if [tuple(column) for column in meta['columns']] != [TIME_COLUMN] + [tuple(column) for column in columns]:
+                raise ValueError('CAPTURE COLUMNS DO NOT MATCH ' + path)
+        else:
+            meta = {'version': VERSION, 'columns': [TIME_COLUMN] + list(columns), 'clock': 'monotonic',
+                    'wall_offset': time.time() - time.monotonic()}
+        self.clock = CLOCKS[meta.get('clock', 'time')]
+        self.columns = [(name, np.dtype(dtype)) for name, dtype in meta['columns']]
+        self.fill = dict((name, np.nan if dtype.kind == 'f' else 0) for name, dtype in self.columns)
+        
+        rows_path = os.path.join(path, ROWS_FILE)
+        if not os.path.exists(rows_path):
+            with open(rows_path, 'wb') as f:
+                f.write(bytes(8))
+        self.rows_map = np.memmap(rows_path, dtype='<i8', mode='r+', shape=(1,))
+        self.rows = int(self.rows_map[0])
+        self.shift = 0.0
+        if meta.get('clock') == 'monotonic':
+            self.shift = new_session(meta, self.rows)
+        tmp_path = meta_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, meta_path)
+        self.capacity = 0
+        self.maps = {}
+        self.last_t = -math.inf
+        self.grow(self.rows)
+        if self.rows:
+            self.last_t = float(self.maps['t'][self.rows - 1])
+    
+    def grow(self, rows):
+        # Extend every column file to hold at least rows, a whole chunk at a time, and remap
+        capacity = max(self.chunk_rows, -(-rows // self.chunk_rows) * self.chunk_rows)
+        if capacity <= self.capacity:
+            return
+        self.flush()
+        for name, dtype in self.columns:
+            with open(column_path(self.path, name), 'ab') as f:
+                f.truncate(capacity * dtype.itemsize)
+            self.maps[name] = np.memmap(column_path(self.path, name), dtype=dtype, mode='r+', shape=(capacity,))
+        self.capacity = capacity
+    
+    def value(self, row, name):
+        value = row.get(name) if isinstance(row, dict) else getattr(row, name, None)
+        return self.fill[name] if value is None else value
+    
+    def append(self, row, t=None):
+        """Append one reading, returns its row number."""
+        if t is None:
+            t = self.clock()
+        t += self.shift
+        if t < self.last_t:
+            raise ValueError('CAPTURE TIMESTAMPS MUST NOT GO BACKWARDS')
+        index = self.rows
+        if index >= self.capacity:
+            self.grow(index + 1)
+        self.maps['t'][index] = t
+        for name, dtype in self.columns[1:]:
+            self.maps[name][index] = self.value(row, name)
+        # The row counter is written last, readers never see a partly written row
+        self.rows = self.rows_map[0] = index + 1
+        self.last_t = t
+        return index
+    
+    def extend(self, t, **columns):
+        """Append a block of rows from arrays, e.g. a BkLoadStream snapshot.  Missing columns are filled."""
+        t = np.asarray(t, dtype=np.float64) + self.shift
+        if not len(t):
+            return
+        if t[0] < self.last_t or np.any(np.diff(t) < 0):
+            raise ValueError('CAPTURE TIMESTAMPS MUST NOT GO BACKWARDS')
+        start, stop = self.rows, self.rows + len(t)
+        self.grow(stop)
+        self.maps['t'][start:stop] = t
+        for name, dtype in self.columns[1:]:
+            self.maps[name][start:stop] = columns.get(name, self.fill[name])
+        self.rows = self.rows_map[0] = stop
+        self.last_t = float(t[-1])
+    
+    def flush(self):
+        for column in self.maps.values():
+            column.flush()
+        self.rows_map.flush()
+    
+    def close(self):
+        """Flush and trim the column files to the rows written."""
+        self.flush()
+        self.maps = {}
+        for name, dtype in self.columns:
+            with open(column_path(self.path, name), 'r+b') as f:
+                f.truncate(self.rows * dtype.itemsize)
+        self.capacity = 0
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+
+class CaptureReader(object):
+    """    Read-only view of a capture directory.  Columns are NumPy arrays mapped onto the files,
+    slicing them or calling range() copies nothing.  refresh() picks up rows appended since
+    the reader was opened (or last refreshed) by a writer in another process."""
+    
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        self.column_types = [(name, np.dtype(dtype)) for name, dtype in meta['columns']]
+        self.names = [name for name, dtype in self.column_types]
+        self.clock = meta.get('clock', 'time')     # Clock of the t column
+        self.wall_offset = meta.get('wall_offset', 0.0)  # time.time() - t when the capture was created
+        self.sessions = meta.get('sessions', [])    # Writer sessions: first row, boot_id, wall_offset and shift
+        self.rows = 0
+        self.columns = {}
+        self.refresh()
+    
+    def refresh(self):
+        """Remap the column files to cover every complete row, returns the row count."""
+        rows = int(np.fromfile(os.path.join(self.path, ROWS_FILE), dtype='<i8', count=1)[0])
+        if rows != self.rows or not self.columns:
+            for name, dtype in self.column_types:
+                if rows:
+                    self.columns[name] = np.memmap(column_path(self.path, name), dtype=dtype, mode='r', shape=(rows,))
+                else:
+                    self.columns[name] = np.zeros(0, dtype=dtype)
+            self.rows = rows
+        return rows
+    
+    def __len__(self):
+        return self.rows
+    
+    def __getitem__(self, name):
+        return self.columns[name]
+    
+    def wall_time(self, t):
+        """Capture timestamps as time.time() values.  Stamps written after a reboot were shifted onto
+        the first session's timeline, so one offset serves every row."""
+        return np.asarray(t, dtype=np.float64) + self.wall_offset
+    
+    def index(self, t):
+        """Row number of the first reading at or after t."""
+        return int(np.searchsorted(self.columns['t'], t, side='left'))
+    
+    def range(self, start=None, stop=None):
+        """Readings with start <= t < stop as a dict of column views, either bound may be None."""
+        first = 0 if start is None else self.index(start)
+        last = self.rows if stop is None else self.index(stop)
+        return dict((name, column[first:last]) for name, column in self.columns.items())
+    
+    def records(self, start=None, stop=None):
+        """Readings in a time range as a NumPy structured array (this one is a copy)."""
+        window = self.range(start, stop)
+        records = np.empty(len(window['t']), dtype=self.column_types)
+        for name in self.names:
+            records[name] = window[name]
+        return records
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""Closed-loop control of the 8500 load and 9129B supply at a fixed, measured loop rate.
+
+    law = ConstantPowerDischarge(power=20.0, cutoff_voltage=10.5)
+    loop = ControlLoop(load, law, rate=10.0)
+    loop.run()
+    print(law.result(), loop.stats.summary())
+
+Every iteration reads the load's present values once and makes at most one write.  A load
+setpoint is sent in the same write as the next iteration's read (write_read_counts), so a
+load law costs one round trip per iteration.  A supply law writes the channel voltage right
+after the read.  Iterations start on a fixed schedule.  The loop sleeps until just before each
+deadline and spins for the rest, so the period does not drift with the work done.  When an
+iteration overruns, the loop skips ahead rather than bursting.  LoopStats keeps the achieved
+rate and the period jitter.
+
+Laws:
+    ConstantPowerDischarge  CC setpoint = P / V until the cutoff, integrates Ah and Wh
+    SourceRegulation        supply channel voltage trimmed so the load sees the target voltage
+    LoadLine                CC setpoint follows an I(V) curve, emulates a non-linear load"""
+
+import math
+import threading
+import time
+
+import numpy as np
+
+from bkinsts import own_sample_t
+
+class LoopStats(object):
+    """Running loop period statistics, nothing is stored per iteration."""
+    
+    def __init__(self, period):
+        self.period = period
+        self.iterations = 0
+        self.mean = 0.0         # Mean period
+        self.m2 = 0.0           # Sum of squared period deviations (Welford)
+        self.worst = 0.0        # Largest |period - nominal|
+        self.busy_max = 0.0     # Longest time spent working in one iteration
+        self.busy_total = 0.0
+        self.overruns = 0       # Iterations whose work ran past the next deadline
+        self.read_failures = 0  # Malformed present value responses
+        self.writes = 0
+        self.write_failures = 0 # Settings the load did not acknowledge
+    
+    def record(self, period, busy):
+        self.iterations += 1
+        delta = period - self.mean
+        self.mean += delta / self.iterations
+        self.m2 += delta * (period - self.mean)
+        self.worst = max(self.worst, abs(period - self.period))
+        self.busy_max = max(self.busy_max, busy)
+        self.busy_total += busy
+    
+    def summary(self):
+        n = self.iterations
+        return {
+            'iterations': n,
+            'rate_hz': 1.0 / self.mean if self.mean else None,
+            'period_s': self.mean,
+            'jitter_rms_s': math.sqrt(self.m2 / n) if n else None,
+            'jitter_max_s': self.worst,
+            'busy_max_s': self.busy_max,
+            'utilization': self.busy_total / (self.mean * n) if n and self.mean else None,
+            'overruns': self.overruns,
+            'read_failures': self.read_failures,
+            'writes': self.writes,
+            'write_failures': self.write_failures,
+        }
+
+class ControlLaw(object):
+    """    Base class for control laws.  actuator is 'load' (update() returns the load setting sent
+    with the opcode in setting, e.g. 'cmd_set_cc_mode_current') or 'supply' (update() returns
+    the voltage for channel).  Returning None, or a value within resolution of the last one
+    written, skips the write.  Set done to end the loop.  start() is called at the top of every
+    run, so one law can be run again."""
+    
+    actuator = 'load'
+    setting = 'cmd_set_cc_mode_current'
+    channel = 1
+    resolution = 0.0001
+    done = False
+    
+    def start(self):
+        self.done = False
+    
+    def setup(self, load, supply):
+        pass
+    
+    def update(self, t, voltage, current, power):
+        return None
+    
+    def finish(self, load, supply):
+        pass
+    
+    def result(self):
+        return {}
+
+class ConstantPowerDischarge(ControlLaw):
+    """    Discharges a battery at constant power in CC mode, the current setpoint is recomputed
+    from the measured voltage every iteration.  power is watts, or a function of the seconds
+    since the start for a power profile.  The load's UVLO is set uvlo_margin volts below the
+    cutoff as a hardware backstop, so the law's own cutoff acts first.  Should the load still stop
+    drawing (UVLO or otherwise), zero_reads readings in a row of no current while a current is set
+    end the run.  Capacity and energy are integrated (trapezoidal) from the measured current and
+    power on the measured timestamps."""
+    
+    def __init__(self, power, cutoff_voltage, max_current=None, uvlo_margin=0.1, zero_reads=3):
+        self.power = power
+        self.cutoff_voltage = cutoff_voltage
+        self.max_current = max_current
+        self.uvlo_margin = uvlo_margin
+        self.zero_reads = zero_reads
+        self.start()
+    
+    def start(self):
+        self.done = False
+        self.start_t = None
+        self.last = None            # (t, current, power) of the previous reading
+        self.setpoint = 0.0         # Last current setpoint returned
+        self.zeros = 0              # Readings in a row with no current while a current is set
+        self.capacity_ah = 0.0
+        self.energy_wh = 0.0
+        self.end_voltage = None
+        self.end_reason = None      # 'cutoff' or 'no current' once done
+    
+    def setup(self, load, supply):
+        load.set_mode('CC')
+        load.set_current_setpoint(0.0)
+        load.set_uvlo_setpoint(max(self.cutoff_voltage - self.uvlo_margin, 0.0))
+        load.enable_load()
+    
+    def update(self, t, voltage, current, power):
+        if self.start_t is None:
+            self.start_t = t
+        if self.last is not None:
+            last_t, last_current, last_power = self.last
+            hours = (t - last_t) / 3600.0
+            self.capacity_ah += (current + last_current) * 0.5 * hours
+            self.energy_wh += (power + last_power) * 0.5 * hours
+        self.last = (t, current, power)
+        self.end_voltage = voltage
+        self.zeros = self.zeros + 1 if self.setpoint > 0.0 and current <= 0.0 else 0
+        if voltage <= self.cutoff_voltage or self.zeros >= self.zero_reads:
+            self.done = True
+            self.end_reason = 'cutoff' if voltage <= self.cutoff_voltage else 'no current'
+            self.setpoint = 0.0
+            return 0.0
+        target = self.power(t - self.start_t) if callable(self.power) else self.power
+        setpoint = target / voltage
+        if self.max_current is not None:
+            setpoint = min(setpoint, self.max_current)
+        self.setpoint = setpoint
+        return setpoint
+    
+    def finish(self, load, supply):
+        load.disable_load()
+    
+    def result(self):
+        return {'capacity_ah': self.capacity_ah, 'energy_wh': self.energy_wh, 'end_voltage': self.end_voltage,
+                'end_reason': self.end_reason, 'duration_s': None if self.last is None else self.last[0] - self.start_t}
+
+class SourceRegulation(ControlLaw):
+    """    Trims a supply channel so the voltage measured at the load holds target_voltage, making up
+    for the cable and connector drop.  Integral control, gain is the fraction of the error
+    corrected per iteration.  The channel voltage stays within 0 and max_voltage."""
+    
+    actuator = 'supply'
+    resolution = 0.001
+    
+    def __init__(self, target_voltage, channel=1, gain=0.5, max_voltage=None):
+        self.target_voltage = target_voltage
+        self.channel = channel
+        self.gain = gain
+        self.max_voltage = target_voltage * 1.2 if max_voltage is None else max_voltage
+        self.start()
+    
+    def start(self):
+        self.done = False
+        self.voltage = self.target_voltage      # Channel voltage
+        self.errors = 0
+        self.error_sq = 0.0
+        self.error_max = 0.0
+    
+    def setup(self, load, supply):
+        supply.set_voltage_ch(self.channel, self.voltage)
+        supply.enable_output_ch(self.channel)
+    
+    def update(self, t, voltage, current, power):
+        error = self.target_voltage - voltage
+        self.errors += 1
+        self.error_sq += error * error
+        self.error_max = max(self.error_max, abs(error))
+        self.voltage = min(max(self.voltage + self.gain * error, 0.0), self.max_voltage)
+        return self.voltage
+    
+    def result(self):
+        return {'channel_voltage': self.voltage, 'error_max_v': self.error_max,
+                'error_rms_v': math.sqrt(self.error_sq / self.errors) if self.errors else None}
+
+class LoadLine(ControlLaw):
+    """    Draws the current given by an I(V) curve at the measured voltage, linearly interpolated
+    between the (voltages, currents) points and held at the end values outside them."""
+    
+    def __init__(self, voltages, currents):
+        self.voltages = np.asarray(voltages, dtype=np.float64)
+        self.currents = np.asarray(currents, dtype=np.float64)
+        if len(self.voltages) != len(self.currents) or np.any(np.diff(self.voltages) <= 0):
+            raise ValueError('LOAD LINE VOLTAGES MUST INCREASE AND MATCH THE CURRENTS')
+    
+    def setup(self, load, supply):
+        load.set_mode('CC')
+        load.set_current_setpoint(float(self.currents[0]))
+        load.enable_load()
+    
+    def update(self, t, voltage, current, power):
+        return float(np.interp(voltage, self.voltages, self.currents))
+    
+    def finish(self, load, supply):
+        load.disable_load()
+
+class ControlLoop(object):
+    """    Runs a ControlLaw against the load (and supply for supply laws) at rate iterations a second.
+    spin is how long before each deadline the loop stops sleeping and busy waits.
+    callback(t, voltage, current, power, value) is called every iteration with the reading and
+    the law's output, keep it short, it runs inside the loop."""
+    
+    def __init__(self, load, law, rate=10.0, supply=None, spin=0.001, callback=None):
+        if law.actuator == 'supply' and supply is None:
+            raise ValueError('SUPPLY LAW NEEDS A SUPPLY')
+        self.load = load
+        self.law = law
+        self.supply = supply
+        self.period = 1.0 / rate
+        self.spin = spin
+        self.callback = callback
+        self.stats = LoopStats(self.period)
+        self.stopping = threading.Event()
+    
+    def stop(self):
+        """Ends run() after the current iteration, safe from any thread."""
+        self.stopping.set()
+    
+    def run(self, duration=None):
+        """Run until the law is done, duration seconds have passed or stop() is called.
+        Returns the law's result()."""
+        law, load = self.law, self.load
+        setting = getattr(load, law.setting) if law.actuator == 'load' else None
+        monotonic = time.monotonic
+        self.stopping.clear()
+        law.start()
+        law.setup(load, self.supply)
+        try:
+            pending = None          # Load setting to send with the next read
+            written = None
+            start = deadline = monotonic()
+            last_start = None
+            last_busy = None
+            while not law.done and not self.stopping.is_set():
+                started = monotonic()
+                if duration is not None and started - start >= duration:
+                    break
+                if pending is not None:
+                    counts, accepted = load.write_read_counts(setting, pending)
+                    self.stats.writes += 1
+                    if not accepted:
+                        self.stats.write_failures += 1
+                        written = None      # Send it again
+                    pending = None
+                else:
+                    counts = load.read_present_counts()
+                t = own_sample_t(load)      # When the load took the reading, not when it arrived
+                if t is None:
+                    t = monotonic()
+                
+                if counts is None:
+                    self.stats.read_failures += 1
+                else:
+                    voltage, current, power = counts[0] / 1000.0, counts[1] / 10000.0, counts[2] / 1000.0
+                    value = law.update(t, voltage, current, power)
+                    if value is not None and (written is None or abs(value - written) >= law.resolution):
+                        if setting is not None:
+                            pending = value
+                        else:
+                            self.supply.set_voltage_ch(law.channel, value)
+                            self.stats.writes += 1
+                        written = value
+                    if self.callback is not None:
+                        self.callback(t, voltage, current, power, value)
+                
+                now = monotonic()
+                if last_start is not None:
+                    # The period that just ended belongs to the previous iteration, so does its work
+                    self.stats.record(started - last_start, last_busy)
+                last_start = started
+                last_busy = now - started
+                deadline += self.period
+                remaining = deadline - now
+                if remaining < 0:
+                    # Fell behind, skip the missed iterations rather than bursting to catch up
+                    self.stats.overruns += 1
+                    deadline = now
+                    continue
+                if remaining > self.spin:
+                    self.stopping.wait(remaining - self.spin)
+                while monotonic() < deadline:
+                    pass
+            if pending is not None:
+                # The law's last setting (the 0 A at the cutoff) has no next read to go out with
+                self.stats.writes += 1
+                try:
+                    load.send_command(setting, pending)
+                except ValueError:
+                    self.stats.write_failures += 1
+        finally:
+            law.finish(load, self.supply)
+        return law.result()
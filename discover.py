@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""Parallel serial port discovery for the TC0521 meter and BK8500 load.
+
+Every candidate port is probed at the same time on a thread pool with a short timeout.
+Devices are identified by their model number (TC0521 command K) or manufacturer info
+(BK8500 GET_MFG_INFO) response.  USB adapters are remembered on disk by VID/PID/serial
+number, so later startups map them straight to a device type without probing.  Adapters
+that answered neither probe are remembered for UNKNOWN_TTL seconds, so a bench full of
+other serial devices is not probed again on every startup."""
+
+import json
+import os
+import time
+import concurrent.futures
+import serial.tools.list_ports as serial_ports  # From official package 'pyserial'
+import serial   # From official package 'pyserial'
+
+PROBE_TIMEOUT = 0.3     # Seconds to wait for a probe response
+UNKNOWN_TTL = 24 * 3600.0   # Seconds a port that answered no probe is left alone
+CACHE_PATH = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+                          'automated-testing', 'ports.json')
+
+def probe_tc0521(sp):
+    '''Returns 'TC0521' if the open port answers the model number query like a TC0521.'''
+    from tc0521 import Tc0521
+    sp.write(Tc0521.command_K_modelnum)
+    sp.flush()
+    if sp.read(size=len(Tc0521.response_K_modelnum)) == Tc0521.response_K_modelnum:
+        return 'TC0521'
+    return None
+
+def probe_bk8500(sp):
+    '''Returns 'BK8500' if the open port answers GET_MFG_INFO with a valid BK8500 packet.'''
+    from bkinsts import BkDcLoad_8500 as Bk
+    packet = bytearray(Bk.PACKET_LENGTH)
+    packet[0] = Bk.START_BYTE
+    packet[1] = Bk.INSTRUMENT_ADDRESS
+    packet[2] = Bk.GET_MFG_INFO
+    packet[-1] = sum(packet[:-1]) & 0xFF
+    sp.write(packet)
+    sp.flush()
+    rx = sp.read(Bk.PACKET_LENGTH)
+    if len(rx) == Bk.PACKET_LENGTH and rx[0] == Bk.START_BYTE and rx[2] == Bk.GET_MFG_INFO and (sum(rx[:-1]) & 0xFF) == rx[-1]:
+        return 'BK8500'
+    return None
+
+# Device type -> probe, each probe is tried in turn on a port until one matches.  The BK8500
+# goes first: it frames 26 byte packets, so the TC0521's one byte K would leave it one byte
+# out of step for the GET_MFG_INFO probe.  The TC0521 has no framing to upset, any answer it
+# gives to the BK8500 packet is discarded before its own probe.
+PROBES = {'BK8500': probe_bk8500, 'TC0521': probe_tc0521}
+
+def port_key(port_info):
+    '''Returns a stable identity for a USB serial adapter, or None if the port has none.'''
+    if port_info.vid is None or port_info.pid is None or not port_info.serial_number:
+        return None
+    return '%04X:%04X:%s' % (port_info.vid, port_info.pid, port_info.serial_number)
+
+def load_cache(path=CACHE_PATH):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_cache(cache, path=CACHE_PATH):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass    # A read-only home directory only costs us the next startup
+
+def unknown_ports(cache, now=None):
+    '''Port keys that answered no probe less than UNKNOWN_TTL seconds ago.'''
+    now = time.time() if now is None else now
+    return set(key for key, when in cache.get('unknown', {}).items() if now - when < UNKNOWN_TTL)
+
+def probe_port(device, device_types, timeout=PROBE_TIMEOUT):
+    '''Open a port and try the probes for device_types on it.  Returns the matching type, False
+    if every probe went unanswered, or None if the port could not be opened or probed
+    (typically already in use).'''
+    try:
+        sp = serial.Serial(port=device, timeout=timeout, write_timeout=timeout)
+    except (serial.SerialException, OSError, ValueError):
+        return None
+    try:
+        for i, device_type in enumerate(sorted(device_types, key=list(PROBES).index)):
+            if i:
+                # Let late answers to the previous probe arrive, then throw them away
+                time.sleep(timeout)
+            sp.reset_input_buffer()
+            sp.reset_output_buffer()
+            try:
+                if PROBES[device_type](sp):
+                    return device_type
+            except (serial.SerialException, OSError):
+                return None
+        return False
+    finally:
+        sp.close()
+
+def discover(device_types=None, timeout=PROBE_TIMEOUT, use_cache=True, cache_path=CACHE_PATH):
+    '''Find connected instruments.  Returns a dict of device type -> list of port device names.
+    Ports remembered in the cache, as a device or as answering nothing, are not probed, pass
+    use_cache=False to probe everything again.'''
+    device_types = list(PROBES) if device_types is None else list(device_types)
+    found = dict((device_type, []) for device_type in device_types)
+    cache = load_cache(cache_path)
+    # Expired entries are dropped, a fresh probe decides about those ports again
+    cache['unknown'] = dict((key, cache['unknown'][key]) for key in unknown_ports(cache))
+    unknown = set(cache['unknown']) if use_cache else set()
+    
+    to_probe = []
+    for port_info in serial_ports.comports():
+        key = port_key(port_info)
+        cached_type = cache.get(key) if use_cache else None
+        if cached_type in found:
+            found[cached_type].append(port_info.device)
+        elif cached_type is None and key not in unknown:
+            to_probe.append(port_info)
+    
+    if to_probe:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(to_probe)) as pool:
+            results = pool.map(lambda port_info: probe_port(port_info.device, device_types, timeout), to_probe)
+            for port_info, device_type in zip(to_probe, results):
+                key = port_key(port_info)
+                if device_type is False and key is not None and set(device_types) >= set(PROBES):
+                    # Only a port that was asked every probe is known to hold none of our devices
+                    cache.pop(key, None)
+                    cache['unknown'][key] = time.time()
+                if not device_type:
+                    continue
+                found[device_type].append(port_info.device)
+                if key is not None:
+                    cache[key] = device_type
+                    cache['unknown'].pop(key, None)
+        save_cache(cache, cache_path)
+    
+    return found
+
+def forget(device, cache_path=CACHE_PATH):
+    '''Remove a port from the cache, for when a cached mapping turns out to be stale.'''
+    cache = load_cache(cache_path)
+    for port_info in serial_ports.comports():
+        key = port_key(port_info)
+        if port_info.device == device and (key in cache or key in cache.get('unknown', {})):
+            cache.pop(key, None)
+            cache.get('unknown', {}).pop(key, None)
+            save_cache(cache, cache_path)
+
+def find_port(device_type, timeout=PROBE_TIMEOUT, use_cache=True, cache_path=CACHE_PATH):
+    '''Returns the first port with the given device type attached, or None.
+    A cached port is returned straight away without probing anything.'''
+    if use_cache:
+        cache = load_cache(cache_path)
+        for port_info in serial_ports.comports():
+            if cache.get(port_key(port_info)) == device_type:
+                return port_info.device
+    ports = discover([device_type], timeout=timeout, use_cache=use_cache, cache_path=cache_path)[device_type]
+    return ports[0] if ports else None
@@ -0,0 +1,685 @@
+#!/usr/bin/env python3
+"""Protocol accurate simulators for the BK9129B, BK8500 and TC0521.
+
+The simulators plug in below the drivers so scripts, benchmarks and regression tests can run
+on a machine with no instruments attached:
+
+    supply = BkTrippleSupply_9129B('SIM', rm=SimResourceManager())
+    load = BkDcLoad_8500(port=Sim8500Serial())
+    meter = Tc0521(port=SimTc0521Serial())
+
+Serial simulators model the wire time of every byte at the configured baud rate plus a per
+command latency, and can corrupt or drop responses to exercise error handling.  Pass
+baudrate=None to turn the wire time off."""
+
+import random
+import struct
+import threading
+import time
+
+from bkinsts import BkDcLoad_8500
+from tc0521 import Tc0521, STATUS_FRAME_LENGTH, STATUS_CHECKSUM_BYTE
+
+class SimSerial(object):
+    """    Base of the serial port simulators, a stand in for serial.Serial.
+    Bytes written are collected and handed to handle(), which returns the response bytes.
+    A response becomes readable once its command and response have crossed the wire and the
+    instrument latency has passed.
+    Error injection:
+        corrupt_rate    probability a response has one byte flipped
+        drop_rate       probability a response is never sent"""
+    
+    def __init__(self, baudrate=9600, latency=0.0, timeout=1.0, corrupt_rate=0.0, drop_rate=0.0, seed=None):
+        self.baudrate = baudrate    # None for instantaneous transfers
+        self.latency = latency      # Seconds the instrument takes to process a command
+        self.timeout = timeout      # Read timeout in seconds, like serial.Serial
+        self.corrupt_rate = corrupt_rate
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+        self.is_open = True
+        self.rx_pending = bytearray()   # Written bytes not yet handled
+        self.responses = []             # [ready_time, bytearray] in send order
+        self.lock = threading.Lock()
+        self.bytes_written = 0
+        self.commands = 0
+        self.port = 'SIM'
+    
+    def byte_time(self, n):
+        if not self.baudrate:
+            return 0.0
+        return n * 10.0 / self.baudrate     # 8N1, ten bits per byte
+    
+    # Instrument behaviour, implemented by each simulator
+    
+    def frame_length(self, pending):
+        """Returns the length of the complete command at the start of pending, or None if incomplete."""
+        raise NotImplementedError
+    
+    def handle(self, command):
+        """Returns the response bytes for one command, or None for no response."""
+        raise NotImplementedError
+    
+    # serial.Serial interface
+    
+    def write(self, data):
+        data = bytes(data)
+        now = time.monotonic()
+        with self.lock:
+            self.bytes_written += len(data)
+            self.rx_pending += data
+            arrival = now + self.byte_time(len(data))
+            while True:
+                length = self.frame_length(self.rx_pending)
+                if not length:
+                    break
+                command = bytes(self.rx_pending[:length])
+                del self.rx_pending[:length]
+                self.commands += 1
+                response = self.handle(command)
+                if response is None or self.random.random() < self.drop_rate:
+                    continue
+                response = bytearray(response)
+                if self.random.random() < self.corrupt_rate:
+                    response[self.random.randrange(len(response))] ^= 0xFF
+                # Responses queue up behind each other on the wire
+                start = arrival + self.latency
+                if self.responses:
+                    start = max(start, self.responses[-1][0])
+                self.responses.append([start + self.byte_time(len(response)), response])
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def available(self, now):
+        """Bytes readable at time now, the head of a response arrives byte by byte."""
+        count = 0
+        for ready, response in self.responses:
+            if ready <= now:
+                count += len(response)
+                continue
+            if self.baudrate:
+                in_transit = int((ready - now) / self.byte_time(1)) + 1
+                count += max(0, len(response) - in_transit)
+            break
+        return count
+    
+    @property
+    def in_waiting(self):
+        with self.lock:
+            return self.available(time.monotonic())
+    
+    def take(self, size):
+        data = bytearray()
+        limit = min(size, self.available(time.monotonic()))
+        while self.responses and len(data) < limit:
+            response = self.responses[0][1]
+            n = min(limit - len(data), len(response))
+            data += response[:n]
+            del response[:n]
+            if not response:
+                self.responses.pop(0)
+        return bytes(data)
+    
+    def read(self, size=1):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        data = bytearray()
+        while len(data) < size:
+            with self.lock:
+                data += self.take(size - len(data))
+            if len(data) >= size:
+                break
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                break
+            time.sleep(0.0005 if deadline is None else min(0.0005, deadline - now))
+        return bytes(data)
+    
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+    
+    def reset_input_buffer(self):
+        with self.lock:
+            now = time.monotonic()
+            self.take(self.available(now))
+    
+    def reset_output_buffer(self):
+        with self.lock:
+            del self.rx_pending[:]
+    
+    def open(self):
+        self.is_open = True
+    
+    def close(self):
+        self.is_open = False
+
+class Sim8500Serial(SimSerial):
+    """    BK8500 DC load simulator speaking the 26 byte packet protocol with checksums.
+    The load is modelled as a source of source_voltage volts behind source_resistance ohms,
+    the operating mode and setpoint decide the operating point while the load is on."""
+    
+    Bk = BkDcLoad_8500
+    
+    def __init__(self, address=0x00, source_voltage=12.0, source_resistance=0.05, **kwargs):
+        SimSerial.__init__(self, **kwargs)
+        self.address = address
+        self.source_voltage = source_voltage
+        self.source_resistance = source_resistance
+        self.reset()
+    
+    def reset(self):
+        self.remote = False
+        self.load_on = False
+        self.values = {     # Get opcode -> raw counts
+            self.Bk.GET_MAX_VOLTAGE_LIMIT: 120000, self.Bk.GET_MAX_CURRENT_LIMIT: 300000, self.Bk.GET_MAX_POWER_LIMIT: 300000,
+            self.Bk.GET_OP_MODE: 0x00, self.Bk.GET_CC_MODE_CURRENT: 0, self.Bk.GET_CV_MODE_VOLTAGE: 120000,
+            self.Bk.GET_CW_MODE_POWER: 0, self.Bk.GET_CR_MODE_RESISTANCE: 7500000, self.Bk.GET_UVLO_VOLTAGE: 0,
+        }
+        self.function_mode = 0x00   # FIXED
+        self.trigger_source = 0x00  # IMMEDIATE
+        self.list_mode = 0x00
+        self.list_repeat = 0x00
+        self.list_count = 2
+        self.list_steps = {}        # (list mode, step) -> (value counts, time counts)
+        self.list_name = b''
+        self.list_partition = 1
+        self.saved_lists = {}       # Slot -> saved list settings
+        self.triggered_at = None    # time.monotonic() of the trigger that started the list
+    
+    def frame_length(self, pending):
+        # Resynchronize on the start byte like the instrument does
+        while pending and pending[0] != self.Bk.START_BYTE:
+            del pending[:1]
+        return self.Bk.PACKET_LENGTH if len(pending) >= self.Bk.PACKET_LENGTH else None
+    
+    def setpoint(self):
+        """Returns the (mode, setpoint counts) in effect, following the running list in list mode."""
+        if self.function_mode == 0x03 and self.triggered_at is not None:
+            times = [self.list_steps.get((self.list_mode, step), (0, 1))[1] for step in range(1, self.list_count + 1)]
+            elapsed = int((time.monotonic() - self.triggered_at) * self.Bk.LIST_TIME_SCALE)
+            if self.list_repeat:
+                elapsed %= sum(times)
+            step = self.list_count     # The last step is held once a single pass has finished
+            for i, step_time in enumerate(times, 1):
+                if elapsed < step_time:
+                    step = i
+                    break
+                elapsed -= step_time
+            return self.list_mode, self.list_steps.get((self.list_mode, step), (0, 1))[0]
+        mode = self.values[self.Bk.GET_OP_MODE]
+        return mode, self.values[(self.Bk.GET_CC_MODE_CURRENT, self.Bk.GET_CV_MODE_VOLTAGE, self.Bk.GET_CW_MODE_POWER,
+                                  self.Bk.GET_CR_MODE_RESISTANCE)[mode]]
+    
+    def operating_point(self):
+        """Returns (voltage, current) in volts and amps."""
+        if not self.load_on:
+            return self.source_voltage, 0.0
+        v0, r0 = self.source_voltage, self.source_resistance
+        mode, counts = self.setpoint()
+        if mode == 0x00:    # CC
+            current = counts / 10000.0
+        elif mode == 0x01:  # CV
+            current = max(0.0, (v0 - counts / 1000.0) / r0)
+        elif mode == 0x02:  # CW, solve P = I * (V0 - I * R0) for the low current root
+            power = counts / 1000.0
+            disc = v0 * v0 - 4.0 * r0 * power
+            current = (v0 - disc ** 0.5) / (2.0 * r0) if disc >= 0 else v0 / (2.0 * r0)
+        else:               # CR
+            current = v0 / (r0 + max(counts / 1000.0, 0.001))
+        current = min(current, self.values[self.Bk.GET_MAX_CURRENT_LIMIT] / 10000.0)
+        voltage = v0 - current * r0
+        if voltage < self.values[self.Bk.GET_UVLO_VOLTAGE] / 1000.0:
+            return voltage, 0.0
+        return voltage, current
+    
+    def packet(self, command, payload=b''):
+        response = bytearray(self.Bk.PACKET_LENGTH)
+        response[0] = self.Bk.START_BYTE
+        response[1] = self.address
+        response[2] = command
+        response[3:3 + len(payload)] = payload
+        response[-1] = sum(response[:-1]) & 0xFF
+        return response
+    
+    def status(self, status):
+        return self.packet(self.Bk.STATUS_DATA, bytes([status]))
+    
+    def handle(self, command):
+        Bk = self.Bk
+        if command[1] != self.address:
+            return None     # Another load on the bus
+        if (sum(command[:-1]) & 0xFF) != command[-1]:
+            return self.status(Bk.STATUS_BAD_CHECKSUM)
+        
+        opcode = command[2]
+        if opcode == Bk.SET_REMOTE:
+            self.remote = bool(command[3])
+        elif opcode == Bk.SET_ON_OFF:
+            self.load_on = bool(command[3])
+        elif opcode == Bk.SET_OP_MODE:
+            if command[3] > 0x03:
+                return self.status(Bk.STATUS_BAD_PARAMETER)
+            self.values[Bk.GET_OP_MODE] = command[3]
+        elif Bk.SET_LIST_MODE <= opcode <= Bk.RECALL_LIST or Bk.SET_TRIGGER_SOURCE <= opcode <= Bk.GET_FUNCTION_MODE:
+            return self.handle_list(opcode, command)
+        elif opcode + 1 in self.values:
+            self.values[opcode + 1] = struct.unpack_from('<I', command, 3)[0]
+        elif opcode == Bk.GET_OP_MODE:
+            return self.packet(opcode, bytes([self.values[opcode]]))
+        elif opcode in self.values:
+            return self.packet(opcode, struct.pack('<I', self.values[opcode]))
+        elif opcode == Bk.GET_VALUES:
+            voltage, current = self.operating_point()
+            # Operation state register: bit 2 remote control, bit 3 input on
+            state = (0x04 if self.remote else 0x00) | (Bk.LOAD_ON_BIT if self.load_on else 0x00)
+            return self.packet(opcode, struct.pack('<IIIB', int(voltage * 1000), int(current * 10000), int(voltage * current * 1000), state))
+        elif opcode == Bk.GET_MFG_INFO:
+            return self.packet(opcode, b'8500\x00\x05\x01SIM0000001')
+        else:
+            return self.status(Bk.STATUS_UNKNOWN_COMMAND)
+        return self.status(Bk.STATUS_SUCCESS)
+    
+    def handle_list(self, opcode, command):
+        # List mode, triggering and function mode commands
+        Bk = self.Bk
+        arg = command[3]
+        if opcode == Bk.SET_LIST_MODE and arg <= 0x03:
+            self.list_mode = arg
+        elif opcode == Bk.GET_LIST_MODE:
+            return self.packet(opcode, bytes([self.list_mode]))
+        elif opcode == Bk.SET_LIST_REPEAT and arg <= 0x01:
+            self.list_repeat = arg
+        elif opcode == Bk.GET_LIST_REPEAT:
+            return self.packet(opcode, bytes([self.list_repeat]))
+        elif opcode == Bk.SET_LIST_STEP_COUNT:
+            count = struct.unpack_from('<H', command, 3)[0]
+            if not 2 <= count <= Bk.MAX_LIST_STEPS // self.list_partition:
+                return self.status(Bk.STATUS_BAD_PARAMETER)
+            self.list_count = count
+        elif opcode == Bk.GET_LIST_STEP_COUNT:
+            return self.packet(opcode, struct.pack('<H', self.list_count))
+        elif Bk.SET_LIST_STEP_CURRENT <= opcode <= Bk.GET_LIST_STEP_RESISTANCE:
+            mode = (opcode - Bk.SET_LIST_STEP_CURRENT) // 2
+            step = struct.unpack_from('<H', command, 3)[0]
+            if not 1 <= step <= self.list_count:
+                return self.status(Bk.STATUS_BAD_PARAMETER)
+            if opcode % 2:  # Get opcodes are odd
+                value, step_time = self.list_steps.get((mode, step), (0, 1))
+                return self.packet(opcode, struct.pack('<HIH', step, value, step_time))
+            self.list_steps[(mode, step)] = struct.unpack_from('<IH', command, 5)
+        elif opcode == Bk.SET_LIST_FILE_NAME:
+            self.list_name = bytes(command[3:13]).rstrip(b'\x00')
+        elif opcode == Bk.GET_LIST_FILE_NAME:
+            return self.packet(opcode, self.list_name)
+        elif opcode == Bk.SET_LIST_PARTITION and arg in (1, 2, 4, 8):
+            self.list_partition = arg
+        elif opcode == Bk.GET_LIST_PARTITION:
+            return self.packet(opcode, bytes([self.list_partition]))
+        elif opcode == Bk.SAVE_LIST and 1 <= arg <= 8:
+            self.saved_lists[arg] = (self.list_mode, self.list_repeat, self.list_count, dict(self.list_steps), self.list_name)
+        elif opcode == Bk.RECALL_LIST and arg in self.saved_lists:
+            self.list_mode, self.list_repeat, self.list_count, steps, self.list_name = self.saved_lists[arg]
+            self.list_steps = dict(steps)
+        elif opcode == Bk.SET_TRIGGER_SOURCE and arg <= 0x02:
+            self.trigger_source = arg
+        elif opcode == Bk.GET_TRIGGER_SOURCE:
+            return self.packet(opcode, bytes([self.trigger_source]))
+        elif opcode == Bk.TRIGGER:
+            if self.trigger_source != 0x02:
+                return self.status(Bk.STATUS_BAD_COMMAND)
+            self.triggered_at = time.monotonic()
+        elif opcode == Bk.SET_FUNCTION_MODE and arg <= 0x04:
+            self.function_mode = arg
+            self.triggered_at = None
+        elif opcode == Bk.GET_FUNCTION_MODE:
+            return self.packet(opcode, bytes([self.function_mode]))
+        else:
+            return self.status(Bk.STATUS_BAD_PARAMETER)
+        return self.status(Bk.STATUS_SUCCESS)
+
+class Sim8500Bus(SimSerial):
+    """    Several simulated BK8500 loads sharing one multi-drop bus, pass Sim8500Serial instances
+    with distinct addresses.  Each command is answered by the load it is addressed to."""
+    
+    def __init__(self, loads, **kwargs):
+        SimSerial.__init__(self, **kwargs)
+        self.loads = dict((load.address, load) for load in loads)
+    
+    def frame_length(self, pending):
+        while pending and pending[0] != BkDcLoad_8500.START_BYTE:
+            del pending[:1]
+        return BkDcLoad_8500.PACKET_LENGTH if len(pending) >= BkDcLoad_8500.PACKET_LENGTH else None
+    
+    def handle(self, command):
+        load = self.loads.get(command[1])
+        return None if load is None else load.handle(command)
+
+class SimTc0521Serial(SimSerial):
+    '''TC0521 thermocouple meter simulator.  Answers the model number query and produces 64 byte
+    status frames that follow the Tc0521 bitmasks.  Set temps (degrees F, None for an unplugged
+    probe) and the flag attributes to shape the frames, button commands act on the same state.
+    record() stores the present temperatures while recording, the recall command streams the
+    stored records back as status frames with the recall mode bit set.  That is the unverified
+    format Tc0521RecallReader assumes, so the sim only exercises the reader, not the format.'''
+    
+    COMMAND_LENGTH = len(Tc0521.command_A_status)
+    
+    def __init__(self, temps=(72.5, 73.0, 74.5, 75.0), **kwargs):
+        SimSerial.__init__(self, **kwargs)
+        self.temps = list(temps)    # T1-T4 in degrees F
+        self.battery = 3
+        self.units = 'F'
+        self.t1t2_mode = False
+        self.probe_type = 'K'
+        self.alarm_high = None      # Degrees F, sets overtemp when any probe is above it
+        self.recording = False
+        self.holdmode = False
+        self.maxminmode = False
+        self.memory = []            # Recorded T1-T4 readings, oldest first
+    
+    def record(self):
+        """Store the present temperatures as the meter does at each logging interval while recording."""
+        if self.recording:
+            self.memory.append(list(self.temps))
+    
+    def frame_length(self, pending):
+        while pending and pending[0] != 0x02:
+            del pending[:1]
+        return self.COMMAND_LENGTH if len(pending) >= self.COMMAND_LENGTH else None
+    
+    def encode_temp(self, temp):
+        # Tenths of a degree in both ranges, the range bit is set from 1000 up
+        if temp is None:
+            return 0, False
+        return int(round(temp * 10)) & 0xFFFF, abs(temp) >= 1000
+    
+    def status_frame(self, temps=None, recall=False):
+        temps = self.temps if temps is None else temps
+        frame = bytearray(STATUS_FRAME_LENGTH)
+        frame[0] = 0x02
+        frame[1] = self.battery
+        
+        raws = []
+        range_bits = (Tc0521.bitmask_T1range, Tc0521.bitmask_T2range, Tc0521.bitmask_T3range, Tc0521.bitmask_T4range)
+        unplug_bits = (Tc0521.bitmask_t1_unplug, Tc0521.bitmask_t2_unplug, Tc0521.bitmask_t3_unplug, Tc0521.bitmask_t4_unplug)
+        for temp, range_bit, unplug_bit in zip(temps, range_bits, unplug_bits):
+            raw, range_hi = self.encode_temp(temp)
+            raws.append(raw)
+            if range_hi:
+                frame[2] |= range_bit
+            if temp is None:
+                frame[6] |= unplug_bit
+        difference = None
+        if self.t1t2_mode and None not in temps[:2]:
+            difference = temps[0] - temps[1]
+        raw, range_hi = self.encode_temp(difference)
+        raws.append(raw)
+        if range_hi:
+            frame[2] |= Tc0521.bitmask_T1T2range
+        
+        if self.t1t2_mode:
+            frame[2] |= Tc0521.bitmask_T1T2mode
+        if recall:
+            frame[2] |= Tc0521.bitmask_recallmode
+        if self.units == 'C':
+            frame[2] |= Tc0521.bitmask_units
+        if self.alarm_high is not None:
+            frame[3] |= Tc0521.bitmask_alarm
+            if any(temp is not None and temp > self.alarm_high for temp in temps):
+                frame[3] |= Tc0521.bitmask_overtemp
+        if self.recording:
+            frame[3] |= Tc0521.bitmask_recording
+        if self.holdmode:
+            frame[3] |= Tc0521.bitmask_holdmode
+        if self.maxminmode:
+            frame[3] |= Tc0521.bitmask_maxminmode
+            frame[4] |= Tc0521.bitmask_maxminavgmode
+        frame[5] = {'K': Tc0521.bitmask_tc_k, 'J': Tc0521.bitmask_tc_j, 'E': Tc0521.bitmask_tc_e, 'T': Tc0521.bitmask_tc_t}[self.probe_type]
+        
+        struct.pack_into('>5H', frame, 9, *raws)
+        frame[STATUS_CHECKSUM_BYTE] = sum(frame[1:STATUS_CHECKSUM_BYTE]) & 0xFF
+        frame[STATUS_FRAME_LENGTH - 1] = 0x03
+        return frame
+    
+    def handle(self, command):
+        if command == Tc0521.command_A_status:
+            return self.status_frame()
+        if command == Tc0521.command_K_modelnum:
+            return Tc0521.response_K_modelnum
+        if command == Tc0521.command_P_load:
+            return b''.join(bytes(self.status_frame(temps, recall=True)) for temps in self.memory) or None
+        if command == Tc0521.command_C_units:
+            self.units = 'F' if self.units == 'C' else 'C'
+        elif command == Tc0521.command_E_record:
+            self.recording = not self.recording
+        elif command == Tc0521.command_H_hold:
+            self.holdmode = not self.holdmode
+        elif command == Tc0521.command_M_minmaxavg:
+            self.maxminmode = True
+        elif command == Tc0521.command_N_xminmaxavg:
+            self.maxminmode = False
+        return None     # Button presses are not acknowledged
+
+class Sim9129B(object):
+    """    BK9129B power supply simulator, a stand in for the pyvisa serial resource.
+    Understands long and short form SCPI headers and semicolon joined lines.  Each output
+    drives a resistive load (load_resistance ohms) limited by the channel current setpoint.
+    Unknown commands push -113 onto the error queue.
+    The serial link is modelled like SimSerial: every line takes its wire time at baudrate
+    (None for instantaneous), the supply works through the lines one at a time taking latency
+    seconds for each, and a response can only be read once it has crossed the wire back.  A
+    read with no response coming waits timeout milliseconds (pyvisa style) and raises.
+    Error injection:
+        corrupt_rate    probability a response has one character changed
+        drop_rate       probability a response is never sent
+        error_rate      probability a setting (not a query) is rejected, -200 on the error queue"""
+    
+    IDN = 'B&K Precision, 9129B, SIM0000001, 1.00-1.00'
+    
+    # Long form mnemonics reduced to their short form
+    SHORT_FORMS = {'INSTRUMENT': 'INST', 'SELECT': 'SEL', 'VOLTAGE': 'VOLT', 'CURRENT': 'CURR', 'SOURCE': 'SOUR',
+                   'CHANNEL': 'CHAN', 'OUTPUT': 'OUTP', 'STATE': 'STAT', 'SYSTEM': 'SYST', 'ERROR': 'ERR',
+                   'REMOTE': 'REM', 'LOCAL': 'LOC', 'MEASURE': 'MEAS', 'POWER': 'POW', 'APPLY': 'APPL', 'SCALAR': 'SCAL'}
+    
+    def __init__(self, load_resistance=(10.0, 10.0, 10.0), latency=0.0, baudrate=9600, timeout=2000,
+                 corrupt_rate=0.0, drop_rate=0.0, error_rate=0.0, seed=None):
+        self.load_resistance = list(load_resistance)
+        self.latency = latency      # Seconds the supply takes to process a line
+        self.baudrate = baudrate    # None for instantaneous transfers
+        self.timeout = timeout      # Read timeout in milliseconds, like a pyvisa resource
+        self.corrupt_rate = corrupt_rate
+        self.drop_rate = drop_rate
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.responses = []     # [ready_time, text] in send order
+        self.busy_until = 0.0   # time.monotonic() the supply finishes the lines written so far
+        self.log = []       # Every line written, for tests and benchmarks
+        self.injected = 0   # Faults injected (corrupted, dropped or rejected)
+        self.reset()
+    
+    def reset(self):
+        self.channel = 1
+        self.voltage = {1: 0.0, 2: 0.0, 3: 0.0}
+        self.current = {1: 3.0, 2: 3.0, 3: 3.0}
+        self.output = {1: False, 2: False, 3: False}
+        self.errors = []
+    
+    def header(self, text):
+        nodes = [self.SHORT_FORMS.get(node, node) for node in text.upper().strip(':').split(':')]
+        # Optional nodes
+        if nodes and nodes[0] == 'SOUR':
+            nodes = nodes[1:]
+        nodes = [node for node in nodes if node not in ('SCAL', 'DC')]
+        return ':'.join(nodes)
+    
+    def measure(self, chan):
+        """Returns (voltage, current) of a channel driving its load."""
+        if not self.output[chan]:
+            return 0.0, 0.0
+        voltage = self.voltage[chan]
+        current = voltage / self.load_resistance[chan - 1]
+        if current > self.current[chan]:
+            current = self.current[chan]
+            voltage = current * self.load_resistance[chan - 1]
+        return voltage, current
+    
+    def execute(self, command):
+        """Executes one command, returns the response string for queries or None."""
+        header, _, args = command.strip().partition(' ')
+        query = header.endswith('?')
+        header = self.header(header.rstrip('?'))
+        args = [arg.strip().upper().rstrip('VAW') if arg.strip().upper() not in ('ON', 'OFF') else arg.strip().upper() for arg in args.split(',')] if args else []
+        
+        if query:
+            if header == '*IDN':
+                return self.IDN
+            if header == '*OPC':
+                return '1'
+            if header == 'SYST:ERR':
+                return self.errors.pop(0) if self.errors else '0,"No error"'
+            if header == 'INST:SEL' or header == 'INST':
+                return 'CH' + str(self.channel)
+            if header == 'VOLT':
+                return '%.3f' % self.voltage[self.channel]
+            if header == 'CURR':
+                return '%.3f' % self.current[self.channel]
+            if header in ('CHAN:OUTP:STAT', 'CHAN:OUTP', 'OUTP:STAT', 'OUTP'):
+                return '1' if self.output[self.channel] else '0'
+            if header.startswith('MEAS:'):
+                quantity, _, all_channels = header[5:].partition(':')
+                chans = (1, 2, 3) if all_channels == 'ALL' else (self.channel,)
+                values = []
+                for chan in chans:
+                    voltage, current = self.measure(chan)
+                    values.append({'VOLT': voltage, 'CURR': current, 'POW': voltage * current}.get(quantity, 0.0))
+                return ', '.join('%.3f' % value for value in values)
+        else:
+            if header in ('*PSC', '*CLS', 'SYST:REM', 'SYST:LOC'):
+                if header == '*CLS':
+                    self.errors = []
+                return None
+            if header == '*RST':
+                self.reset()
+                return None
+            if header in ('INST:SEL', 'INST'):
+                self.channel = int(args[0][-1])
+                return None
+            if header == 'VOLT':
+                self.voltage[self.channel] = float(args[0])
+                return None
+            if header == 'CURR':
+                self.current[self.channel] = float(args[0])
+                return None
+            if header in ('CHAN:OUTP:STAT', 'CHAN:OUTP'):
+                self.output[self.channel] = args[0] in ('ON', '1')
+                return None
+            if header in ('OUTP:STAT:ALL', 'OUTP:ALL'):
+                for chan in self.output:
+                    self.output[chan] = args[0] in ('ON', '1')
+                return None
+            if header == 'APPL:VOLT':
+                for chan, value in zip((1, 2, 3), args):
+                    self.voltage[chan] = float(value)
+                return None
+            if header == 'APPL:CURR':
+                for chan, value in zip((1, 2, 3), args):
+                    self.current[chan] = float(value)
+                return None
+        self.errors.append('-113,"Undefined header"')
+        return None
+    
+    def byte_time(self, n):
+        if not self.baudrate:
+            return 0.0
+        return n * 10.0 / self.baudrate     # 8N1, ten bits per byte
+    
+    def fault(self, rate):
+        if rate and self.random.random() < rate:
+            self.injected += 1
+            return True
+        return False
+    
+    # pyvisa resource interface
+    
+    def write(self, line):
+        self.log.append(line)
+        # The line crosses the wire (with its terminator), then waits its turn in the supply
+        now = time.monotonic()
+        done = max(now + self.byte_time(len(line) + 1), self.busy_until) + self.latency
+        self.busy_until = done
+        responses = []
+        for command in line.split(';'):
+            if command.strip():
+                if '?' not in command and self.fault(self.error_rate):
+                    self.errors.append('-200,"Execution error"')
+                    continue
+                try:
+                    response = self.execute(command)
+                except (ValueError, IndexError, KeyError):
+                    self.errors.append('-224,"Illegal parameter value"')
+                    response = None
+                if response is not None:
+                    responses.append(response)
+        if responses and not self.fault(self.drop_rate):
+            response = ';'.join(responses)
+            if self.fault(self.corrupt_rate):
+                i = self.random.randrange(len(response))
+                response = response[:i] + chr(ord(response[i]) ^ 0x04) + response[i + 1:]
+            self.responses.append([done + self.byte_time(len(response) + 1), response])
+        return len(line)
+    
+    def read(self):
+        if not self.responses:
+            time.sleep(self.timeout / 1000.0)
+            raise IOError('VI_ERROR_TMO: Timeout expired before operation completed.')
+        ready, response = self.responses.pop(0)
+        wait = ready - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        return response + '\n'
+    
+    def query(self, line):
+        self.write(line)
+        return self.read()
+    
+    def close(self):
+        pass
+
+class Sim9129BSerial(SimSerial):
+    """    A Sim9129B behind a plain serial port, for drivers that speak SCPI over serial themselves
+    (aioinsts.AsyncBkTrippleSupply_9129B).  Lines are handed to supply, a Sim9129B made with no
+    wire time of its own unless one is given, and its responses sent back newline terminated."""
+    
+    def __init__(self, supply=None, **kwargs):
+        SimSerial.__init__(self, **kwargs)
+        self.supply = supply if supply is not None else Sim9129B(baudrate=None, timeout=0)
+    
+    def frame_length(self, pending):
+        end = pending.find(b'\n')
+        return end + 1 if end >= 0 else None
+    
+    def handle(self, command):
+        self.supply.write(command.decode().strip())
+        if not self.supply.responses:
+            return None
+        return self.supply.read().encode()
+
+class SimResourceManager(object):
+    """Stand in for pyvisa.ResourceManager that opens Sim9129B instances, one per resource name."""
+    
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs    # Passed to every Sim9129B created
+        self.resources = {}
+    
+    def open_resource(self, name, **kwargs):
+        if name not in self.resources:
+            self.resources[name] = Sim9129B(**self.kwargs)
+        return self.resources[name]
+    
+    def list_resources(self):
+        return tuple(self.resources)
+    
+    def close(self):
+        pass
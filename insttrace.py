@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""Instrumentation for the instrument drivers.
+
+    instr = Instrumentation(trace_path='station.trace')
+    instrument(load, instr)
+    instrument(supply, instr)
+    ...
+    print(instr.counters())
+
+For every driver it records per command timing histograms, bytes on the wire, time spent
+waiting on I/O versus sleeping, checksum failures and retries.  Events can also be written
+to a trace file as JSON lines.  Drivers that are not instrumented only pay an 'is None' check.
+Loads on a Bk8500Bus share its port, the port is traced once under the bus and each load
+reports its own command timing.  Streams and readers go through their driver's transport, so
+one started before instrument() is traced from then on."""
+
+import json
+import threading
+import time
+
+from bkinsts import BkTrippleSupply_9129B, BkDcLoad_8500
+from bkbus import Bk8500Bus
+from tc0521 import Tc0521
+
+# BK8500 opcode -> command name, for readable counters
+BK8500_COMMAND_NAMES = dict((getattr(BkDcLoad_8500, name), name) for name in dir(BkDcLoad_8500)
+                            if name.startswith('SET_') or name.startswith('GET_') or name in ('TRIGGER', 'SAVE_LIST', 'RECALL_LIST'))
+
+class Instrumentation(object):
+    """    Collects timing and error counters from instrumented drivers, optionally writing a trace file.
+    Command histograms bucket latencies by powers of two microseconds, the key of each bucket is
+    its upper bound in microseconds."""
+    
+    def __init__(self, trace_path=None):
+        self.lock = threading.Lock()
+        self.trace = open(trace_path, 'a') if trace_path else None
+        self.reset()
+    
+    def reset(self):
+        with self.lock:
+            self.drivers = {}
+    
+    def stats(self, driver):
+        # Caller holds the lock
+        name = driver if isinstance(driver, str) else getattr(driver, 'trace_name', type(driver).__name__)
+        stats = self.drivers.get(name)
+        if stats is None:
+            stats = self.drivers[name] = {'commands': {}, 'bytes_tx': 0, 'bytes_rx': 0, 'io_s': 0.0, 'sleep_s': 0.0,
+                                          'checksum_failures': 0, 'retries': 0}
+        return name, stats
+    
+    def record(self, name, event, **fields):
+        # Caller holds the lock
+        if self.trace is not None:
+            fields.update({'t': time.monotonic(), 'driver': name, 'event': event})
+            self.trace.write(json.dumps(fields) + '\n')
+    
+    def command(self, driver, command, seconds):
+        """A complete command or query took seconds, including any pacing.  BK8500 opcodes are named."""
+        command = BK8500_COMMAND_NAMES.get(command, command) if isinstance(command, int) else command
+        with self.lock:
+            name, stats = self.stats(driver)
+            entry = stats['commands'].get(command)
+            if entry is None:
+                entry = stats['commands'][command] = {'count': 0, 'total_s': 0.0, 'max_s': 0.0, 'histogram': {}}
+            entry['count'] += 1
+            entry['total_s'] += seconds
+            entry['max_s'] = max(entry['max_s'], seconds)
+            bucket = 1 << int(seconds * 1e6).bit_length()
+            entry['histogram'][bucket] = entry['histogram'].get(bucket, 0) + 1
+            self.record(name, 'command', command=command, seconds=seconds)
+    
+    def io(self, driver, direction, nbytes, seconds):
+        """direction is 'tx' or 'rx', seconds is the time blocked in the transport."""
+        with self.lock:
+            name, stats = self.stats(driver)
+            stats['bytes_' + direction] += nbytes
+            stats['io_s'] += seconds
+            self.record(name, direction, bytes=nbytes, seconds=seconds)
+    
+    def sleep(self, driver, seconds):
+        with self.lock:
+            name, stats = self.stats(driver)
+            stats['sleep_s'] += seconds
+            self.record(name, 'sleep', seconds=seconds)
+    
+    def checksum_failure(self, driver):
+        with self.lock:
+            name, stats = self.stats(driver)
+            stats['checksum_failures'] += 1
+            self.record(name, 'checksum_failure')
+    
+    def retry(self, driver, count=1):
+        with self.lock:
+            name, stats = self.stats(driver)
+            stats['retries'] += count
+            self.record(name, 'retry', count=count)
+    
+    def counters(self):
+        """Returns a snapshot of all counters, keyed by driver name."""
+        with self.lock:
+            return json.loads(json.dumps(self.drivers))
+    
+    def close(self):
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
+
+class TracedTransport(object):
+    """Wraps a serial port or VISA resource and reports bytes and blocking time to an Instrumentation.
+    Anything not traced is passed through to the wrapped object."""
+    
+    def __init__(self, wrapped, instrumentation, driver):
+        self.wrapped = wrapped
+        self.instrumentation = instrumentation
+        self.driver = driver
+    
+    def __getattr__(self, name):
+        return getattr(self.wrapped, name)
+    
+    def write(self, data):
+        start = time.perf_counter()
+        result = self.wrapped.write(data)
+        self.instrumentation.io(self.driver, 'tx', len(data), time.perf_counter() - start)
+        return result
+    
+    def flush(self):
+        start = time.perf_counter()
+        self.wrapped.flush()
+        self.instrumentation.io(self.driver, 'tx', 0, time.perf_counter() - start)
+    
+    def read(self, *args, **kwargs):
+        start = time.perf_counter()
+        data = self.wrapped.read(*args, **kwargs)
+        self.instrumentation.io(self.driver, 'rx', len(data), time.perf_counter() - start)
+        return data
+    
+    def readinto(self, b):
+        start = time.perf_counter()
+        n = self.wrapped.readinto(b)
+        self.instrumentation.io(self.driver, 'rx', n or 0, time.perf_counter() - start)
+        return n
+    
+    def query(self, message, *args, **kwargs):
+        start = time.perf_counter()
+        response = self.wrapped.query(message, *args, **kwargs)
+        self.instrumentation.io(self.driver, 'tx', len(message), 0.0)
+        self.instrumentation.io(self.driver, 'rx', len(response), time.perf_counter() - start)
+        return response
+
+def transport_attribute(driver):
+    if isinstance(driver, BkTrippleSupply_9129B):
+        return 'ps'
+    if isinstance(driver, BkDcLoad_8500):
+        return 'sp'
+    if isinstance(driver, (Tc0521, Bk8500Bus)):
+        return 'port'
+    raise TypeError('UNSUPPORTED DRIVER ' + type(driver).__name__)
+
+def on_bus(driver):
+    return isinstance(driver, BkDcLoad_8500) and driver.bus is not None
+
+def instrument(driver, instrumentation, name=None):
+    """Attach instrumentation to a driver and wrap its transport.  Returns the driver.
+    A load on a bus instruments the bus too, unless it already is."""
+    if on_bus(driver):
+        if not isinstance(driver.bus.port, TracedTransport):
+            instrument(driver.bus, instrumentation)
+        driver.trace_name = name or '%s@%s#%d' % (type(driver).__name__, getattr(driver.bus.port, 'port', None) or id(driver.bus), driver.address)
+        driver.instrumentation = instrumentation
+        return driver
+    attribute = transport_attribute(driver)
+    uninstrument(driver)
+    driver.trace_name = name or type(driver).__name__ + '@' + str(getattr(getattr(driver, attribute), 'resource_name', None)
+                                                                 or getattr(getattr(driver, attribute), 'port', None) or id(driver))
+    setattr(driver, attribute, TracedTransport(getattr(driver, attribute), instrumentation, driver))
+    driver.instrumentation = instrumentation
+    if attribute == 'ps':
+        driver.pacer.resource = driver.ps
+        driver.pacer.instrumentation = instrumentation
+        driver.pacer.trace_name = driver.trace_name
+    return driver
+
+def uninstrument(driver):
+    """Remove instrumentation from a driver, restoring its original transport.
+    The port of a bus stays traced until the bus itself is uninstrumented."""
+    if on_bus(driver):
+        driver.instrumentation = None
+        return driver
+    attribute = transport_attribute(driver)
+    transport = getattr(driver, attribute)
+    if isinstance(transport, TracedTransport):
+        setattr(driver, attribute, transport.wrapped)
+    driver.instrumentation = None
+    if attribute == 'ps':
+        driver.pacer.resource = driver.ps
+        driver.pacer.instrumentation = None
+    return driver
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+"""Interlock engine, shuts the supply and load off when a temperature or load limit trips.
+
+    interlock = Interlock(supply=supply, load=load, meter=meter, max_temp=150.0,
+                          load_limits={'voltage': (10.5, None), 'current': (None, 5.0)})
+    interlock.start()
+    ...
+    if interlock.tripped:
+        print(interlock.report())
+
+Watcher threads keep a pipelined status stream running on the meter and poll the load's
+present values back to back.  Every reading is checked against the rules as it arrives.  On
+a trip the shutdown actions (supply disable_output_all, load disable_load) run at once on
+their own pre-started threads, one per port, and are sent on the drivers' priority path:
+they go ahead of any command a test script is waiting to send and cut a pacing sleep short,
+so the wait is at most the one transaction already on the wire.  The time from trip to each
+off command going out is measured against the latency budget, then the output state is read
+back from the instruments (OUTP? on the supply, the operation state register on the load).
+
+A trip latches until reset(): while it is latched the drivers refuse, with InterlockTripped,
+every command that would turn an output back on (enable_output_*, enable_load, batches).
+A watcher that fails trips the interlock too, and a watched instrument that stops producing
+readings for stale_timeout seconds trips it as stale.
+
+The interlock owns the meter and load polling while it runs, scripts that need readings can
+take them from the interlock (last) or feed readings they take themselves through check()."""
+
+import collections
+import threading
+import time
+
+from bkinsts import own_sample_t
+
+TripEvent = collections.namedtuple('TripEvent', [
+    'rule',         # Name of the rule that tripped
+    'detail',       # What it saw
+    'sample_t',     # time.monotonic() the offending reading was taken, None if not from a reading
+    'trip_t',       # time.monotonic() the trip was raised
+    'off_latency',  # {action: seconds from trip_t until the output was switched off}, None for an action that failed
+    'confirmed',    # {action: True if read back off, False if still on, None if it could not be read}
+])
+
+class InterlockTripped(RuntimeError):
+    """Raised by a driver asked to turn an output on while an interlock trip is latched."""
+
+LOAD_QUANTITIES = ('voltage', 'current', 'power')
+
+def tc0521_rules(max_temp=None, trip_on_overtemp=True, trip_on_ol=True):
+    """Rules for Tc0521 readings, max_temp is in the meter's display units."""
+    rules = []
+    if max_temp is not None:
+        def over_max_temp(reading):
+            for name in ('t1', 't2', 't3', 't4'):
+                temp = getattr(reading, name)
+                if temp is not None and temp > max_temp:
+                    return '%s %.1f > %.1f' % (name.upper(), temp, max_temp)
+        rules.append(('tc0521', 'max_temp', over_max_temp))
+    if trip_on_overtemp:
+        rules.append(('tc0521', 'overtemp', lambda reading: 'METER OVERTEMP ALARM' if reading.overtemp else None))
+    if trip_on_ol:
+        def over_limit(reading):
+            probes = [name for name in ('t1', 't2', 't3', 't4') if getattr(reading, name + '_ol')]
+            if probes:
+                return 'OVER LIMIT ' + ','.join(probes).upper()
+        rules.append(('tc0521', 'overlimit', over_limit))
+    return rules
+
+def load_rules(limits):
+    """Rules for BK8500 present values, limits is {'voltage'|'current'|'power': (low, high)}, either bound None."""
+    rules = []
+    for quantity, (low, high) in sorted(limits.items()):
+        if quantity not in LOAD_QUANTITIES:
+            raise ValueError('UNKNOWN LOAD QUANTITY ' + str(quantity))
+        def outside(values, quantity=quantity, low=low, high=high):
+            value = values[quantity]
+            if low is not None and value < low:
+                return '%s %.4g < %.4g' % (quantity.upper(), value, low)
+            if high is not None and value > high:
+                return '%s %.4g > %.4g' % (quantity.upper(), value, high)
+        rules.append(('load', 'load_' + quantity, outside))
+    return rules
+
+def read_off(state):
+    # An output state read back as confirmation it is off, None when it could not be read
+    return None if state is None else not state
+
+class Interlock(object):
+    """    Watches the meter and load, trips the shutdown actions when a rule fires.
+    Rules are (source, name, predicate), predicate(reading) returns a description of the fault or
+    None.  Sources are 'tc0521' (Tc0521Reading) and 'load' (present values dict), add_rule() can
+    add rules for any source fed through check().  A trip latches until reset().
+    stale_timeout trips when a watched instrument has not produced a reading for that long (None
+    turns the watchdog off).  A watcher that raises trips the interlock, then starts over after
+    retry_delay seconds."""
+    
+    def __init__(self, supply=None, load=None, meter=None, max_temp=None, trip_on_overtemp=True, trip_on_ol=True,
+                 load_limits=None, budget=0.25, stale_timeout=2.0, depth=2, on_trip=None, retry_delay=0.5):
+        self.supply = supply
+        self.load = load
+        self.meter = meter
+        self.budget = budget                # Seconds allowed from trip to every output off
+        self.stale_timeout = stale_timeout
+        self.retry_delay = retry_delay      # Seconds a failed watcher waits before starting over
+        self.depth = depth                  # Status requests kept in flight on the meter
+        self.on_trip = on_trip              # Called with the TripEvent once every action has run
+        
+        self.rules = []
+        if meter is not None:
+            self.rules += tc0521_rules(max_temp, trip_on_overtemp, trip_on_ol)
+        if load is not None and load_limits:
+            self.rules += load_rules(load_limits)
+        
+        self.actions = []
+        if supply is not None:
+            self.add_action('supply', lambda: supply.disable_output_all(priority=True),
+                            lambda: not any(supply.read_output_state_all(priority=True)))
+            supply.interlock = self
+        if load is not None:
+            self.add_action('load', lambda: load.disable_load(priority=True),
+                            lambda: read_off(load.read_load_state(priority=True)))
+            load.interlock = self
+        
+        self.lock = threading.Lock()
+        self.done_event = threading.Event()
+        self.stopping = threading.Event()
+        self.running = False
+        self.threads = []
+        self.tripped = None         # TripEvent of the latched trip
+        self.pending = None         # TripEvent whose actions are running or have run, until reset()
+        self.trips = []             # Every TripEvent since construction
+        self.checks = collections.Counter()     # Readings checked per source
+        self.failures = collections.Counter()   # Watcher exceptions per source
+        self.last = {}              # Source -> (time.monotonic(), reading) of the latest reading
+    
+    def add_rule(self, source, name, predicate):
+        self.rules.append((source, name, predicate))
+    
+    def add_action(self, name, function, confirm=None):
+        """Run function on a trip, on its own thread in parallel with the other actions.
+        function may return the time.monotonic() the output went off, otherwise the time it returned
+        is used.  confirm() then reads the output back, True if it is off, None if it cannot tell."""
+        self.actions.append((name, function, confirm, threading.Event()))
+    
+    def reset(self, timeout=None):
+        """Re-arm after a trip, the outputs are left off and may be turned on again.
+        A trip whose actions are still running is waited for first, up to timeout seconds.
+        Returns False, leaving the trip latched, if it did not complete in time."""
+        with self.lock:
+            in_flight = self.pending is not None and self.tripped is None
+        if in_flight and not self.done_event.wait(timeout):
+            return False
+        with self.lock:
+            self.tripped = None
+            self.pending = None
+            self.done_event.clear()
+        return True
+    
+    def refuse(self, output):
+        """Raises InterlockTripped while a trip is latched, the drivers call it before turning output on."""
+        event = self.pending
+        if event is not None:
+            raise InterlockTripped('INTERLOCK TRIPPED BY %s (%s), %s STAYS OFF UNTIL RESET' % (event.rule.upper(), event.detail, output.upper()))
+    
+    # Checking
+    
+    def check(self, source, reading, sample_t=None):
+        """Check one reading against the rules for its source, returns True if it tripped."""
+        if sample_t is None:
+            sample_t = time.monotonic()
+        self.checks[source] += 1
+        self.last[source] = (sample_t, reading)
+        for rule_source, name, predicate in self.rules:
+            if rule_source == source:
+                detail = predicate(reading)
+                if detail:
+                    self.trip(name, detail, sample_t)
+                    return True
+        return False
+    
+    def trip(self, rule, detail, sample_t=None):
+        """Raise a trip by hand or from a rule.  Only the first trip until reset() runs the actions."""
+        with self.lock:
+            if self.pending is not None or self.tripped is not None:
+                return
+            event = self.pending = TripEvent(rule, detail, sample_t, time.monotonic(), {}, {})
+            if not self.actions:
+                self.finish(event)
+                return
+            self.remaining = len(self.actions)
+            running = self.running
+        for name, function, confirm, wake in self.actions:
+            if running:
+                wake.set()
+            else:
+                # No responders before start() or after stop(), the actions still have to run
+                threading.Thread(target=self.act, args=(event, name, function, confirm), name='Interlock-act', daemon=True).start()
+    
+    def finish(self, event):
+        # Caller holds the lock, every action of event has completed
+        self.tripped = event
+        self.trips.append(event)
+        self.done_event.set()
+        if self.on_trip is not None:
+            threading.Thread(target=self.on_trip, args=(event,), daemon=True).start()
+    
+    def wait(self, timeout=None):
+        """Wait for a trip to complete, returns its TripEvent or None on timeout."""
+        if self.done_event.wait(timeout):
+            return self.tripped
+        return None
+    
+    # Threads
+    
+    def start(self):
+        self.stopping.clear()
+        self.running = True
+        for name, function, confirm, wake in self.actions:
+            self.spawn(self.respond, name, function, confirm, wake)
+        if self.meter is not None:
+            self.spawn(self.watch_meter)
+        if self.load is not None:
+            self.spawn(self.watch_load)
+        if self.stale_timeout is not None and (self.meter is not None or self.load is not None):
+            self.spawn(self.watch_stale)
+        return self
+    
+    def spawn(self, target, *args):
+        thread = threading.Thread(target=target, args=args, name='Interlock-' + target.__name__, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+    
+    def stop(self):
+        self.running = False
+        self.stopping.set()
+        for name, function, confirm, wake in self.actions:
+            wake.set()              # Wakes the responders so they can exit
+        self.threads = []
+    
+    def respond(self, name, function, confirm, wake):
+        # Waits for a trip and runs one shutdown action
+        while True:
+            wake.wait()
+            wake.clear()
+            if not self.running:
+                return
+            with self.lock:
+                event = self.pending
+            if event is None or name in event.off_latency:
+                continue
+            self.act(event, name, function, confirm)
+    
+    def act(self, event, name, function, confirm):
+        # Runs one shutdown action for event, then reads the output back
+        try:
+            off_t = function()
+            if not isinstance(off_t, float):
+                off_t = time.monotonic()
+            latency = off_t - event.trip_t
+        except Exception:
+            latency = None          # Reported as a failed action
+        confirmed = None
+        if confirm is not None:
+            try:
+                confirmed = confirm()
+            except Exception:
+                pass
+        with self.lock:
+            event.off_latency[name] = latency
+            event.confirmed[name] = confirmed
+            self.remaining -= 1
+            if not self.remaining:
+                self.finish(event)
+    
+    def failed(self, source, error):
+        # A watcher raised: trip, then give the instrument a moment before starting over
+        self.failures[source] += 1
+        self.trip('watch_' + source, '%s WATCHER FAILED: %r' % (source.upper(), error))
+        self.stopping.wait(self.retry_delay)
+    
+    def watch_meter(self):
+        reader = None
+        while self.running:
+            try:
+                if reader is None:
+                    reader = self.meter.stream(depth=self.depth)
+                reading = reader.read()
+                self.check('tc0521', reading, reader.sample_t)
+            except Exception as error:
+                reader = None       # A new reader flushes whatever the failure left on the port
+                self.failed('tc0521', error)
+    
+    def watch_load(self):
+        while self.running:
+            try:
+                counts = self.load.read_present_counts()
+                if counts is not None:
+                    self.check('load', {'voltage': counts[0] / 1000.0, 'current': counts[1] / 10000.0, 'power': counts[2] / 1000.0},
+                               own_sample_t(self.load))
+            except Exception as error:
+                self.failed('load', error)
+    
+    def watch_stale(self):
+        started = time.monotonic()
+        sources = [source for source, instrument in (('tc0521', self.meter), ('load', self.load)) if instrument is not None]
+        while self.running:
+            now = time.monotonic()
+            for source in sources:
+                last_t = self.last.get(source, (started, None))[0]
+                if now - last_t > self.stale_timeout:
+                    self.trip('stale_' + source, 'NO READING FROM %s FOR %.2f s' % (source.upper(), now - last_t))
+            self.stopping.wait(self.stale_timeout / 4.0)
+    
+    def report(self):
+        """Summary of the trips and their trip to off latency against the budget."""
+        trips = []
+        for event in self.trips:
+            latencies = [latency for latency in event.off_latency.values() if latency is not None]
+            trips.append({
+                'rule': event.rule,
+                'detail': event.detail,
+                'detection_s': None if event.sample_t is None else event.trip_t - event.sample_t,
+                'off_latency_s': dict(event.off_latency),
+                'confirmed': dict(event.confirmed),
+                'worst_s': max(latencies) if latencies else None,
+                'within_budget': len(latencies) == len(event.off_latency) and all(latency <= self.budget for latency in latencies),
+            })
+        return {'budget_s': self.budget, 'checks': dict(self.checks), 'tripped': self.tripped is not None, 'trips': trips}
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""Bounded memory soak buffers: a raw sample ring plus rolling min/max/mean tiers.
+
+    soak = RollupBuffer(TC0521_COLUMNS)
+    with hub.subscribe(['tc0521']) as samples:
+        for sample in samples:
+            soak.append(sample.value, sample.t)
+
+    soak.raw(600)                   # The last 600 samples as they were taken
+    soak.rows(60.0, 24 * 60)        # The last day as 1 minute min/max/mean/count rows
+
+The host side version of the meter's MIN/MAX/AVG mode, for every column at once.  A sample
+goes into the raw ring and the open bucket of the finest tier (1 s by default).  When a
+sample falls in a new bucket, the old one is closed into that tier's ring and merged into
+the next tier up (1 min, then 1 h).  Each sample is added once, and every coarser tier only
+ever sees closed buckets.  Every ring is preallocated, so memory stays the same whether the
+run lasts an hour or a month.  NaN values (unplugged probes, None readings) are left out of
+min, max and mean, count is the number of samples in each bucket."""
+
+import threading
+import time
+
+import numpy as np
+
+# Columns for common sources, the dtypes of the capture schemas are ignored, everything is float
+from capture import LOAD_COLUMNS, TC0521_COLUMNS
+
+# (bucket seconds, buckets kept): 6 hours of seconds, 2 weeks of minutes, a year of hours
+DEFAULT_TIERS = ((1.0, 6 * 3600), (60.0, 14 * 24 * 60), (3600.0, 365 * 24))
+
+class RollupTier(object):
+    """    Fixed size ring of closed buckets of one width, plus the bucket still being filled.
+    Rows are merged in as (t, min, max, sum, count) blocks, raw samples are blocks whose min,
+    max and sum are the values themselves and whose count is 1 (0 for NaN)."""
+    
+    def __init__(self, width, capacity, names):
+        self.width = width
+        self.capacity = capacity
+        self.names = names
+        columns = len(names)
+        self.t = np.zeros(capacity, dtype=np.float64)       # Bucket start
+        self.min = np.zeros((capacity, columns), dtype=np.float64)
+        self.max = np.zeros((capacity, columns), dtype=np.float64)
+        self.sum = np.zeros((capacity, columns), dtype=np.float64)
+        self.n = np.zeros((capacity, columns), dtype=np.int64)
+        self.count = 0          # Buckets closed since the start, ring index is count % capacity
+        self.bucket = None      # Index (t // width) of the open bucket
+        self.open = None        # [min, max, sum, n] of the open bucket
+    
+    def merge(self, t, mins, maxs, sums, counts):
+        """Merge a time ordered block in, returns the buckets it closed as a block for the next tier."""
+        buckets = np.floor_divide(t, self.width).astype(np.int64)
+        starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+        # One reduction per bucket touched, the loop below runs once per bucket, not per row
+        block = (np.fmin.reduceat(mins, starts, axis=0), np.fmax.reduceat(maxs, starts, axis=0),
+                 np.add.reduceat(sums, starts, axis=0), np.add.reduceat(counts, starts, axis=0))
+        closed = []
+        for i, bucket in enumerate(buckets[starts]):
+            if bucket == self.bucket:
+                acc = self.open
+                np.fmin(acc[0], block[0][i], out=acc[0])
+                np.fmax(acc[1], block[1][i], out=acc[1])
+                acc[2] += block[2][i]
+                acc[3] += block[3][i]
+                continue
+            if self.bucket is not None:
+                if bucket < self.bucket:
+                    raise ValueError('ROLLUP TIMESTAMPS MUST NOT GO BACKWARDS')
+                closed.append(self.close())
+            self.bucket = bucket
+            self.open = [block[0][i].copy(), block[1][i].copy(), block[2][i].copy(), block[3][i].copy()]
+        if not closed:
+            return None
+        return tuple(np.array(column) for column in zip(*closed))
+    
+    def close(self):
+        # Move the open bucket into the ring, returns it as a row for the next tier
+        i = self.count % self.capacity
+        start = self.bucket * self.width
+        mins, maxs, sums, counts = self.open
+        self.t[i] = start
+        self.min[i] = mins
+        self.max[i] = maxs
+        self.sum[i] = sums
+        self.n[i] = counts
+        self.count += 1
+        self.bucket = None
+        self.open = None
+        return start, mins, maxs, sums, counts
+    
+    def rows(self, n=None, include_open=False):
+        """Copies of the last n closed buckets (default all held) in time order as a dict of arrays:
+        t (bucket start), count, and for every column name_min, name_max and name_mean.
+        include_open adds the bucket still being filled at the end."""
+        available = min(self.count, self.capacity)
+        n = available if n is None else min(n, available)
+        idx = np.arange(self.count - n, self.count) % self.capacity
+        t, mins, maxs, sums, counts = self.t[idx], self.min[idx], self.max[idx], self.sum[idx], self.n[idx]
+        if include_open and self.bucket is not None:
+            t = np.append(t, self.bucket * self.width)
+            mins, maxs, sums, counts = [np.vstack([column, row]) for column, row in zip((mins, maxs, sums, counts), self.open)]
+        means = np.divide(sums, counts, out=np.full(sums.shape, np.nan), where=counts > 0)
+        rows = {'t': t, 'count': counts.max(axis=1) if len(self.names) else np.zeros(len(t), dtype=np.int64)}
+        for j, name in enumerate(self.names):
+            rows[name + '_min'] = mins[:, j]
+            rows[name + '_max'] = maxs[:, j]
+            rows[name + '_mean'] = means[:, j]
+        return rows
+
+class RollupBuffer(object):
+    """    Raw ring of raw_capacity samples plus tiers of (bucket seconds, buckets kept), each tier
+    a whole multiple of the one below.  columns is a list of names or of (name, dtype) pairs
+    such as capture.LOAD_COLUMNS, rows are dicts or namedtuples keyed by column name.
+    Safe to append from one thread while others read.  flush() ends the run, rows(include_open=True)
+    reads the buckets still being filled without closing them."""
+    
+    def __init__(self, columns, raw_capacity=65536, tiers=DEFAULT_TIERS):
+        self.names = [column if isinstance(column, str) else column[0] for column in columns]
+        widths = [width for width, capacity in tiers]
+        for finer, coarser in zip(widths, widths[1:]):
+            if coarser <= finer or (coarser / finer) % 1:
+                raise ValueError('EACH ROLLUP TIER MUST BE A WHOLE MULTIPLE OF THE ONE BELOW')
+        self.raw_capacity = raw_capacity
+        self.raw_t = np.zeros(raw_capacity, dtype=np.float64)
+        self.raw_values = np.zeros((raw_capacity, len(self.names)), dtype=np.float64)
+        self.raw_count = 0      # Samples appended since the start, ring index is raw_count % raw_capacity
+        self.last_t = -np.inf
+        self.tiers = [RollupTier(width, capacity, self.names) for width, capacity in tiers]
+        self.closed = False     # Set by flush(), no more samples can be added
+        self.lock = threading.Lock()
+    
+    def value(self, row, name):
+        value = row.get(name) if isinstance(row, dict) else getattr(row, name, None)
+        return np.nan if value is None else value
+    
+    def append(self, row, t=None):
+        """Add one reading, t defaults to time.monotonic()."""
+        if t is None:
+            t = time.monotonic()
+        values = np.array([self.value(row, name) for name in self.names], dtype=np.float64)
+        self.extend_rows(np.array([t], dtype=np.float64), values[np.newaxis])
+    
+    def extend(self, t, **columns):
+        """Add a block of readings from arrays, e.g. a BkLoadStream snapshot.  Missing columns are NaN."""
+        t = np.asarray(t, dtype=np.float64)
+        values = np.empty((len(t), len(self.names)), dtype=np.float64)
+        for j, name in enumerate(self.names):
+            values[:, j] = columns.get(name, np.nan)
+        self.extend_rows(t, values)
+    
+    def extend_rows(self, t, values):
+        if not len(t):
+            return
+        if np.any(np.diff(t) < 0):
+            raise ValueError('ROLLUP TIMESTAMPS MUST NOT GO BACKWARDS')
+        with self.lock:
+            # Checked against the last append under the lock, another thread may have just added later samples
+            if self.closed:
+                raise ValueError('ROLLUP BUFFER IS FLUSHED')
+            if t[0] < self.last_t:
+                raise ValueError('ROLLUP TIMESTAMPS MUST NOT GO BACKWARDS')
+            # Only the last raw_capacity rows of a large block can survive in the ring
+            keep = min(len(t), self.raw_capacity)
+            idx = np.arange(self.raw_count + len(t) - keep, self.raw_count + len(t)) % self.raw_capacity
+            self.raw_t[idx] = t[-keep:]
+            self.raw_values[idx] = values[-keep:]
+            self.raw_count += len(t)
+            self.last_t = t[-1]
+            
+            present = ~np.isnan(values)
+            block = (t, values, values, np.where(present, values, 0.0), present.astype(np.int64))
+            for tier in self.tiers:
+                block = tier.merge(*block)
+                if block is None:
+                    break
+    
+    def flush(self):
+        """Close the open bucket of every tier at the end of a run.  The buffer is closed too, a later
+        sample would fall in a bucket that has already been closed and give a second row for it."""
+        with self.lock:
+            self.closed = True
+            block = None
+            for tier in self.tiers:
+                closed = [] if block is None else tier.merge(*block)
+                rows = [] if closed is None else list(zip(*closed))
+                if tier.bucket is not None:
+                    rows.append(tier.close())
+                block = tuple(np.array(column) for column in zip(*rows)) if rows else None
+    
+    def raw(self, n=None):
+        """Copies of the last n raw samples (default all held) in time order as a dict of arrays."""
+        with self.lock:
+            available = min(self.raw_count, self.raw_capacity)
+            n = available if n is None else min(n, available)
+            idx = np.arange(self.raw_count - n, self.raw_count) % self.raw_capacity
+            rows = {'t': self.raw_t[idx]}
+            values = self.raw_values[idx]
+        for j, name in enumerate(self.names):
+            rows[name] = values[:, j]
+        return rows
+    
+    def tier(self, width):
+        """The RollupTier with buckets of width seconds."""
+        for tier in self.tiers:
+            if tier.width == width:
+                return tier
+        raise ValueError('NO ROLLUP TIER OF %g SECONDS' % width)
+    
+    def rows(self, width, n=None, include_open=False):
+        """RollupTier.rows() of the width seconds tier, taken under the lock."""
+        with self.lock:
+            return self.tier(width).rows(n, include_open)
+    
+    def nbytes(self):
+        """Memory held by the rings, fixed from construction."""
+        total = self.raw_t.nbytes + self.raw_values.nbytes
+        for tier in self.tiers:
+            total += tier.t.nbytes + tier.min.nbytes + tier.max.nbytes + tier.sum.nbytes + tier.n.nbytes
+        return total
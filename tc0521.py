@@ -1,6 +1,9 @@
-import serial.tools.list_ports as serial_ports  # From official package 'pyserial'
 import serial   # From official package 'pyserial'
-from time import sleep
+import collections
+import struct
+from time import sleep, monotonic
+
+from bkinsts import sample_time, SampleStamp
 
 class Tc0521(object):
     '''Device handler for PerfectPrime TC0521 thermocouple meter.  
@@ -72,86 +75,45 @@ class Tc0521(object):
     bitmask_t3_unplug   = bit6
     bitmask_t4_unplug   = bit7
     
-    def __init__(self, com_port=None):
+    instrumentation = None  # insttrace.Instrumentation, set by insttrace.instrument()
+    sample_t = SampleStamp()    # Estimated monotonic() the last status reading was taken, see bkinsts.sample_time()
+    sample_offset = 0.0
+    
+    def __init__(self, com_port=None, port=None):
         '''Connects to TC0521 meter give input COM port.  
-        COM port should use OS specifi naming.'''
-        
-        # Command A byte 1 battery data:
-        self.battery = None     # Battery fuel gauge level
-        
-        # Command A byte 2 temperature operating modes data:
-        self.t1t2_mode = None        # In T1-T2 mode (boolean)
-        self.t1_range_hi = None    # If amplitude is xxx.x or xxxx (<= 999.9 or >= 1000) for T1
-        self.t2_range_hi = None    # If amplitude is xxx.x or xxxx (<= 999.9 or >= 1000) for T2
-        self.t3_range_hi = None    # If amplitude is xxx.x or xxxx (<= 999.9 or >= 1000) for T3
-        self.t4_range_hi = None    # If amplitude is xxx.x or xxxx (<= 999.9 or >= 1000) for T4
-        self.t1t2_range_hi = None  # If amplitude is xxx.x or xxxx (<= 999.9 or >= 1000) for T1-T2
-        self.units = None       # Units of C or F
-        
-        # Command A byte 3 system data
-        self.alarm_en = None    # Is the alarm enabled?
-        self.overtemp = None    # Is there a reading exceeding alarm value?
-        self.undertemp = None   # Is there a reading under alarm value?
-        self.recording = None   # Is recording active?
-        self.memfull = None     # Is internal storage memory full?
-        self.holdmode = None    # Is unit holding current frozen value?
-        self.maxminmode = None  # Is unit operating in max/min mode?
-        self.btactive = None    # Is bluetooth enabled?
-        
-        # Command A byte 4 min/max/avg current operating mode
-        self.maxminmodetype = None  # Which of min, max, avg, or min/max/avg mode are we operating in?
-        
-        # Command A byte 5 probe type
-        self.probe_type = None
+        COM port should use OS specifi naming.  port takes an already open
+        serial.Serial like object instead (e.g. an instsim.SimTc0521Serial).'''
         
-        # Command A byte 6 Over limit or unplugged
-        self.t1_ol = None
-        self.t2_ol = None
-        self.t3_ol = None
-        self.t4_ol = None
-        self.t1_unplug = None
-        self.t2_unplug = None
-        self.t3_unplug = None
-        self.t4_unplug = None
+        # Last decoded status, the status attributes (battery, units, t1 ...) are read from it.
+        self.reading = None
         
-        # Probe temperatures
-        self.t1 = None
-        self.t2 = None
-        self.t3 = None
-        self.t4 = None
-        self.t1t2 = None
-        
-        if com_port == None:
-            # Scan through the ports to see if TC0521 is connected.
-            
-            # Determine the available system ports
-            available_ports = serial_ports.comports()
-        
-            # Loop through all system ports to find one with responsive TC0521 unit.
-            for port_info in available_ports:
-                try:
-                    print("trying port " + port_info.device)
-                    self.port = serial.Serial(port=port_info.device, timeout=1)
-                    
-                    self.port.reset_output_buffer()
-                    self.port.reset_input_buffer()
-                    
-                    # Send query for model number
-                    self.port.write(command_K_modelnum)
-                    self.port.flush()
-                    
-                    # Check response for correct value indicating right port selected
-                    self.raw_data = self.port.read(size=32)
-                    
-                    if self.raw_data == response_K_modelnum:
-                        print('Successfully connected to TC0521.')
-                    else:
-                        raise NameError('TC0521 NOT ON SPECIFIED PORT.')
-                        self.port.close()
-                        del(self.port)
-                    
-                except:
-                    pass # Port cannot be opened, probably already in use.  Try next one.
+        if port is not None:
+            self.port = port
+        elif com_port == None:
+            # Probe all system ports in parallel (or use the cached mapping) to find a TC0521.
+            import discover
+            com_port = discover.find_port('TC0521')
+            if com_port is None:
+                raise NameError('NO TC0521 FOUND.')
+            try:
+                self.port = serial.Serial(port=com_port, timeout=1)
+            except serial.SerialException:
+                raise NameError('PORT UNAVAILABLE OR ALREADY IN USE.')
+                
+            # Verify a cached mapping is still right, re-probe without the cache if not
+            self.port.reset_output_buffer()
+            self.port.reset_input_buffer()
+            self.port.write(self.command_K_modelnum)
+            self.port.flush()
+            self.raw_data = self.port.read(size=len(self.response_K_modelnum))
+            if self.raw_data != self.response_K_modelnum:
+                self.port.close()
+                discover.forget(com_port)
+                com_port = discover.find_port('TC0521', use_cache=False)
+                if com_port is None:
+                    raise NameError('NO TC0521 FOUND.')
+                self.port = serial.Serial(port=com_port, timeout=1)
+            print('Successfully connected to TC0521 on ' + com_port + '.')
         else:
             # COM port specified
             try:
@@ -211,10 +173,12 @@ class Tc0521(object):
         else:
             return (temp - 32.0) * 5.0 / 9.0
         
-    def get_status(self):
+    def get_reading(self):
         '''Query the current operating status and temperature values.  
-        Returns True if checksum mismatch.'''
+        Returns a Tc0521Reading, check its checksum_ok field before trusting it.'''
         
+        start = monotonic()
+            
         self.port.reset_output_buffer()
         self.port.reset_input_buffer()
         
@@ -223,189 +187,353 @@ class Tc0521(object):
         self.port.flush()
         
         self.raw_data = self.port.read(size=64)
+        end = monotonic()
+        self.sample_t = sample_time(start, end, len(self.command_A_status), len(self.raw_data),
+                                    getattr(self.port, 'baudrate', None), self.sample_offset)
         
-        # print(self.raw_data)
+        self.reading = decode_status(self.raw_data)
         
-        # Parse out binary data from string:
+        if self.instrumentation is not None:
+            self.instrumentation.command(self, 'A', end - start)
+            if not self.reading.checksum_ok:
+                self.instrumentation.checksum_failure(self)
+        return self.reading
         
-        # Byte 0 is always 0x02
-        
-        # Byte 1 is battery level
-        self.battery = self.raw_data[1] * 33
+    def get_status(self):
+        '''Query the current operating status and temperature values.  
+        Returns True if checksum mismatch.'''
         
-        # Byte 2 is boolean information about current configuration
-        if self.raw_data[2] & self.bitmask_T1T2mode:
-            self.t1t2_mode = True
-        else:
-            self.t1t2 = False
-        if self.raw_data[2] & self.bitmask_recallmode:
-            pass # not sure what to do here...
-        if self.raw_data[2] & self.bitmask_T1range:
-            self.t1_range_hi = True
-        else:
-            self.t1_range_hi = False
-        if self.raw_data[2] & self.bitmask_T2range:
-            self.t2_range_hi = True
-        else:
-            self.t2_range_hi = False
-        if self.raw_data[2] & self.bitmask_T3range:
-            self.t3_range_hi = True
-        else:
-            self.t3_range_hi = False
-        if self.raw_data[2] & self.bitmask_T4range:
-            self.t4_range_hi = True
-        else:
-            self.t4_range_hi = False
-        if self.raw_data[2] & self.bitmask_T1T2range:
-            self.t1t2_range_hi = True
-        else:
-            self.t1t2_range_hi = False
-        if self.raw_data[2] & self.bitmask_units:
-            self.units = 'C'
+        if not self.get_reading().checksum_ok:
+            print("WARNING: CHECKSUM MISMATCH, NULLIFYING ALL DATA.  RETRY READ.")
+            return True
         else:
-            self.units = 'F'
+            return False
             
-        # Byte 3 is more status information
-        if self.raw_data[3] & self.bitmask_alarm:
-            self.alarm_en = True
-        else:
-            self.alarm_en = False
-        if self.raw_data[3] & self.bitmask_overtemp:
-            self.overtemp = True
-        else:
-            self.overtemp = False
-        if self.raw_data[3] & self.bitmask_undertemp:
-            self.undertemp = True
-        else:
-            self.undertemp = False
-        if self.raw_data[3] & self.bitmask_recording:
-            self.recording = True
-        else:
-            self.recording = False
-        if self.raw_data[3] & self.bitmask_memfull:
-            self.memfull = True
-        else:
-            self.memfull = False
-        if self.raw_data[3] & self.bitmask_holdmode:
-            self.holdmode = True
-        else:
-            self.holdmode = False
-        if self.raw_data[3] & self.bitmask_maxminmode:
-            self.maxminmode = True
-        else:
-            self.maxminmode = False
-        if self.raw_data[3] & self.bitmask_btenabled:
-            self.btactive = True
-        else:
-            self.btactive = False
+    def stream(self, depth=2):
+        '''Returns a Tc0521StreamReader for continuous pipelined status reads.'''
+        return Tc0521StreamReader(self, depth=depth)
         
-        # Byte 4 is min max current mode
-        if self.maxminmode:
-            if self.raw_data[4] & self.bitmask_maxmode:
-                self.maxminmodetype = 'MAX'
-            elif self.raw_data[4] & self.bitmask_minmode:
-                self.maxminmodetype = 'MIN'
-            elif self.raw_data[4] & self.bitmask_avgmode:
-                self.maxminmodetype = 'AVG'
-            elif self.raw_data[4] & self.bitmask_maxminavgmode:
-                self.maxminmodetype = 'MINMAXAVG'
-            else:
-                self.maxminmodetype = None
-        else:
-            self.maxminmodetype = None
+    def recall(self, block_size=4096, experimental=False):
+        '''EXPERIMENTAL: download the meter's recorded memory (REC), iterate the returned
+        Tc0521RecallReader for the stored records as Tc0521Reading.  The record format is a
+        guess that has not been checked against a meter, pass experimental=True to use it anyway.'''
+        if not experimental:
+            raise RuntimeError('TC0521 RECALL FORMAT IS UNVERIFIED, PASS experimental=True TO USE IT')
+        return Tc0521RecallReader(self, block_size=block_size)
+            
+class Tc0521StreamReader(object):
+    '''Continuous status reader for a TC0521.  Keeps up to depth status requests in flight and
+    frames responses out of the incoming byte stream instead of resetting the port buffers and
+    doing one blocking read per request.
+    Frames start with 0x02, end with 0x03 and carry a checksum in byte 62.  A delimited frame
+    with a bad checksum is dropped whole and counted in corrupt, misaligned bytes are skipped
+    one at a time until the next 0x02 and counted in dropped_bytes.  Bytes already received
+    are never thrown away, except after a timeout: the reader then waits settle seconds for
+    late responses and discards them, so they are not counted against the new requests.
+    Each reading is stamped (sample_t) from the send time of its request and the arrival of
+    its frame, see bkinsts.sample_time().'''
+    
+    START_BYTE = 0x02
+    END_BYTE = 0x03
+    
+    def __init__(self, meter, depth=2, timeout=1.0, settle=0.1):
+        self.meter = meter
+        self.depth = depth          # Status requests kept in flight
+        self.timeout = timeout      # Seconds without a frame before requests are considered lost
+        self.settle = settle        # Seconds to wait for late responses after a timeout before draining
+        self.buffer = bytearray()
+        self.outstanding = 0
+        self.sent = collections.deque()     # monotonic() each outstanding request was written
+        self.frame_sent = None      # Send time of the request the last frame answered, None if unknown
+        self.read_t = None          # monotonic() of the read that completed the last frame
+        self.sample_t = None        # Estimated monotonic() the last reading was taken
+        self.frames = 0             # Good frames decoded
+        self.corrupt = 0            # Delimited frames dropped for a checksum mismatch
+        self.dropped_bytes = 0      # Bytes skipped while resynchronizing on the start byte
+        self.lost = 0               # Requests that never got a response
         
-        # Byte 5 probe type
-        if self.raw_data[5] & self.bitmask_tc_k:
-            self.probe_type = 'K'
-        elif self.raw_data[5] & self.bitmask_tc_j:
-            self.probe_type = 'J'
-        elif self.raw_data[5] & self.bitmask_tc_e:
-            self.probe_type = 'E'
-        elif self.raw_data[5] & self.bitmask_tc_t:
-            self.probe_type = 'T'
-        else:
-            self.probe_type = None
+        # Only flush stale data once, before the first request goes out
+        self.port.reset_output_buffer()
+        self.port.reset_input_buffer()
+        
+    @property
+    def port(self):
+        # Looked up on the meter every time, so a port wrapped later (insttrace) is used
+        return self.meter.port
+        
+    def request(self):
+        while self.outstanding < self.depth:
+            self.port.write(self.meter.command_A_status)
+            self.sent.append(monotonic())
+            self.outstanding += 1
+        self.port.flush()
+        
+    def drain(self):
+        '''Give up on the outstanding requests: wait settle seconds, then discard everything received.'''
+        sleep(self.settle)
+        self.port.reset_input_buffer()
+        self.dropped_bytes += len(self.buffer)
+        del self.buffer[:]
+        self.outstanding = 0
+        self.sent.clear()
+        
+    def next_frame(self):
+        '''Returns the next complete, checksum verified frame held in the buffer, or None.'''
+        while True:
+            frame, skipped = take_frame(self.buffer)
+            self.dropped_bytes += skipped
+            if frame is None:
+                return None
+            self.outstanding = max(0, self.outstanding - 1)
+            self.frame_sent = self.sent.popleft() if self.sent else None
+            if (sum(frame[1:STATUS_CHECKSUM_BYTE]) & 0xFF) != frame[STATUS_CHECKSUM_BYTE]:
+                self.corrupt += 1
+                if self.meter.instrumentation is not None:
+                    self.meter.instrumentation.checksum_failure(self.meter)
+                continue
+            return frame
             
-        # Byte 6 is probe over/under load
-        if self.raw_data[6] & self.bitmask_t1_ol:
-            self.t1_ol = True
-        else:
-            self.t1_ol = False
-        if self.raw_data[6] & self.bitmask_t2_ol:
-            self.t2_ol = True
-        else:
-            self.t2_ol = False
-        if self.raw_data[6] & self.bitmask_t3_ol:
-            self.t3_ol = True
-        else:
-            self.t3_ol = False
-        if self.raw_data[6] & self.bitmask_t4_ol:
-            self.t4_ol = True
-        else:
-            self.t4_ol = False
-        if self.raw_data[6] & self.bitmask_t1_unplug:
-            self.t1_unplug = True
-        else:
-            self.t1_unplug = False
-        if self.raw_data[6] & self.bitmask_t2_unplug:
-            self.t2_unplug = True
-        else:
-            self.t2_unplug = False
-        if self.raw_data[6] & self.bitmask_t3_unplug:
-            self.t3_unplug = True
-        else:
-            self.t3_unplug = False
-        if self.raw_data[6] & self.bitmask_t4_unplug:
-            self.t4_unplug = True
-        else:
-            self.t4_unplug = False
+    def read(self):
+        '''Returns the next Tc0521Reading, blocking until one arrives.'''
+        last_frame_time = monotonic()
+        while True:
+            frame = self.next_frame()
+            if frame is not None:
+                self.frames += 1
+                self.stamp()
+                self.request()      # Replace the answered request so the pipeline stays full
+                self.meter.raw_data = frame
+                self.meter.reading = decode_status(frame)
+                return self.meter.reading
+                
+            if monotonic() - last_frame_time > self.timeout:
+                # Responses went missing, stop waiting on them and re-issue
+                self.lost += self.outstanding
+                if self.meter.instrumentation is not None and self.outstanding:
+                    self.meter.instrumentation.retry(self.meter, self.outstanding)
+                self.drain()
+                last_frame_time = monotonic()
+            self.request()
+            
+            data = self.port.read(self.port.in_waiting or 1)
+            if data:
+                self.buffer += data
+                self.read_t = monotonic()
+                
+    def stamp(self):
+        # The frame's end arrived no later than the read that completed it
+        end = self.read_t if self.read_t is not None else monotonic()
+        start = self.frame_sent if self.frame_sent is not None else end
+        self.sample_t = sample_time(start, end, len(self.meter.command_A_status), STATUS_FRAME_LENGTH,
+                                    getattr(self.port, 'baudrate', None), self.meter.sample_offset)
+        self.meter.sample_t = self.sample_t
+        if self.meter.instrumentation is not None and self.frame_sent is not None:
+            self.meter.instrumentation.command(self.meter, 'A', end - self.frame_sent)
+                
+    def __iter__(self):
+        while True:
+            yield self.read()
+            
+class Tc0521RecallReader(Tc0521StreamReader):
+    '''EXPERIMENTAL bulk download of the records the meter logged on its own.  Sends a single recall (P)
+    command and frames the records out of large block reads as they arrive, decoding them one
+    at a time so a full memory never has to be held as readings.
+    The recall format is not documented, records are taken to be status frames with the recall
+    mode bit set.  Each record's checksum is verified, bad records are dropped and counted in
+    corrupt.  The download ends at the first frame without the recall bit (the meter is back to
+    live status) or when a read times out with no data.'''
+    
+    def __init__(self, meter, block_size=4096):
+        Tc0521StreamReader.__init__(self, meter, depth=0)
+        self.block_size = block_size    # Bytes requested per read
+        self.records = 0                # Records decoded
+        self.done = False
+        self.port.write(meter.command_P_load)
+        self.port.flush()
         
-        # Probe Temperatures
-        if self.t1_ol | self.t1_unplug:
-            self.t1 = None
-        else:
-            self.t1 = int((self.raw_data[9] << 8) | self.raw_data[10])
-            if ~self.t1_range_hi:
-                self.t1 = self.t1 / 10.0
-        if self.t2_ol | self.t2_unplug:
-            self.t2 = None
-        else:
-            self.t2 = int((self.raw_data[11] << 8) | self.raw_data[12])
-            if ~self.t2_range_hi:
-                self.t2 = self.t2 / 10.0
-        if self.t3_ol | self.t3_unplug | (self.t1t2_mode == True):
-            self.t3 = None
-        else:
-            self.t3 = int((self.raw_data[13] << 8) | self.raw_data[14])
-            if ~self.t3_range_hi:
-                self.t3 = self.t3 / 10.0
-        if self.t4_ol | self.t4_unplug | (self.t1t2_mode == True):
-            self.t4 = None
-        else:
-            self.t4 = int((self.raw_data[15] << 8) | self.raw_data[16])
-            if ~self.t4_range_hi:
-                self.t4 = self.t4 / 10.0
-        if self.t1t2_mode:
-            self.t1t2 = int((self.raw_data[17] << 8) | self.raw_data[18])
-            if ~self.t1t2_range_hi:
-                self.t1t2 = self.t1t2 / 10.0
-        else:
-            self.t1t2 = None
+    def request(self):
+        pass    # The recall command is only sent once
+        
+    def read(self):
+        '''Returns the next recorded Tc0521Reading, or None once the download is complete.'''
+        while not self.done:
+            frame = self.next_frame()
+            if frame is not None:
+                reading = decode_status(frame)
+                if not reading.recall_mode:
+                    break
+                self.records += 1
+                return reading
+                
+            data = self.port.read(max(self.block_size, self.port.in_waiting))
+            if not data:
+                break
+            self.buffer += data
+        self.done = True
+        return None
+        
+    def __iter__(self):
+        while True:
+            reading = self.read()
+            if reading is None:
+                return
+            yield reading
             
-        # Convert temp units if applicable:
-        self.t1 = self.f_to_c(self.t1)
-        self.t2 = self.f_to_c(self.t2)
-        self.t3 = self.f_to_c(self.t3)
-        self.t4 = self.f_to_c(self.t4)
-        self.t1t2 = self.f_to_c(self.t1t2)
+# Decoded Command A status report.  Fields in frame order:
+#   battery                         byte 1, battery fuel gauge level
+#   t1t2_mode .. units              byte 2, temperature operating modes.  tN_range_hi is True if the
+#                                   amplitude is displayed as xxxx (>= 1000) rather than xxx.x, units is 'C' or 'F'
+#   alarm_en .. btactive            byte 3, system data (alarm enabled, reading over/under alarm value,
+#                                   recording, memory full, hold, max/min mode, bluetooth enabled)
+#   maxminmodetype                  byte 4, 'MAX', 'MIN', 'AVG', 'MINMAXAVG' or None when not in max/min mode
+#   probe_type                      byte 5, 'K', 'J', 'E', 'T' or None
+#   t1_ol .. t4_unplug              byte 6, probe over limit or unplugged
+#   t1 .. t4, t1t2                  bytes 9-18, probe temperatures in the displayed units, None if unavailable.
+#                                   Sent as tenths of a degree in either range
+#   checksum_ok                     byte 62 matches the sum of bytes 1-61
+Tc0521Reading = collections.namedtuple('Tc0521Reading', [
+    'battery',
+    't1t2_mode', 'recall_mode', 't1_range_hi', 't2_range_hi', 't3_range_hi', 't4_range_hi', 't1t2_range_hi', 'units',
+    'alarm_en', 'overtemp', 'undertemp', 'recording', 'memfull', 'holdmode', 'maxminmode', 'btactive',
+    'maxminmodetype', 'probe_type',
+    't1_ol', 't2_ol', 't3_ol', 't4_ol', 't1_unplug', 't2_unplug', 't3_unplug', 't4_unplug',
+    't1', 't2', 't3', 't4', 't1t2',
+    'checksum_ok'])
+
+STATUS_FRAME_LENGTH = 64
+STATUS_FRAME = struct.Struct('>7B2x5H')     # Bytes 0-18: start, battery, status bytes 2-6, (2 unknown), five temperatures
+STATUS_CHECKSUM_BYTE = 62
+STATUS_START_BYTE = 0x02
+STATUS_END_BYTE = 0x03
 
-        # Run Checksum
-        sum = 0
-        for i in range(1,62):
-            sum += self.raw_data[i]
+def take_frame(buffer):
+    '''Removes the next delimited status frame from the front of the bytearray buffer.
+    Returns (frame, bytes skipped), frame is None until a whole frame has arrived.  Misaligned
+    bytes are skipped one at a time until the next start byte, the checksum is not checked.'''
+    skipped = 0
+    while True:
+        start = buffer.find(STATUS_START_BYTE)
+        if start < 0:
+            skipped += len(buffer)
+            del buffer[:]
+            return None, skipped
+        if start:
+            skipped += start
+            del buffer[:start]
+        if len(buffer) < STATUS_FRAME_LENGTH:
+            return None, skipped
             
-        if (sum & 255) ^ self.raw_data[62]:
-            print("WARNING: CHECKSUM MISMATCH, NULLIFYING ALL DATA.  RETRY READ.")
-            return True
-        else:
-            return False
\ No newline at end of file
+        if buffer[STATUS_FRAME_LENGTH - 1] != STATUS_END_BYTE:
+            # Not aligned on a frame, skip this start byte and look for the next
+            skipped += 1
+            del buffer[:1]
+            continue
+            
+        frame = bytes(buffer[:STATUS_FRAME_LENGTH])
+        del buffer[:STATUS_FRAME_LENGTH]
+        return frame, skipped
+        
+
+def flag_table(masks):
+    '''Returns a 256 entry table of boolean tuples, one per mask, for every possible byte value.'''
+    return tuple(tuple(bool(value & mask) for mask in masks) for value in range(256))
+
+def first_match_table(choices):
+    '''Returns a 256 entry table holding the name of the first (mask, name) pair set in each byte value.'''
+    return tuple(next((name for mask, name in choices if value & mask), None) for value in range(256))
+
+# Status byte bitmasks in Tc0521Reading field order
+STATUS_BYTE2_MASKS = (Tc0521.bitmask_T1T2mode, Tc0521.bitmask_recallmode, Tc0521.bitmask_T1range, Tc0521.bitmask_T2range,
+                      Tc0521.bitmask_T3range, Tc0521.bitmask_T4range, Tc0521.bitmask_T1T2range, Tc0521.bitmask_units)
+STATUS_BYTE3_MASKS = (Tc0521.bitmask_alarm, Tc0521.bitmask_overtemp, Tc0521.bitmask_undertemp, Tc0521.bitmask_recording,
+                      Tc0521.bitmask_memfull, Tc0521.bitmask_holdmode, Tc0521.bitmask_maxminmode, Tc0521.bitmask_btenabled)
+STATUS_BYTE6_MASKS = (Tc0521.bitmask_t1_ol, Tc0521.bitmask_t2_ol, Tc0521.bitmask_t3_ol, Tc0521.bitmask_t4_ol,
+                      Tc0521.bitmask_t1_unplug, Tc0521.bitmask_t2_unplug, Tc0521.bitmask_t3_unplug, Tc0521.bitmask_t4_unplug)
+
+# Precomputed decode tables indexed by the raw status byte value
+STATUS_BYTE2_TABLE = tuple(flags[:7] + ('C' if flags[7] else 'F',) for flags in flag_table(STATUS_BYTE2_MASKS))
+STATUS_BYTE3_TABLE = flag_table(STATUS_BYTE3_MASKS)
+STATUS_BYTE4_TABLE = first_match_table((
+    (Tc0521.bitmask_maxmode, 'MAX'), (Tc0521.bitmask_minmode, 'MIN'),
+    (Tc0521.bitmask_avgmode, 'AVG'), (Tc0521.bitmask_maxminavgmode, 'MINMAXAVG')))
+STATUS_BYTE5_TABLE = first_match_table((
+    (Tc0521.bitmask_tc_k, 'K'), (Tc0521.bitmask_tc_j, 'J'), (Tc0521.bitmask_tc_e, 'E'), (Tc0521.bitmask_tc_t, 'T')))
+STATUS_BYTE6_TABLE = flag_table(STATUS_BYTE6_MASKS)
+
+def temperature(raw, range_hi, units):
+    # Readings are tenths of a degree in both ranges, range_hi only changes the display resolution.
+    # The meter always reports temperature in F, convert to C if applicable.
+    temp = raw / 10.0
+    if units == 'F':
+        return temp
+    return (temp - 32.0) * 5.0 / 9.0
+
+def decode_status(frame):
+    '''Decode a 64 byte Command A status frame into an immutable Tc0521Reading.'''
+    (start, battery, b2, b3, b4, b5, b6, raw1, raw2, raw3, raw4, raw12) = STATUS_FRAME.unpack_from(frame)
+    
+    modes = STATUS_BYTE2_TABLE[b2]
+    system = STATUS_BYTE3_TABLE[b3]
+    probes = STATUS_BYTE6_TABLE[b6]
+    t1t2_mode, units = modes[0], modes[7]
+    
+    # A probe that is over limit or unplugged has no temperature, T3 and T4 are not shown in T1-T2 mode
+    t1 = None if (probes[0] or probes[4]) else temperature(raw1, modes[2], units)
+    t2 = None if (probes[1] or probes[5]) else temperature(raw2, modes[3], units)
+    t3 = None if (probes[2] or probes[6] or t1t2_mode) else temperature(raw3, modes[4], units)
+    t4 = None if (probes[3] or probes[7] or t1t2_mode) else temperature(raw4, modes[5], units)
+    t1t2 = temperature(raw12, modes[6], units) if t1t2_mode else None
+    
+    checksum_ok = (sum(memoryview(frame)[1:STATUS_CHECKSUM_BYTE]) & 0xFF) == frame[STATUS_CHECKSUM_BYTE]
+    
+    return tuple.__new__(Tc0521Reading, (battery * 33,) + modes + system
+        + (STATUS_BYTE4_TABLE[b4] if system[6] else None, STATUS_BYTE5_TABLE[b5]) + probes
+        + (t1, t2, t3, t4, t1t2, checksum_ok))
+
+def decode_status_batch(frames):
+    '''Decode many status frames at once with NumPy.  frames is a bytes-like object of concatenated
+    64 byte frames or an (N, 64) uint8 array.  Returns a NumPy structured array with the Tc0521Reading
+    fields, unavailable temperatures are NaN and missing mode/probe names are empty strings.'''
+    import numpy as np     # Only needed for batch decoding
+    
+    f = np.asarray(frames, dtype=np.uint8) if hasattr(frames, 'shape') else np.frombuffer(frames, dtype=np.uint8)
+    f = f.reshape(-1, STATUS_FRAME_LENGTH)
+    
+    dtype = [('battery', np.int16)] + [(name, np.bool_) for name in Tc0521Reading._fields[1:8]] + [('units', 'U1')]
+    dtype += [(name, np.bool_) for name in Tc0521Reading._fields[9:17]] + [('maxminmodetype', 'U9'), ('probe_type', 'U1')]
+    dtype += [(name, np.bool_) for name in Tc0521Reading._fields[19:27]]
+    dtype += [(name, np.float64) for name in Tc0521Reading._fields[27:32]] + [('checksum_ok', np.bool_)]
+    out = np.empty(len(f), dtype=dtype)
+    
+    out['battery'] = f[:, 1].astype(np.int16) * 33
+    for byte, masks, names in ((2, STATUS_BYTE2_MASKS[:7], Tc0521Reading._fields[1:8]),
+                               (3, STATUS_BYTE3_MASKS, Tc0521Reading._fields[9:17]),
+                               (6, STATUS_BYTE6_MASKS, Tc0521Reading._fields[19:27])):
+        for mask, name in zip(masks, names):
+            out[name] = (f[:, byte] & mask) != 0
+    out['units'] = np.where(f[:, 2] & Tc0521.bitmask_units, 'C', 'F')
+    out['maxminmodetype'] = np.where(out['maxminmode'], np.array([x or '' for x in STATUS_BYTE4_TABLE])[f[:, 4]], '')
+    out['probe_type'] = np.array([x or '' for x in STATUS_BYTE5_TABLE])[f[:, 5]]
+    
+    raw = np.ascontiguousarray(f[:, 9:19]).view('>u2').astype(np.float64)
+    temps = raw / 10.0
+    temps = np.where((out['units'] == 'C')[:, None], (temps - 32.0) * 5.0 / 9.0, temps)
+    unavailable = np.stack([out['t1_ol'] | out['t1_unplug'], out['t2_ol'] | out['t2_unplug'],
+                            out['t3_ol'] | out['t3_unplug'] | out['t1t2_mode'], out['t4_ol'] | out['t4_unplug'] | out['t1t2_mode'],
+                            ~out['t1t2_mode']], axis=1)
+    temps[unavailable] = np.nan
+    for i, name in enumerate(Tc0521Reading._fields[27:32]):
+        out[name] = temps[:, i]
+        
+    out['checksum_ok'] = (f[:, 1:STATUS_CHECKSUM_BYTE].sum(axis=1, dtype=np.uint32) & 0xFF) == f[:, STATUS_CHECKSUM_BYTE]
+    return out
+
+def reading_property(name):
+    index = Tc0521Reading._fields.index(name)
+    def fget(self):
+        return None if self.reading is None else self.reading[index]
+    return property(fget, doc='Status field ' + name + ' of the last reading, see Tc0521Reading.')
+
+# The status attributes of Tc0521 are a read-only view of the last Tc0521Reading
+for field in Tc0521Reading._fields:
+    setattr(Tc0521, field, reading_property(field))
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""Telemetry hub, polls each instrument once and fans the samples out to every consumer.
+
+    hub = TelemetryHub()
+    hub.add_source('load', load.get_present_values, rate=10.0)
+    hub.add_source('tc0521', meter.get_reading, rate=2.0)
+    hub.add_source('supply', supply.measure_all, rate=1.0)
+    hub.start()
+    hub.serve()                             # Optional, local socket subscribers
+
+    with hub.subscribe(['tc0521']) as samples:      # In process subscriber
+        for sample in samples:
+            print(sample.t, sample.value.t1)
+
+    for sample in TelemetryClient(topics=['load']):  # From another process
+        print(sample.value['current'])
+
+Every subscriber has its own bounded queue.  A subscriber that falls behind loses its oldest
+samples (counted in dropped) and never slows the poll loops or the other subscribers."""
+
+import collections
+import os
+import socket
+import sys
+import threading
+import time
+
+from bkinsts import own_sample_t
+from broker import bind_socket, encode_value, decode_value, send_message, recv_message
+
+SOCKET_PATH = os.path.join(os.environ.get('XDG_RUNTIME_DIR', '/tmp'), 'automated-testing-telemetry.sock')
+
+Sample = collections.namedtuple('Sample', ['topic', 't', 'value'])     # t is time.monotonic() the reading was taken
+
+class Subscription(object):
+    """    Bounded, drop-oldest queue of samples for one subscriber, iterate it or call get().
+    topics is a collection of source names, None for all of them."""
+    
+    def __init__(self, hub, topics=None, maxsize=256):
+        self.hub = hub
+        self.topics = None if topics is None else frozenset(topics)
+        self.queue = collections.deque(maxlen=maxsize)
+        self.cond = threading.Condition()
+        self.delivered = 0      # Samples queued
+        self.dropped = 0        # Oldest samples discarded because the queue was full
+        self.closed = False
+    
+    def put(self, sample):
+        # Called by the poll loops
+        if self.topics is not None and sample.topic not in self.topics:
+            return
+        with self.cond:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1
+            self.queue.append(sample)
+            self.delivered += 1
+            self.cond.notify()
+    
+    def get(self, timeout=None):
+        """Returns the oldest queued sample, None on timeout or once closed."""
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.queue or self.closed, timeout):
+                return None
+            return self.queue.popleft() if self.queue else None
+    
+    def drain(self):
+        """Returns every queued sample without waiting."""
+        with self.cond:
+            samples = list(self.queue)
+            self.queue.clear()
+        return samples
+    
+    def close(self):
+        self.hub.unsubscribe(self)
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+    
+    def __iter__(self):
+        while True:
+            sample = self.get()
+            if sample is None:
+                return
+            yield sample
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+
+class PollSource(object):
+    """Calls function rate times a second on its own thread and publishes each result."""
+    
+    def __init__(self, hub, name, function, rate):
+        self.hub = hub
+        self.name = name
+        self.function = function
+        self.period = 1.0 / rate
+        self.samples = 0
+        self.errors = 0         # Polls that raised, the exception is not published
+        self.overruns = 0       # Polls that took longer than the period
+        self.thread = None
+    
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='PollSource-' + self.name, daemon=True)
+        self.thread.start()
+    
+    def run(self):
+        driver = getattr(self.function, '__self__', None)
+        deadline = time.monotonic()
+        while self.hub.running:
+            t = time.monotonic()
+            try:
+                value = self.function()
+            except Exception:
+                self.errors += 1
+            else:
+                # Use the driver's latency corrected stamp when this poll set it.  Stamps are kept per
+                # thread, another thread's transaction on the same driver cannot be picked up here.
+                sample_t = own_sample_t(driver)
+                if sample_t is not None and sample_t >= t:
+                    t = sample_t
+                self.samples += 1
+                self.hub.publish(Sample(self.name, t, value))
+            deadline += self.period
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                self.hub.stopping.wait(delay)
+            else:
+                # Fell behind, skip the missed polls rather than bursting to catch up
+                self.overruns += 1
+                deadline = time.monotonic()
+
+class TelemetryHub(object):
+    """Polls sources at fixed rates and fans their samples out to subscribers."""
+    
+    def __init__(self):
+        self.sources = {}
+        self.subscriptions = []
+        self.lock = threading.Lock()
+        self.running = False
+        self.stopping = threading.Event()
+        self.server = None
+        self.socket_path = None
+    
+    def add_source(self, name, function, rate):
+        """Poll function (e.g. load.get_present_values) rate times a second, published as topic name."""
+        source = self.sources[name] = PollSource(self, name, function, rate)
+        if self.running:
+            source.start()
+        return source
+    
+    def start(self):
+        self.running = True
+        self.stopping.clear()
+        for source in self.sources.values():
+            source.start()
+        return self
+    
+    def stop(self):
+        self.running = False
+        self.stopping.set()
+        for source in self.sources.values():
+            if source.thread is not None:
+                source.thread.join()
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+        with self.lock:
+            subscriptions = list(self.subscriptions)
+        for subscription in subscriptions:
+            subscription.close()
+    
+    def subscribe(self, topics=None, maxsize=256):
+        subscription = Subscription(self, topics, maxsize)
+        with self.lock:
+            self.subscriptions = self.subscriptions + [subscription]
+        return subscription
+    
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions = [s for s in self.subscriptions if s is not subscription]
+    
+    def publish(self, sample):
+        # The list is replaced, never modified, so it can be walked without the lock
+        for subscription in self.subscriptions:
+            subscription.put(sample)
+    
+    # Local socket subscribers
+    
+    def serve(self, socket_path=SOCKET_PATH, maxsize=256):
+        """Accept subscribers on a Unix socket from a background thread.  The socket is owner only,
+        a hub or broker still answering on socket_path is not replaced (RuntimeError)."""
+        self.server = bind_socket(socket_path)
+        self.socket_path = socket_path
+        self.server.listen(16)
+        threading.Thread(target=self.accept, args=(self.server, maxsize), name='TelemetryServer', daemon=True).start()
+    
+    def accept(self, server, maxsize):
+        while True:
+            try:
+                conn, address = server.accept()
+            except OSError:
+                return      # Closed by stop()
+            threading.Thread(target=self.send_samples, args=(conn, maxsize), name='TelemetrySubscriber', daemon=True).start()
+    
+    def send_samples(self, conn, maxsize):
+        # The first message from a subscriber is its topic list, None for everything
+        try:
+            request_id, code, topics = recv_message(conn)
+        except (EOFError, OSError, ValueError):
+            conn.close()
+            return
+        subscription = self.subscribe(topics, maxsize)
+        try:
+            sequence = 0
+            for sample in subscription:
+                sequence = (sequence + 1) & 0xFFFFFFFF
+                send_message(conn, sequence, 0, (sample.topic, sample.t, encode_value(sample.value), subscription.dropped))
+        except OSError:
+            pass    # Subscriber went away
+        finally:
+            subscription.close()
+            conn.close()
+
+class TelemetryClient(object):
+    """Subscriber in another process, iterate it for Samples.  dropped is the count the hub
+    reported for this subscriber with the last sample."""
+    
+    def __init__(self, socket_path=SOCKET_PATH, topics=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        send_message(self.sock, 0, 0, None if topics is None else list(topics))
+        self.dropped = 0
+    
+    def get(self):
+        """Returns the next Sample, None once the hub has gone."""
+        try:
+            sequence, code, (topic, t, value, dropped) = recv_message(self.sock)
+        except (EOFError, OSError):
+            return None
+        self.dropped = dropped
+        return Sample(topic, t, decode_value(value))
+    
+    def __iter__(self):
+        while True:
+            sample = self.get()
+            if sample is None:
+                return
+            yield sample
+    
+    def close(self):
+        self.sock.close()
+
+if __name__ == '__main__':
+    # Print every sample a running hub publishes
+    for sample in TelemetryClient(sys.argv[1] if len(sys.argv) > 1 else SOCKET_PATH):
+        print(sample.topic, sample.t, sample.value)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""Tests for the asyncio drivers, run against instsim."""
+
+import asyncio
+
+import pytest
+
+import instsim
+from aioinsts import AsyncBkDcLoad_8500, AsyncBkTrippleSupply_9129B, AsyncSerialTransport, AsyncTc0521
+from bkinsts import BkTrippleSupply_9129B
+from interlock import Interlock, InterlockTripped
+
+def run(test, *ports):
+    '''Run test(transports...) on a fresh event loop, each port wrapped in an AsyncSerialTransport.'''
+    async def main():
+        transports = [AsyncSerialTransport(port, asyncio.get_running_loop()) for port in ports]
+        try:
+            return await test(*transports)
+        finally:
+            for transport in transports:
+                transport.close()
+    return asyncio.run(main())
+
+def make_supply(transport, **kwargs):
+    supply = AsyncBkTrippleSupply_9129B(transport, pacing='fixed', **kwargs)
+    supply.cmd_delay = 0.0
+    return supply
+
+def operations(supply):
+    # The same operations for either driver, yields after each so the async one can await it
+    yield supply.set_voltage_ch(1, 5.0)
+    yield supply.set_voltage_ch(1, 5.0)
+    yield supply.set_current_ch(1, 1.5)
+    yield supply.enable_output_ch(2)
+    yield supply.enable_output_ch(2)
+    yield supply.set_voltage_ch(3, 12.0)
+    yield supply.disable_output_ch(2)
+
+def test_supply_sends_what_the_blocking_driver_sends():
+    rm = instsim.SimResourceManager(baudrate=None, timeout=50)
+    blocking = BkTrippleSupply_9129B('SIM', rm=rm, pacing='fixed')
+    blocking.pacer.fixed_delay = 0.0
+    sim = rm.resources['SIM']
+    del sim.log[:]
+    for operation in operations(blocking):
+        pass
+    port = instsim.Sim9129BSerial(baudrate=None)
+    async def test(transport):
+        supply = make_supply(transport)
+        for operation in operations(supply):
+            await operation
+        assert supply.state.voltage_setpoint == {1: 5.0, 3: 12.0} and supply.state.output_state == {2: False}
+    run(test, port)
+    assert port.supply.log == sim.log
+    assert port.supply.voltage == sim.voltage and port.supply.output == sim.output
+
+def test_supply_batch_and_resync():
+    port = instsim.Sim9129BSerial(baudrate=None)
+    async def test(transport):
+        supply = make_supply(transport)
+        async with supply.batch() as batch:
+            for chan in (1, 2, 3):
+                batch.set_voltage_ch(chan, 2.0 * chan)
+            batch.enable_output_all()
+        assert port.supply.log[-1] == 'APPL:VOLT 2.0,4.0,6.0;:OUTP:STAT:ALL ON'
+        port.supply.voltage[2] = 9.0
+        await supply.resync()
+        assert supply.state.voltage_setpoint == {1: 2.0, 2: 9.0, 3: 6.0}
+        assert await supply.read_output_state_all() == (True, True, True)
+        written = len(port.supply.log)
+        await supply.set_voltage_ch(2, 9.0)
+        await supply.set_voltage_ch(3, 1.0)
+        assert port.supply.log[written:] == ['VOLTage 1.0V']     # CH3 is left selected by the resync
+    run(test, port)
+
+def test_supply_opc_pacing():
+    port = instsim.Sim9129BSerial(baudrate=None)
+    async def test(transport):
+        supply = AsyncBkTrippleSupply_9129B(transport)
+        await supply.set_current_ch(2, 0.5)
+        assert await supply.get_current_setpoint_ch(2) == 0.5
+        supply.invalidate_cache()
+        assert await supply.get_current_setpoint_ch(2) == 0.5
+    run(test, port)
+    assert port.supply.log[:2] == ['INSTrument:SELect CH2;*OPC?', 'CURRent 0.5A;*OPC?']
+
+def test_outputs_refused_while_tripped():
+    supply_port, load_port = instsim.Sim9129BSerial(baudrate=None), instsim.Sim8500Serial(baudrate=None)
+    async def test(supply_transport, load_transport):
+        supply, load = make_supply(supply_transport), AsyncBkDcLoad_8500(load_transport)
+        interlock = Interlock()
+        supply.interlock = load.interlock = interlock
+        interlock.trip('manual', 'test')
+        for turn_on in (supply.enable_output_all, lambda: supply.enable_output_ch(1), lambda: supply.write('OUTP:STAT:ALL ON'),
+                        load.enable_load):
+            with pytest.raises(InterlockTripped):
+                await turn_on()
+        with pytest.raises(InterlockTripped):
+            async with supply.batch() as batch:
+                batch.enable_output_ch(3)
+        await supply.disable_output_all()
+        await load.disable_load()
+        assert interlock.reset(1.0)
+        await supply.enable_output_ch(1)
+        await load.enable_load()
+    run(test, supply_port, load_port)
+    assert supply_port.supply.output == {1: True, 2: False, 3: False} and load_port.load_on
+
+def test_meter_recall_is_opt_in():
+    port = instsim.SimTc0521Serial(baudrate=None)
+    port.memory = [[80.0, 81.0, 82.0, 83.0]] * 3
+    async def test(transport):
+        meter = AsyncTc0521(transport, timeout=0.05)
+        with pytest.raises(RuntimeError):
+            async for reading in meter.recall():
+                pass
+        return [reading.t2 async for reading in meter.recall(experimental=True)]
+    assert run(test, port) == [81.0] * 3
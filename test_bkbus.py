@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""Tests for the BK8500 multi-drop bus, run against instsim."""
+
+import pytest
+
+import instsim
+from bkbus import Bk8500Bus
+
+@pytest.fixture
+def bus():
+    sims = [instsim.Sim8500Serial(address=address, baudrate=None) for address in (1, 2, 3)]
+    bus = Bk8500Bus(port=instsim.Sim8500Bus(sims, baudrate=None, timeout=0.01), timeout=0.1)
+    yield bus
+    bus.close()
+
+def test_map_answers_every_load(bus):
+    loads = [bus.load(address, cache=False) for address in (1, 2, 3)]
+    for i, load in enumerate(loads):
+        load.set_current_setpoint(0.5 * (i + 1))
+    assert bus.map(lambda load: load.get_current_setpoint(), loads) == [0.5, 1.0, 1.5]
+    assert bus.responses == 6 and bus.unmatched == bus.stale == bus.timeouts == 0
+
+@pytest.mark.parametrize('late', ['set_current_setpoint', 'read_present_counts'])
+def test_late_answer_is_drained_as_stale(bus, late):
+    load = bus.load(1, cache=False)
+    load.set_voltage_setpoint(12.0)
+    bus.port.latency = 0.15     # The answer to the next request comes after its timeout
+    if late == 'set_current_setpoint':
+        with pytest.raises(ValueError):
+            load.set_current_setpoint(1.0)
+    else:
+        assert load.read_present_counts() is None
+    bus.port.latency = 0.0
+    assert load.get_voltage_setpoint() == 12.0     # Not the late status or present values
+    assert bus.timeouts == 1 and bus.stale == 1 and bus.unmatched == 0
+
+def test_lost_answer_does_not_block_the_next_request(bus):
+    load = bus.load(2, cache=False)
+    load.set_current_setpoint(2.0)
+    bus.port.drop_rate = 1.0
+    assert load.read_present_counts() is None
+    bus.port.drop_rate = 0.0
+    assert load.get_current_setpoint() == 2.0
+    assert bus.timeouts == 1 and bus.stale == 0
+
+def test_lost_answer_does_not_cascade(bus):
+    load = bus.load(2)
+    bus.port.drop_rate = 1.0
+    assert load.read_present_counts() is None
+    bus.port.drop_rate = 0.0
+    # Each poll is answered, not drained as the late answer of the one before
+    assert all(load.read_present_counts() is not None for i in range(4))
+    assert bus.timeouts == 1 and bus.stale == 0
+
+def test_corrupt_runs_counted_and_resynchronized(bus):
+    load = bus.load(3, cache=False)
+    bus.port.corrupt_rate = 1.0
+    assert all(load.read_present_counts() is None for i in range(5))
+    bus.port.corrupt_rate = 0.0
+    assert load.read_present_counts() is not None
+    assert 1 <= bus.corrupt <= 5 and bus.dropped_bytes > 0
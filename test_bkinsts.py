@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""Tests for the BK8500 and 9129B drivers, run against instsim."""
+
+import pytest
+
+import instsim
+from bkinsts import BkDcLoad_8500, BkTrippleSupply_9129B, Bk9129BBatch, ScpiPacer
+
+def make_load(**kwargs):
+    return BkDcLoad_8500(port=instsim.Sim8500Serial(baudrate=None), **kwargs)
+
+def make_supply(pacing='fixed', **kwargs):
+    rm = instsim.SimResourceManager(baudrate=None, timeout=50, **kwargs)
+    supply = BkTrippleSupply_9129B('SIM', rm=rm, pacing=pacing)
+    supply.pacer.fixed_delay = 0.0
+    return supply, rm.resources['SIM']
+
+# 8500 codec
+
+@pytest.mark.parametrize('setter, getter, value', [
+    ('set_current_setpoint', 'get_current_setpoint', 1.2345),
+    ('set_voltage_setpoint', 'get_voltage_setpoint', 11.999),
+    ('set_power_setpoint', 'get_power_setpoint', 150.25),
+    ('set_resistance_setpoint', 'get_resistance_setpoint', 7.5),
+    ('set_uvlo_setpoint', 'get_uvlo_setpoint', 10.4),
+    ('set_max_current_limit', 'get_max_current_limit', 20.0),
+    ('set_mode', 'get_mode', 'CW'),
+    ('set_list_file_name', 'get_list_file_name', 'SOAK'),
+])
+def test_8500_round_trip(setter, getter, value):
+    load = make_load(cache=False)
+    getattr(load, setter)(value)
+    assert getattr(load, getter)() == value
+
+def test_8500_list_step_round_trip():
+    load = make_load(cache=False)
+    load.set_list_step('CC', 2, 1.5, 0.25)
+    assert load.get_list_step('CC', 2) == (1.5, 0.25)
+
+def test_8500_checksum():
+    load = BkDcLoad_8500.unconnected()
+    load.encode_command(load.cmd_set_cc_mode_current, 1.0)
+    packet = bytes(load.tx_buff)
+    assert len(packet) == load.PACKET_LENGTH and packet[0] == load.START_BYTE
+    assert packet[-1] == sum(packet[:-1]) & 0xFF == load.calc_checksum(packet)
+
+def test_8500_bad_checksum_rejected():
+    load = make_load(cache=False)
+    sim = load.sp
+    load.encode_command(load.cmd_set_cc_mode_current, 1.0)
+    load.tx_buff[load.CHECKSUM_OFFSET] ^= 0xFF
+    load.transact()
+    assert load.rx_buff[3] == load.STATUS_BAD_CHECKSUM
+    with pytest.raises(ValueError):
+        load.decode_response(load.cmd_set_cc_mode_current, 1.0)
+    assert sim.values[load.GET_CC_MODE_CURRENT] == 0
+
+def test_8500_corrupt_response_counts():
+    load = make_load()
+    assert load.read_present_counts() is not None
+    load.sp.corrupt_rate = 1.0
+    assert all(load.read_present_counts() is None for i in range(20))
+
+def test_8500_read_load_state():
+    load = make_load()
+    assert load.read_load_state() is False
+    load.enable_load()
+    assert load.read_load_state() is True
+
+# 9129B batch
+
+def test_batch_merges_all_channel_settings():
+    supply, sim = make_supply()
+    batch = Bk9129BBatch(supply)
+    for chan in (1, 2, 3):
+        batch.set_voltage_ch(chan, 5.0 * chan)
+        batch.set_current_ch(chan, 1.0)
+    batch.enable_output_all()
+    assert batch.commands() == ['APPL:VOLT 5.0,10.0,15.0', 'APPL:CURR 1.0,1.0,1.0', 'OUTP:STAT:ALL ON']
+    assert batch.lines() == ['APPL:VOLT 5.0,10.0,15.0;:APPL:CURR 1.0,1.0,1.0;:OUTP:STAT:ALL ON']
+
+def test_batch_orders_off_before_setpoints_before_on():
+    supply, sim = make_supply()
+    supply.select_channel(2)
+    batch = Bk9129BBatch(supply)
+    batch.enable_output_ch(1)
+    batch.set_voltage_ch(1, 3.3)
+    batch.disable_output_ch(3)
+    batch.set_current_ch(2, 0.5)
+    assert batch.commands() == ['INST:SEL CH3', 'SOUR:CHAN:OUTP:STAT OFF',
+                                'INST:SEL CH1', 'VOLT 3.3V', 'SOUR:CHAN:OUTP:STAT ON',
+                                'INST:SEL CH2', 'CURR 0.5A']
+
+def test_batch_splits_long_lines():
+    supply, sim = make_supply()
+    batch = Bk9129BBatch(supply)
+    batch.MAX_LINE_LENGTH = 40
+    for chan in (1, 2):
+        batch.set_voltage_ch(chan, 1.25 * chan)
+        batch.set_current_ch(chan, 0.125 * chan)
+        batch.enable_output_ch(chan)
+    lines = batch.lines()
+    assert len(lines) > 1 and all(len(line) <= batch.MAX_LINE_LENGTH for line in lines)
+    assert ';:'.join(lines).split(';:') == batch.commands()
+    batch.send()
+    assert sim.voltage == {1: 1.25, 2: 2.5, 3: 0.0} and sim.current[2] == 0.25 and sim.output == {1: True, 2: True, 3: False}
+
+def test_batch_drops_cached_operations():
+    supply, sim = make_supply()
+    supply.set_voltage_ch(1, 5.0)
+    written = len(sim.log)
+    with supply.batch() as batch:
+        batch.set_voltage_ch(1, 5.0)
+    assert len(sim.log) == written
+
+# Shadow state caches
+
+def test_supply_cache_hit_and_invalidate():
+    supply, sim = make_supply()
+    supply.set_voltage_ch(1, 5.0)
+    written = len(sim.log)
+    supply.set_voltage_ch(1, 5.0)
+    supply.enable_output_ch(2)
+    supply.enable_output_ch(2)
+    assert len(sim.log) == written + 2      # The select and the enable, both repeats skipped
+    supply.invalidate_cache()
+    supply.set_voltage_ch(1, 5.0)
+    assert sim.log[-2:] == ['INSTrument:SELect CH1', 'VOLTage 5.0V']
+
+def test_supply_resync_reads_front_panel_changes():
+    supply, sim = make_supply()
+    supply.set_voltage_ch(1, 5.0)
+    sim.voltage[1] = 7.0
+    supply.set_voltage_ch(1, 5.0)
+    assert sim.voltage[1] == 7.0            # Not seen until the shadow state is refreshed
+    supply.resync()
+    supply.set_voltage_ch(1, 5.0)
+    assert sim.voltage[1] == 5.0
+
+def test_load_cache_hit_and_invalidate():
+    load = make_load()
+    load.set_current_setpoint(1.5)
+    commands = load.sp.commands
+    load.set_current_setpoint(1.5)
+    assert load.get_current_setpoint() == 1.5
+    assert load.sp.commands == commands
+    load.invalidate_cache()
+    assert load.get_current_setpoint() == 1.5
+    assert load.sp.commands == commands + 1
+
+# 9129B pacing
+
+class SleepRecorder(object):
+    def __init__(self):
+        self.slept = []
+    def sleep(self, driver, seconds):
+        self.slept.append(seconds)
+
+def test_pacer_records_preempted_sleep_as_elapsed():
+    pacer = ScpiPacer(None)
+    pacer.instrumentation = SleepRecorder()
+    pacer.lock.preempted.set()
+    pacer.sleep(1.0)
+    assert pacer.instrumentation.slept[0] < 0.5
+    pacer.lock.preempted.clear()
+    pacer.sleep(0.02)
+    assert pacer.instrumentation.slept[1] >= 0.02
+
+def test_supply_defaults_to_opc_pacing():
+    rm = instsim.SimResourceManager(baudrate=None, timeout=50)
+    assert BkTrippleSupply_9129B('SIM', rm=rm).pacer.mode == 'opc'
+
+# Sim9129B faults against the pacer
+
+def test_rejected_setting_reported_by_errors():
+    supply, sim = make_supply(pacing='opc')
+    sim.error_rate = 1.0
+    supply.set_voltage_ch(1, 5.0)
+    sim.error_rate = 0.0
+    assert supply.errors() == ['-200,"Execution error"'] * 2     # The select and the voltage
+    assert supply.errors() == []
+
+def test_pacer_drains_errors_when_opc_fails():
+    supply, sim = make_supply(pacing='opc')
+    sim.error_rate = 1.0
+    sim.drop_rate = 1.0
+    supply.set_voltage_ch(1, 5.0)
+    sim.error_rate = sim.drop_rate = 0.0
+    assert sim.errors == [] and sim.injected >= 4
+
+def test_pacer_falls_back_when_opc_is_lost():
+    supply, sim = make_supply(pacing='opc')
+    sim.drop_rate = 1.0
+    supply.set_voltage_ch(2, 3.0)
+    sim.drop_rate = 0.0
+    assert sim.voltage[2] == 3.0
+    assert 'VOLTAGE' not in supply.pacer.latencies
+    assert supply.pacer.sync()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""Tests for BkLoadStream, run against instsim."""
+
+import threading
+
+import numpy as np
+import pytest
+
+import instsim
+from bkinsts import BkDcLoad_8500
+
+def make_load(baudrate=None):
+    load = BkDcLoad_8500(port=instsim.Sim8500Serial(baudrate=baudrate))
+    load.set_mode('CC')
+    load.set_current_setpoint(1.0)
+    load.enable_load()
+    return load
+
+def test_stream_fills_the_ring_in_time_order():
+    load = make_load()
+    with load.stream(capacity=16) as stream:
+        samples = []
+        for sample in stream:
+            samples.append(sample)
+            if len(samples) == 20:
+                break
+    assert all(sample[2] == 1.0 for sample in samples)
+    snapshot = stream.snapshot()
+    assert len(snapshot['t']) == 16 and np.all(np.diff(snapshot['t']) > 0)
+    assert stream.latest()[0] == snapshot['t'][-1]
+    with pytest.raises(IndexError):
+        stream.sample(0)
+
+def test_command_finishes_while_streaming():
+    load = make_load(baudrate=9600)     # Wire time on, the reader is never idle
+    with load.stream() as stream:
+        done = threading.Event()
+        def script():
+            load.set_current_setpoint(0.5)
+            done.set()
+        threading.Thread(target=script, daemon=True).start()
+        assert done.wait(2.0)
+        start = stream.count
+        for t, voltage, current, power in stream:
+            if current == 0.5:
+                break
+    assert stream.count > start and stream.error is None
+
+def test_read_error_stops_the_stream_and_is_raised():
+    load = make_load()
+    calls = []
+    read = load.read_present_counts
+    def failing():
+        calls.append(1)
+        if len(calls) > 5:
+            raise IOError('PORT GONE')
+        return read()
+    load.read_present_counts = failing
+    stream = load.stream().start()
+    with pytest.raises(IOError):
+        for sample in stream:
+            pass
+    assert stream.count == 5 and not stream.running
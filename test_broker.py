@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""Tests for the instrument broker, serving the simulated instruments."""
+
+import argparse
+import threading
+import time
+
+import pytest
+
+import broker
+
+@pytest.fixture
+def client(tmp_path):
+    path = str(tmp_path / 'broker.sock')
+    server = broker.InstrumentBroker(broker.open_instruments(argparse.Namespace(sim=True)), path)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    for attempt in range(500):
+        try:
+            client = broker.BrokerClient(path)
+            break
+        except OSError:
+            time.sleep(0.01)     # Not listening yet
+    yield client
+    client.close()
+    server.shutdown()
+
+def test_calls_are_forwarded(client):
+    assert client.instruments() == {'supply': 'BkTrippleSupply_9129B', 'load': 'BkDcLoad_8500', 'tc0521': 'Tc0521'}
+    load = client.instrument('load')
+    load.set_current_setpoint(1.5)
+    assert load.get_current_setpoint() == 1.5
+    assert type(client.instrument('tc0521').get_reading()).__name__ == 'Tc0521Reading'
+
+def test_blocked_and_unknown_calls_reply_an_error(client):
+    for call in (lambda: client.instrument('load').close(), lambda: client.instrument('tc0521').recall(),
+                 lambda: client.call('scope', 'identify')):
+        with pytest.raises(RuntimeError):
+            call()
+
+@pytest.mark.parametrize('body', [None, 1, ('load',), ('load', 'get_mode', (), {}, 1), ('load', 7, (), {}),
+                                  ('load', 'get_mode', None, {}), ('load', 'get_mode', 5, {}),
+                                  ('load', 'get_mode', (), None), ('load', 'get_mode', (), {1: 2}), ([1], 'get_mode', (), {})])
+def test_malformed_call_replies_an_error(client, body):
+    with pytest.raises(RuntimeError, match='BAD CALL REQUEST'):
+        client.request(broker.CALL, body)
+    assert client.instrument('load').get_mode() == 'CC'     # The connection is still served
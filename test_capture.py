@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""Tests for the capture writer and reader, including captures continued after a reboot."""
+
+import numpy as np
+import pytest
+
+import capture
+from capture import LOAD_COLUMNS, CaptureReader, CaptureWriter
+
+class Clock(object):
+    # Stands in for the time module, monotonic() counts from boot and time() = monotonic() + offset
+    def __init__(self, offset, monotonic):
+        self.offset = offset
+        self.now = monotonic
+    def monotonic(self):
+        return self.now
+    def time(self):
+        return self.now + self.offset
+
+def reading(i):
+    return {'voltage': 12.0, 'current': 0.1 * i, 'power': 1.2 * i}
+
+def test_range_is_half_open_and_copies_nothing(tmp_path):
+    path = str(tmp_path / 'load')
+    with CaptureWriter(path, LOAD_COLUMNS, chunk_rows=4) as writer:
+        for i in range(10):
+            writer.append(reading(i), t=float(i))
+    reader = CaptureReader(path)
+    window = reader.range(2.0, 5.0)
+    np.testing.assert_array_equal(window['t'], [2.0, 3.0, 4.0])
+    np.testing.assert_allclose(window['current'], [0.2, 0.3, 0.4])
+    assert isinstance(window['t'], np.memmap) and len(reader.range(None, 0.5)['t']) == 1
+    assert len(reader.range(9.5)['t']) == 0 and len(reader.range()['t']) == 10
+    assert reader.records(8.0)['power'].tolist() == pytest.approx([9.6, 10.8])
+
+def test_reopen_continues_and_refresh_sees_new_rows(tmp_path):
+    path = str(tmp_path / 'load')
+    with CaptureWriter(path, LOAD_COLUMNS) as writer:
+        writer.extend([1.0, 2.0], current=[0.1, 0.2])
+    reader = CaptureReader(path)
+    writer = CaptureWriter(path, LOAD_COLUMNS)
+    with pytest.raises(ValueError):
+        writer.append(reading(0), t=1.5)
+    writer.append({'current': 0.3}, t=3.0)
+    assert len(reader) == 2 and reader.refresh() == 3
+    np.testing.assert_array_equal(reader['t'], [1.0, 2.0, 3.0])
+    assert np.isnan(reader['voltage']).all()
+    writer.close()
+    with pytest.raises(ValueError):
+        CaptureWriter(path, LOAD_COLUMNS[:2])
+
+@pytest.mark.parametrize('boots', [('a', 'b', 'b'), (None, None, None)])
+def test_capture_continued_after_a_reboot(tmp_path, monkeypatch, boots):
+    path = str(tmp_path / 'load')
+    sessions = iter(zip(boots, (Clock(1e6, 100.0), Clock(1e6 + 500.0, 5.0), Clock(1e6 + 500.2, 50.0))))
+    def open_session():
+        boot, clock = next(sessions)
+        monkeypatch.setattr(capture, 'boot_id', lambda: boot)
+        monkeypatch.setattr(capture, 'time', clock)
+        return CaptureWriter(path, LOAD_COLUMNS), clock
+    writer, clock = open_session()
+    writer.extend([100.0, 101.0])
+    writer.close()
+    # Rebooted 400 s after the last row, monotonic() starts again near zero
+    writer, clock = open_session()
+    writer.append(reading(1), t=5.0)
+    writer.close()
+    writer, clock = open_session()      # Same boot again, the clock was adjusted a little
+    writer.append(reading(2), t=50.0)
+    writer.close()
+    reader = CaptureReader(path)
+    np.testing.assert_array_equal(reader['t'], [100.0, 101.0, 505.0, 550.0])
+    np.testing.assert_allclose(reader.wall_time(reader['t']), [1e6 + 100.0, 1e6 + 101.0, 1e6 + 505.0, 1e6 + 550.0])
+    assert [(session['row'], session['shift']) for session in reader.sessions] == [(0, 0.0), (2, 500.0), (3, 500.0)]
+    assert len(reader.range(500.0, 600.0)['t']) == 2
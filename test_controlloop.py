@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""Tests for the control loop and its laws, run against instsim."""
+
+import instsim
+from bkinsts import BkDcLoad_8500
+from controlloop import ConstantPowerDischarge, ControlLoop
+
+def make_load(source_resistance=0.3):
+    return BkDcLoad_8500(port=instsim.Sim8500Serial(baudrate=None, source_resistance=source_resistance))
+
+def test_discharge_ends_at_the_cutoff_and_zeroes_the_setpoint():
+    load = make_load()
+    law = ConstantPowerDischarge(power=20.0, cutoff_voltage=11.5)
+    result = ControlLoop(load, law, rate=50.0).run(duration=3.0)
+    assert result['end_reason'] == 'cutoff' and result['end_voltage'] <= 11.5 and result['capacity_ah'] > 0.0
+    assert abs(load.get_uvlo_setpoint() - 11.4) < 1e-6      # The backstop sits below the cutoff
+    assert load.sp.values[load.GET_CC_MODE_CURRENT] == 0     # The final 0 A went out after the last read
+    assert not load.sp.load_on
+
+def test_discharge_ends_when_the_load_stops_drawing():
+    load = make_load()
+    law = ConstantPowerDischarge(power=20.0, cutoff_voltage=11.0, uvlo_margin=-0.6)   # UVLO trips above the cutoff
+    result = ControlLoop(load, law, rate=50.0).run(duration=3.0)
+    assert result['end_reason'] == 'no current' and result['duration_s'] < 2.0
+
+def test_law_can_be_run_again():
+    load = make_load()
+    law = ConstantPowerDischarge(power=20.0, cutoff_voltage=11.5)
+    loop = ControlLoop(load, law, rate=50.0)
+    first = loop.run(duration=3.0)
+    iterations = loop.stats.iterations
+    second = loop.run(duration=3.0)
+    assert loop.stats.iterations > iterations
+    assert second['end_reason'] == 'cutoff' and second['duration_s'] > 0.0
+    assert second['capacity_ah'] < 1.5 * first['capacity_ah']    # Not added to the first run's
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""Tests for the port probes and the discovery cache, run against instsim."""
+
+import collections
+
+import pytest
+
+import discover
+import instsim
+
+PortInfo = collections.namedtuple('PortInfo', 'device vid pid serial_number')
+
+@pytest.fixture
+def bench(monkeypatch, tmp_path):
+    '''A bench with a load, a meter and a port answering nothing, all on USB adapters.'''
+    ports = [PortInfo('/dev/ttyUSB0', 0x0403, 0x6001, 'LOAD'), PortInfo('/dev/ttyUSB1', 0x10C4, 0xEA60, 'METER'),
+             PortInfo('/dev/ttyUSB2', 0x067B, 0x2303, 'OTHER')]
+    sims = {'/dev/ttyUSB0': lambda: instsim.Sim8500Serial(baudrate=None, timeout=0.05),
+            '/dev/ttyUSB1': lambda: instsim.SimTc0521Serial(baudrate=None, timeout=0.05),
+            '/dev/ttyUSB2': lambda: instsim.Sim8500Serial(baudrate=None, timeout=0.05, drop_rate=1.0)}
+    opened = []
+    def open_port(port, timeout, write_timeout):
+        opened.append(port)
+        return sims[port]()
+    monkeypatch.setattr(discover.serial_ports, 'comports', lambda: ports)
+    monkeypatch.setattr(discover.serial, 'Serial', open_port)
+    return opened, str(tmp_path / 'ports.json')
+
+def test_probes_identify_their_device():
+    assert discover.probe_bk8500(instsim.Sim8500Serial(baudrate=None)) == 'BK8500'
+    assert discover.probe_tc0521(instsim.SimTc0521Serial(baudrate=None)) == 'TC0521'
+    assert discover.probe_bk8500(instsim.SimTc0521Serial(baudrate=None, timeout=0.05)) is None
+    assert discover.probe_tc0521(instsim.Sim8500Serial(baudrate=None, timeout=0.05)) is None
+
+def test_discover_probes_once_then_uses_the_cache(bench):
+    opened, cache_path = bench
+    expected = {'BK8500': ['/dev/ttyUSB0'], 'TC0521': ['/dev/ttyUSB1']}
+    assert discover.discover(timeout=0.05, cache_path=cache_path) == expected
+    assert sorted(opened) == ['/dev/ttyUSB0', '/dev/ttyUSB1', '/dev/ttyUSB2']
+    cache = discover.load_cache(cache_path)
+    assert cache['0403:6001:LOAD'] == 'BK8500' and list(cache['unknown']) == ['067B:2303:OTHER']
+    del opened[:]
+    assert discover.discover(timeout=0.05, cache_path=cache_path) == expected
+    assert discover.find_port('TC0521', cache_path=cache_path) == '/dev/ttyUSB1'
+    assert opened == []
+
+def test_partial_discover_does_not_mark_ports_unknown(bench):
+    opened, cache_path = bench
+    assert discover.discover(['TC0521'], timeout=0.05, cache_path=cache_path) == {'TC0521': ['/dev/ttyUSB1']}
+    assert discover.load_cache(cache_path)['unknown'] == {}
+
+def test_unknown_ports_expire(bench):
+    opened, cache_path = bench
+    discover.discover(timeout=0.05, cache_path=cache_path)
+    cache = discover.load_cache(cache_path)
+    assert discover.unknown_ports(cache, now=cache['unknown']['067B:2303:OTHER'] + discover.UNKNOWN_TTL) == set()
+
+def test_forget_removes_a_cached_port(bench):
+    opened, cache_path = bench
+    discover.discover(timeout=0.05, cache_path=cache_path)
+    discover.forget('/dev/ttyUSB0', cache_path=cache_path)
+    assert '0403:6001:LOAD' not in discover.load_cache(cache_path)
+    del opened[:]
+    assert discover.find_port('BK8500', timeout=0.05, cache_path=cache_path) == '/dev/ttyUSB0'
+    assert opened == ['/dev/ttyUSB0']
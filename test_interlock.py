@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""Tests for the interlock trip, latch and reset, run against instsim."""
+
+import threading
+
+import pytest
+
+import instsim
+from bkinsts import BkDcLoad_8500, BkTrippleSupply_9129B, PriorityLock
+from interlock import Interlock, InterlockTripped
+from tc0521 import Tc0521
+
+@pytest.fixture
+def rig():
+    load = BkDcLoad_8500(port=instsim.Sim8500Serial(baudrate=None))
+    load.set_mode('CC')
+    load.set_current_setpoint(1.0)
+    load.enable_load()
+    supply = BkTrippleSupply_9129B('SIM', rm=instsim.SimResourceManager(baudrate=None), pacing='fixed')
+    supply.pacer.fixed_delay = 0.0
+    supply.enable_output_all()
+    meter = Tc0521(port=instsim.SimTc0521Serial(baudrate=None))
+    interlocks = []
+    yield supply, load, meter, interlocks
+    for interlock in interlocks:
+        interlock.stop()
+
+def test_over_temperature_trips_and_switches_off(rig):
+    supply, load, meter, interlocks = rig
+    interlock = Interlock(supply=supply, load=load, meter=meter, max_temp=150.0)
+    interlocks.append(interlock.start())
+    meter.port.temps[1] = 200.0
+    event = interlock.wait(5.0)
+    assert event is not None and event.rule == 'max_temp'
+    assert event.confirmed == {'supply': True, 'load': True}
+    assert not any(supply.ps.output.values()) and not load.sp.load_on
+    trip = interlock.report()['trips'][0]
+    assert trip['detection_s'] >= 0.0 and set(trip['off_latency_s']) == {'supply', 'load'}
+
+def test_trip_latches_until_reset(rig):
+    supply, load, meter, interlocks = rig
+    interlock = Interlock(supply=supply, load=load)
+    interlock.trip('manual', 'TEST')
+    assert interlock.wait(5.0).rule == 'manual'
+    for turn_on in (supply.enable_output_all, lambda: supply.enable_output_ch(2), load.enable_load,
+                    lambda: supply.write('OUTPut:STATe:ALL ON')):
+        with pytest.raises(InterlockTripped):
+            turn_on()
+    with pytest.raises(InterlockTripped):
+        with supply.batch() as batch:
+            batch.set_voltage_ch(1, 3.0)
+            batch.enable_output_ch(1)
+    assert not any(supply.ps.output.values()) and not load.sp.load_on
+    supply.set_voltage_ch(1, 3.0)           # Settings that leave the outputs off still go through
+    
+    interlock.trip('manual', 'AGAIN')       # Latched, no second trip
+    assert len(interlock.trips) == 1
+    assert interlock.reset()
+    supply.enable_output_ch(1)
+    load.enable_load()
+    assert supply.ps.output[1] and load.sp.load_on
+
+def test_load_limit_and_watcher_failure(rig):
+    supply, load, meter, interlocks = rig
+    interlock = Interlock(load=load, load_limits={'current': (None, 0.5)})
+    interlocks.append(interlock.start())
+    event = interlock.wait(5.0)
+    assert event.rule == 'load_current' and event.sample_t is not None and event.trip_t >= event.sample_t
+    interlock.stop()
+    interlock.reset()
+    
+    def broken():
+        raise IOError('PORT GONE')
+    load.read_present_counts = broken
+    interlock = Interlock(load=load, stale_timeout=None, retry_delay=0.01)
+    interlocks.append(interlock.start())
+    event = interlock.wait(5.0)
+    assert event.rule == 'watch_load' and interlock.failures['load'] >= 1
+
+def test_stale_watchdog(rig):
+    supply, load, meter, interlocks = rig
+    meter.port.drop_rate = 1.0
+    interlock = Interlock(supply=supply, meter=meter, stale_timeout=0.1)
+    interlocks.append(interlock.start())
+    event = interlock.wait(5.0)
+    assert event.rule == 'stale_tc0521' and not any(supply.ps.output.values())
+
+def test_script_command_finishes_while_the_watcher_polls():
+    load = BkDcLoad_8500(port=instsim.Sim8500Serial())     # Wire time on, the watcher is never idle
+    interlock = Interlock(load=load).start()
+    try:
+        done = threading.Event()
+        def script():
+            load.set_current_setpoint(0.5)
+            load.set_mode('CC')
+            done.set()
+        threading.Thread(target=script, daemon=True).start()
+        assert done.wait(2.0)
+        assert interlock.checks['load'] > 0 and interlock.tripped is None
+    finally:
+        interlock.stop()
+
+def test_priority_lock_serves_normal_acquires_in_order():
+    lock = PriorityLock()
+    order = []
+    lock.acquire()
+    threads = []
+    for i in range(5):
+        thread = threading.Thread(target=lambda i=i: (lock.acquire(), order.append(i), lock.release()), daemon=True)
+        thread.start()
+        threads.append(thread)
+        while lock.next_ticket < i + 2:     # Queued before the next one starts
+            threading.Event().wait(0.001)
+    lock.release()
+    for thread in threads:
+        thread.join(2.0)
+    assert order == list(range(5))
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""Tests for the rollup tiers against a brute force aggregate of the raw samples."""
+
+import numpy as np
+import pytest
+
+from rollup import RollupBuffer
+
+TIERS = ((1.0, 1000), (10.0, 100), (60.0, 10))
+
+def samples(n=3000, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.cumsum(rng.uniform(0.05, 0.5, n))
+    values = rng.normal(size=(n, 2))
+    values[rng.random(n) < 0.1, 0] = np.nan     # Unplugged probe readings
+    return t, values
+
+def brute_force(t, values, width):
+    buckets = np.floor_divide(t, width)
+    rows = {'t': [], 'count': [], 'a_min': [], 'a_max': [], 'a_mean': [], 'b_min': [], 'b_max': [], 'b_mean': []}
+    for bucket in np.unique(buckets):
+        block = values[buckets == bucket]
+        rows['t'].append(bucket * width)
+        rows['count'].append(np.sum(~np.isnan(block), axis=0).max())
+        for j, name in enumerate('ab'):
+            column = block[:, j][~np.isnan(block[:, j])]
+            rows[name + '_min'].append(column.min() if len(column) else np.nan)
+            rows[name + '_max'].append(column.max() if len(column) else np.nan)
+            rows[name + '_mean'].append(column.mean() if len(column) else np.nan)
+    return dict((name, np.array(column)) for name, column in rows.items())
+
+def check(rows, expected):
+    for name in expected:
+        np.testing.assert_allclose(rows[name], expected[name], err_msg=name)
+
+@pytest.mark.parametrize('block_size', [1, 7, 500, 3000])
+def test_tiers_match_brute_force(block_size):
+    t, values = samples()
+    buffer = RollupBuffer(['a', 'b'], raw_capacity=256, tiers=TIERS)
+    for start in range(0, len(t), block_size):
+        buffer.extend(t[start:start + block_size], a=values[start:start + block_size, 0], b=values[start:start + block_size, 1])
+    for width, capacity in TIERS:
+        expected = brute_force(t, values, width)
+        check(buffer.rows(width), dict((name, column[-capacity - 1:-1]) for name, column in expected.items()))
+    # Only the finest tier's open bucket holds every sample so far, coarser ones only see closed buckets
+    width, capacity = TIERS[0]
+    check(buffer.rows(width, include_open=True), dict((name, column[-capacity - 1:]) for name, column in brute_force(t, values, width).items()))
+    buffer.flush()
+    for width, capacity in TIERS:
+        expected = brute_force(t, values, width)
+        check(buffer.rows(width), dict((name, column[-capacity:]) for name, column in expected.items()))
+
+def test_raw_ring_keeps_the_latest_samples():
+    t, values = samples(600)
+    buffer = RollupBuffer(['a', 'b'], raw_capacity=256, tiers=TIERS)
+    buffer.extend(t, a=values[:, 0], b=values[:, 1])
+    raw = buffer.raw()
+    np.testing.assert_array_equal(raw['t'], t[-256:])
+    np.testing.assert_array_equal(raw['b'], values[-256:, 1])
+    np.testing.assert_array_equal(buffer.raw(10)['t'], t[-10:])
+
+def test_rejects_backwards_timestamps_and_appends_after_flush():
+    buffer = RollupBuffer(['a'], tiers=TIERS)
+    buffer.append({'a': 1.0}, 5.0)
+    with pytest.raises(ValueError):
+        buffer.append({'a': 1.0}, 4.0)
+    with pytest.raises(ValueError):
+        buffer.extend([6.0, 5.5], a=[1.0, 2.0])
+    buffer.flush()
+    with pytest.raises(ValueError):
+        buffer.append({'a': 1.0}, 5.2)
+    assert len(buffer.rows(1.0)['t']) == 1
+
+def test_tiers_must_be_whole_multiples():
+    with pytest.raises(ValueError):
+        RollupBuffer(['a'], tiers=((1.0, 10), (2.5, 10)))
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""Tests for the TC0521 status decoders and stream reader, run against instsim."""
+
+import math
+import random
+
+import numpy as np
+import pytest
+
+import instsim
+from tc0521 import Tc0521, Tc0521Reading, STATUS_FRAME_LENGTH, STATUS_CHECKSUM_BYTE, decode_status, decode_status_batch, take_frame
+
+def random_frames(n, seed=0):
+    rng = random.Random(seed)
+    frames = [bytes([0x02]) + bytes(rng.getrandbits(8) for i in range(STATUS_FRAME_LENGTH - 1)) for i in range(n)]
+    sim = instsim.SimTc0521Serial()
+    frames.append(bytes(sim.status_frame()))
+    frames.append(bytes(sim.status_frame(temps=(None, 1234.0, -40.5, 72.0))))
+    return frames
+
+def same(value, batch_value):
+    if value is None:
+        return batch_value == '' or (isinstance(batch_value, float) and math.isnan(batch_value))
+    if isinstance(value, float):
+        return abs(value - batch_value) < 1e-9
+    return value == batch_value
+
+def test_batch_matches_single_decode():
+    frames = random_frames(500)
+    batch = decode_status_batch(b''.join(frames))
+    assert len(batch) == len(frames)
+    for i, frame in enumerate(frames):
+        reading = decode_status(frame)
+        for name in Tc0521Reading._fields:
+            assert same(getattr(reading, name), batch[name][i].item()), (i, name)
+
+def test_batch_accepts_an_array():
+    frames = random_frames(20, seed=1)
+    array = np.frombuffer(b''.join(frames), dtype=np.uint8).reshape(-1, STATUS_FRAME_LENGTH)
+    from_array, from_bytes = decode_status_batch(array), decode_status_batch(b''.join(frames))
+    for name in from_bytes.dtype.names:
+        np.testing.assert_array_equal(from_array[name], from_bytes[name])
+
+def test_checksum():
+    frame = bytearray(instsim.SimTc0521Serial().status_frame())
+    assert decode_status(frame).checksum_ok
+    frame[STATUS_CHECKSUM_BYTE] ^= 0x01
+    assert not decode_status(frame).checksum_ok
+    assert not decode_status_batch(bytes(frame))['checksum_ok'][0]
+
+# Command A report written out by hand from the documented layout: battery 3, T1 in the high (xxxx)
+# range, units F, K probe, T1 1234.5, T2-T4 72.5, checksum 0xF6 over bytes 1-61
+HIGH_RANGE_FRAME = bytes.fromhex(
+    '020304000001000000303902d502d502d5000000000000000000000000000000'
+    '000000000000000000000000000000000000000000000000000000000000f603')
+
+def test_high_range_reading_is_tenths():
+    reading = decode_status(HIGH_RANGE_FRAME)
+    assert reading.checksum_ok and reading.t1_range_hi and not reading.t2_range_hi
+    assert reading.units == 'F' and reading.probe_type == 'K'
+    assert (reading.t1, reading.t2, reading.t3, reading.t4, reading.t1t2) == (1234.5, 72.5, 72.5, 72.5, None)
+    batch = decode_status_batch(HIGH_RANGE_FRAME)
+    assert batch['t1'][0] == 1234.5 and batch['t2'][0] == 72.5
+
+def test_take_frame_skips_misaligned_bytes():
+    frame = bytes(instsim.SimTc0521Serial().status_frame())
+    buffer = bytearray(b'\x55\x66' + frame + frame[:10])
+    taken, skipped = take_frame(buffer)
+    assert bytes(taken) == frame and skipped == 2
+    assert take_frame(buffer) == (None, 0) and len(buffer) == 10
+
+def test_stream_reader_counts_corrupt_frames():
+    sim = instsim.SimTc0521Serial(baudrate=None, corrupt_rate=0.3, seed=2)
+    meter = Tc0521(port=sim)
+    reader = meter.stream(depth=2)
+    readings = [reader.read() for i in range(50)]
+    assert all(reading.t1 == 72.5 for reading in readings)
+    assert reader.frames == 50 and reader.corrupt + reader.dropped_bytes > 0
+    assert reader.sample_t is not None and meter.sample_t == reader.sample_t
+
+def test_recall_is_opt_in():
+    meter = Tc0521(port=instsim.SimTc0521Serial(baudrate=None))
+    with pytest.raises(RuntimeError):
+        meter.recall()
+
+def test_recall_reader_stops_at_live_status():
+    # Only the reader mechanics, the sim's record format is the same guess as the reader's
+    sim = instsim.SimTc0521Serial(baudrate=None, timeout=0.05)
+    sim.memory = [[70.0 + i, 71.0, 72.0, 73.0] for i in range(5)]
+    meter = Tc0521(port=sim)
+    reader = meter.recall(block_size=100, experimental=True)
+    assert [reading.t1 for reading in reader] == [70.0, 71.0, 72.0, 73.0, 74.0]
+    assert reader.records == 5 and reader.done
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""Tests for the telemetry hub and its socket subscribers."""
+
+import os
+import socket
+
+import pytest
+
+from telemetry import Sample, TelemetryClient, TelemetryHub
+
+def counter():
+    count = [0]
+    def read():
+        count[0] += 1
+        return count[0]
+    return read
+
+def test_slow_subscriber_drops_oldest():
+    hub = TelemetryHub()
+    subscription = hub.subscribe(['a'], maxsize=3)
+    for i in range(5):
+        hub.publish(Sample('a', float(i), i))
+        hub.publish(Sample('b', float(i), i))
+    assert [sample.value for sample in subscription.drain()] == [2, 3, 4]
+    assert subscription.dropped == 2 and subscription.delivered == 5
+    subscription.close()
+    assert subscription.get(0.1) is None and hub.subscriptions == []
+
+def test_socket_subscriber_receives_samples(tmp_path):
+    path = str(tmp_path / 'telemetry.sock')
+    hub = TelemetryHub()
+    hub.add_source('count', counter(), rate=200.0)
+    hub.add_source('other', counter(), rate=200.0)
+    hub.start()
+    try:
+        hub.serve(path)
+        assert os.stat(path).st_mode & 0o077 == 0      # Owner only
+        client = TelemetryClient(path, ['count'])
+        samples = [client.get() for i in range(5)]
+        client.close()
+        assert all(sample.topic == 'count' for sample in samples)
+        values = [sample.value for sample in samples]
+        assert values == sorted(values)
+    finally:
+        hub.stop()
+    assert not os.path.exists(path)
+
+def test_serve_replaces_a_stale_socket_only(tmp_path):
+    path = str(tmp_path / 'telemetry.sock')
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(path)
+    stale.close()       # Left behind, nothing answers on it
+    first, second = TelemetryHub(), TelemetryHub()
+    try:
+        first.serve(path)
+        with pytest.raises(RuntimeError):
+            second.serve(path)
+        client = TelemetryClient(path)      # Still the first hub's socket
+        client.close()
+    finally:
+        first.stop()
+        second.stop()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""Tests for compile_plan() and TestPlanRunner, run against instsim."""
+
+import pytest
+
+import instsim
+from bkinsts import BkDcLoad_8500, BkTrippleSupply_9129B
+import testplan
+from testplan import StepFailed, compile_plan, describe
+
+PLAN = [
+    {'name': 'start', 'supply': {'voltage': {1: 12.0, 2: 5.0}, 'output': {1: True}},
+     'load': {'mode': 'CC', 'current': 0.5, 'enabled': True}, 'measure': ['load']},
+    {'supply': {'voltage': {1: 12.0, 2: 5.5}, 'output': {1: True}}, 'load': {'mode': 'CC', 'current': 0.5}},
+    {'load': {'current': 1.0, 'enabled': False}},
+]
+
+def test_compile_drops_redundant_operations():
+    compiled = compile_plan(PLAN)
+    assert compiled[0].settings == {
+        'supply': [('set_voltage_ch', (1, 12.0)), ('set_voltage_ch', (2, 5.0)), ('enable_output_ch', (1,))],
+        'load': [('set_mode', ('CC',)), ('set_current_setpoint', (0.5,)), ('enable_load', ())]}
+    assert compiled[1].settings == {'supply': [('set_voltage_ch', (2, 5.5))]}
+    assert compiled[2].settings == {'load': [('disable_load', ()), ('set_current_setpoint', (1.0,))]}
+    assert 'load.enable_load()' in describe(compiled)
+
+def test_compile_from_known_state_and_first_step():
+    compiled = compile_plan(PLAN, state={'load': {'mode': 'CC', 'current': 0.5, 'enabled': True}})
+    assert 'load' not in compiled[0].settings
+    rest = compile_plan(PLAN, first=1)
+    assert [step.index for step in rest] == [1, 2]
+    assert rest[0].settings['load'] == [('set_mode', ('CC',)), ('set_current_setpoint', (0.5,))]
+
+def test_compile_rejects_unknown_keys():
+    for plan in ([{'supply': {'volts': {1: 1.0}}}], [{'load': {'mode': 'XX'}}], [{'wait': 1.0}], [{'measure': ['scope']}]):
+        with pytest.raises(ValueError):
+            compile_plan(plan)
+
+def make_runner():
+    load = BkDcLoad_8500(port=instsim.Sim8500Serial(baudrate=None))
+    supply = BkTrippleSupply_9129B('SIM', rm=instsim.SimResourceManager(baudrate=None), pacing='fixed')
+    supply.pacer.fixed_delay = 0.0
+    return testplan.TestPlanRunner({'supply': supply, 'load': load}), supply, load
+
+def test_run_applies_the_plan():
+    runner, supply, load = make_runner()
+    results = runner.run(compile_plan(PLAN))
+    runner.close()
+    assert [result['step'] for result in results] == [0, 1, 2]
+    assert results[0]['load']['current'] == 0.5
+    sim = supply.ps
+    assert sim.voltage[2] == 5.5 and sim.output[1] and not load.sp.load_on
+
+def test_failed_step_stops_the_run_and_retries_from_a_fresh_compile():
+    runner, supply, load = make_runner()
+    failures = [ValueError('LOAD REJECTED')]
+    set_current = load.set_current_setpoint
+    def flaky(current):
+        if current == 1.0 and failures:
+            raise failures.pop()
+        set_current(current)
+    load.set_current_setpoint = flaky
+    with pytest.raises(StepFailed) as failed:
+        runner.run(compile_plan(PLAN))
+    assert failed.value.step.index == 2 and len(failed.value.results) == 2 and list(failed.value.errors) == ['load']
+    
+    failures.append(ValueError('LOAD REJECTED'))
+    results = runner.run(compile_plan(PLAN), plan=PLAN, retries=1)
+    runner.close()
+    assert [result['step'] for result in results] == [0, 1, 2]
+    assert load.get_current_setpoint() == 1.0
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""Tests for resample() and align()."""
+
+import numpy as np
+import pytest
+
+from timebase import StreamRecorder, align, flatten, resample
+
+def test_resample_matches_interp_per_column():
+    rng = np.random.default_rng(0)
+    t = np.cumsum(rng.uniform(0.05, 0.2, 50))
+    values = rng.normal(size=(50, 3))
+    grid = np.linspace(t[0] - 0.5, t[-1] + 0.5, 200)
+    out = resample(t, values, grid)
+    for j in range(3):
+        np.testing.assert_allclose(out[:, j], resample(t, values[:, j], grid))
+        np.testing.assert_allclose(out[:, j], np.interp(grid, t, values[:, j], left=np.nan, right=np.nan))
+
+def test_resample_single_sample_matches_1d():
+    grid = np.array([0.5, 1.0, 1.5])
+    np.testing.assert_array_equal(resample([1.0], [3.0], grid), [np.nan, 3.0, np.nan])
+    np.testing.assert_array_equal(resample([1.0], [[3.0, 4.0]], grid)[:, 0], resample([1.0], [3.0], grid))
+
+def test_resample_repeated_times():
+    out = resample([0.0, 1.0, 1.0, 2.0], [[0.0], [1.0], [1.0], [2.0]], [0.5, 1.0, 1.5])
+    np.testing.assert_allclose(out[:, 0], [0.5, 1.0, 1.5])
+
+def test_align_rate_grid_covers_the_common_interval():
+    streams = {'a': (np.array([0.0, 1.0, 2.0, 3.0]), {'x': np.array([0.0, 10.0, 20.0, 30.0])}),
+               'b': (np.array([0.5, 2.5]), {'y': np.array([1.0, 3.0]), 'z': np.array([5.0, 5.0])})}
+    grid, aligned = align(streams, rate=2.0)
+    np.testing.assert_allclose(grid, [0.5, 1.0, 1.5, 2.0, 2.5])
+    np.testing.assert_allclose(aligned['a']['x'], [5.0, 10.0, 15.0, 20.0, 25.0])
+    np.testing.assert_allclose(aligned['b']['y'], [1.0, 1.5, 2.0, 2.5, 3.0])
+    np.testing.assert_allclose(aligned['b']['z'], 5.0)
+
+def test_align_reference_and_errors():
+    streams = {'a': (np.array([0.0, 1.0, 2.0]), {'x': np.array([0.0, 1.0, 2.0])}),
+               'b': (np.array([0.5, 1.5, 2.5]), {'y': np.array([0.0, 2.0, 4.0])})}
+    grid, aligned = align(streams, reference='b')
+    np.testing.assert_allclose(grid, [0.5, 1.5])
+    np.testing.assert_allclose(aligned['a']['x'], [0.5, 1.5])
+    with pytest.raises(ValueError):
+        align(streams)
+    with pytest.raises(ValueError):
+        align({'a': streams['a'], 'c': (np.array([5.0, 6.0]), {'x': np.array([0.0, 0.0])})}, rate=1.0)
+
+def test_recorder_flattens_readings():
+    columns = flatten({'v': 1, 'on': True, 'gone': None, 'name': 'skipped'})
+    assert sorted(columns) == ['gone', 'on', 'v'] and columns['v'] == 1.0 and columns['on'] == 1.0 and np.isnan(columns['gone'])
+    recorder = StreamRecorder()
+    recorder.add('s', 2.0, {'v': (1.0, None)})
+    recorder.add('s', 1.0, {'v': (3.0, 4.0)})
+    t, columns = recorder.stream('s')
+    np.testing.assert_array_equal(t, [1.0, 2.0])
+    np.testing.assert_array_equal(columns['v_1'], [3.0, 1.0])
+    assert np.isnan(columns['v_2'][1])
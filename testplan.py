@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""Declarative test plans for the 9129B, 8500 and TC0521.
+
+A plan is a list of steps, each a dict (a JSON file of the same shape works too):
+
+    plan = [
+        {'name': 'warm up',
+         'supply': {'voltage': {1: 12.0, 2: 5.0}, 'current': {1: 2.0, 2: 1.0}, 'output': {1: True, 2: True}},
+         'load': {'mode': 'CC', 'current': 0.5, 'enabled': True},
+         'dwell': 5.0,
+         'measure': ['supply', 'load', 'tc0521']},
+        {'load': {'current': 1.0}, 'dwell': 5.0, 'measure': ['load', 'tc0521']},
+    ]
+    results = TestPlanRunner({'supply': supply, 'load': load, 'tc0521': meter}).run(compile_plan(plan))
+
+compile_plan() tracks the state every step leaves the instruments in and keeps only the
+operations that change something.  Redundant mode sets, setpoints and output changes are
+dropped.  The supply operations of a step go out as one Bk9129BBatch, so selects are merged
+into a few SCPI lines.  The runner gives each instrument (port) its own worker thread.  A
+step's settings run on all ports at once, then the dwell, then the measurements at once.
+A step therefore costs the slowest instrument rather than the sum of all of them.  Give a
+step 'serial': ['supply', 'load'] when its settings must be applied in that order.
+
+The compiled stream is only right while every operation succeeds.  When one fails the runner
+lets the other ports finish, stops the plan there and raises StepFailed.  Given the plan, it
+can instead retry from a fresh compile of the rest of the plan with no known state, so every
+setting the remaining steps name is sent again."""
+
+import argparse
+import collections
+import concurrent.futures
+import json
+import sys
+import time
+
+CompiledStep = collections.namedtuple('CompiledStep', [
+    'index',        # Position in the plan
+    'name',
+    'settings',     # {instrument: [(method, args), ...]}, only instruments with something to do
+    'dwell',        # Seconds to wait after the settings before measuring
+    'measure',      # Instruments to read
+    'serial',       # Instrument order for the settings, None to apply them in parallel
+])
+
+class StepFailed(RuntimeError):
+    """A step's settings or measurements failed.  step is the CompiledStep, errors {instrument: exception}
+    and results the results of the steps completed before it."""
+    
+    def __init__(self, step, errors, results=None):
+        RuntimeError.__init__(self, 'STEP %d (%s) FAILED ON %s: %s' % (step.index, step.name, ', '.join(sorted(errors)),
+                                                                       '; '.join(repr(errors[name]) for name in sorted(errors))))
+        self.step = step
+        self.errors = errors
+        self.results = results
+
+INSTRUMENTS = ('supply', 'load', 'tc0521')
+STEP_KEYS = ('name', 'supply', 'load', 'dwell', 'measure', 'serial')
+
+# Load setpoints, step key -> driver method
+LOAD_SETPOINTS = (('current', 'set_current_setpoint'), ('voltage', 'set_voltage_setpoint'), ('power', 'set_power_setpoint'),
+                  ('resistance', 'set_resistance_setpoint'), ('uvlo', 'set_uvlo_setpoint'))
+LOAD_MODES = ('CC', 'CV', 'CW', 'CR')
+
+# Reading taken for each instrument named in a step's measure list
+MEASUREMENTS = {'supply': 'measure_all', 'load': 'get_present_values', 'tc0521': 'get_reading'}
+
+def channels(settings, key):
+    # JSON object keys are strings, channel numbers are ints
+    return sorted((int(chan), value) for chan, value in settings.get(key, {}).items())
+
+def compile_supply(settings, state):
+    ops = []
+    for key, method in (('voltage', 'set_voltage_ch'), ('current', 'set_current_ch')):
+        for chan, value in channels(settings, key):
+            if state.get((key, chan)) != value:
+                ops.append((method, (chan, value)))
+                state[(key, chan)] = value
+    for chan, enabled in channels(settings, 'output'):
+        if state.get(('output', chan)) != bool(enabled):
+            ops.append(('enable_output_ch' if enabled else 'disable_output_ch', (chan,)))
+            state[('output', chan)] = bool(enabled)
+    unknown = set(settings) - set(['voltage', 'current', 'output'])
+    if unknown:
+        raise ValueError('UNKNOWN SUPPLY SETTINGS ' + ', '.join(sorted(unknown)))
+    return ops
+
+def compile_load(settings, state):
+    ops = []
+    unknown = set(settings) - set(['mode', 'enabled']) - set(key for key, method in LOAD_SETPOINTS)
+    if unknown:
+        raise ValueError('UNKNOWN LOAD SETTINGS ' + ', '.join(sorted(unknown)))
+    enabled = settings.get('enabled')
+    # Off before anything changes, on after everything has, like Bk9129BBatch
+    if enabled is False and state.get('enabled') is not False:
+        ops.append(('disable_load', ()))
+        state['enabled'] = False
+    mode = settings.get('mode')
+    if mode is not None:
+        if mode not in LOAD_MODES:
+            raise ValueError('UNKNOWN LOAD MODE ' + str(mode))
+        if state.get('mode') != mode:
+            ops.append(('set_mode', (mode,)))
+            state['mode'] = mode
+    for key, method in LOAD_SETPOINTS:
+        value = settings.get(key)
+        if value is not None and state.get(key) != value:
+            ops.append((method, (value,)))
+            state[key] = value
+    if enabled and state.get('enabled') is not True:
+        ops.append(('enable_load', ()))
+        state['enabled'] = True
+    return ops
+
+def compile_plan(plan, state=None, first=0):
+    """Compile a plan into CompiledSteps holding only the operations that change something.
+    state is the {instrument: {setting: value}} the instruments are known to start in, first
+    the index of the step to start from.  The state after each step assumes every operation
+    before it succeeded."""
+    state = dict((name, dict(settings)) for name, settings in (state or {}).items())
+    compiled = []
+    for index, step in enumerate(plan[first:], first):
+        unknown = set(step) - set(STEP_KEYS)
+        if unknown:
+            raise ValueError('UNKNOWN STEP KEYS %s IN STEP %d' % (', '.join(sorted(unknown)), index))
+        settings = {}
+        if 'supply' in step:
+            settings['supply'] = compile_supply(step['supply'], state.setdefault('supply', {}))
+        if 'load' in step:
+            settings['load'] = compile_load(step['load'], state.setdefault('load', {}))
+        settings = dict((name, ops) for name, ops in settings.items() if ops)
+        measure = list(step.get('measure', ()))
+        for name in measure + list(step.get('serial') or ()):
+            if name not in INSTRUMENTS:
+                raise ValueError('UNKNOWN INSTRUMENT %s IN STEP %d' % (name, index))
+        compiled.append(CompiledStep(index, step.get('name', 'step %d' % index), settings, float(step.get('dwell', 0.0)),
+                                     measure, step.get('serial')))
+    return compiled
+
+def describe(compiled):
+    """The compiled command stream as text, one line per operation."""
+    lines = []
+    for step in compiled:
+        lines.append('%d %s' % (step.index, step.name))
+        for name in (step.serial or sorted(step.settings)):
+            for method, args in step.settings.get(name, ()):
+                lines.append('    %s.%s(%s)' % (name, method, ', '.join(repr(arg) for arg in args)))
+        if step.dwell:
+            lines.append('    dwell %g s' % step.dwell)
+        for name in step.measure:
+            lines.append('    %s.%s()' % (name, MEASUREMENTS[name]))
+    return '\n'.join(lines)
+
+class TestPlanRunner(object):
+    """    Runs compiled plans on {name: driver} instruments, one worker thread per instrument so
+    every port works in parallel while each port's operations stay in order."""
+    
+    def __init__(self, instruments):
+        self.instruments = instruments
+        self.workers = dict((name, concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='TestPlan-' + name))
+                            for name in instruments)
+    
+    def apply(self, name, ops):
+        instrument = self.instruments[name]
+        if name == 'supply':
+            # One batch per step, merged into as few SCPI lines as the supply allows
+            with instrument.batch() as batch:
+                for method, args in ops:
+                    getattr(batch, method)(*args)
+        else:
+            for method, args in ops:
+                getattr(instrument, method)(*args)
+    
+    def run_step(self, step):
+        """Run one CompiledStep, returns its result dict."""
+        missing = (set(step.settings) | set(step.measure)) - set(self.instruments)
+        if missing:
+            raise ValueError('STEP %d NEEDS %s' % (step.index, ', '.join(sorted(missing))))
+        start = time.monotonic()
+        if step.serial:
+            errors = {}
+            for name in step.serial:
+                if name in step.settings:
+                    errors = self.settle({name: self.workers[name].submit(self.apply, name, step.settings[name])})
+                    if errors:
+                        break       # The instruments after it keep their old settings
+        else:
+            errors = self.settle(dict((name, self.workers[name].submit(self.apply, name, ops)) for name, ops in step.settings.items()))
+        if errors:
+            self.fail(step, errors)
+        settled = time.monotonic()
+        if step.dwell:
+            time.sleep(step.dwell)
+        
+        futures = dict((name, self.workers[name].submit(getattr(self.instruments[name], MEASUREMENTS[name]))) for name in step.measure)
+        measured = time.monotonic()
+        result = {'step': step.index, 'name': step.name, 't': measured, 'settings_s': settled - start}
+        errors = self.settle(futures)
+        if errors:
+            self.fail(step, errors)
+        for name, future in futures.items():
+            result[name] = future.result()
+        result['measure_s'] = time.monotonic() - measured
+        return result
+    
+    def settle(self, futures):
+        # Waits for every port, so none is still working when a failure is raised, returns {name: exception}
+        concurrent.futures.wait(list(futures.values()))
+        return dict((name, future.exception()) for name, future in futures.items() if future.exception() is not None)
+    
+    def fail(self, step, errors):
+        # The failed instruments' shadow state can no longer be trusted, the next settings go out in full
+        for name in errors:
+            invalidate = getattr(self.instruments[name], 'invalidate_cache', None)
+            if invalidate is not None:
+                invalidate()
+        raise StepFailed(step, errors)
+    
+    def run(self, compiled, callback=None, plan=None, retries=0):
+        """Run every step in order, returns the list of step results.  callback(result) is called after each step.
+        A failed step stops the run, the steps after it were compiled assuming it succeeded and are not
+        run.  Given the plan the steps were compiled from, the rest of the plan is compiled again with no
+        known state and run from the failed step, up to retries times.  Otherwise StepFailed is raised
+        with the results so far."""
+        results = []
+        steps = list(compiled)
+        while steps:
+            step = steps.pop(0)
+            try:
+                result = self.run_step(step)
+            except StepFailed as failure:
+                failure.results = results
+                if plan is None or retries <= 0:
+                    raise
+                retries -= 1
+                steps = compile_plan(plan, first=step.index)
+                continue
+            results.append(result)
+            if callback is not None:
+                callback(result)
+        return results
+    
+    def close(self):
+        for worker in self.workers.values():
+            worker.shutdown()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compile a JSON test plan, print the command stream and optionally run it.')
+    parser.add_argument('plan', help='JSON test plan')
+    parser.add_argument('--sim', action='store_true', help='run the plan against the instsim simulators')
+    args = parser.parse_args(argv)
+    with open(args.plan) as f:
+        plan = json.load(f)
+    compiled = compile_plan(plan)
+    print(describe(compiled))
+    if args.sim:
+        import instsim
+        from bkinsts import BkTrippleSupply_9129B, BkDcLoad_8500
+        from tc0521 import Tc0521
+        runner = TestPlanRunner({'supply': BkTrippleSupply_9129B('SIM', rm=instsim.SimResourceManager()),
+                                 'load': BkDcLoad_8500(port=instsim.Sim8500Serial()),
+                                 'tc0521': Tc0521(port=instsim.SimTc0521Serial())})
+        for result in runner.run(compiled, plan=plan, retries=1):
+            print(result)
+        runner.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
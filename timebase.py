@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""Timestamped readings and alignment of several instrument streams onto one time grid.
+
+Every driver keeps sample_t, its estimate of the time.monotonic() its last reading was taken.
+bkinsts.sample_time() takes the wire time of the request and response off the transaction and
+places the reading in the middle of the instrument's own turnaround.  timed() pairs a reading
+with that timestamp:
+
+    recorder = StreamRecorder()
+    while testing:
+        recorder.add('load', *timed(load.get_present_values))
+        recorder.add('supply', *timed(supply.measure_all))
+        recorder.add('tc0521', *timed(meter.get_reading))
+    grid, aligned = align(recorder.streams(), rate=10.0)
+    efficiency = aligned['load']['power'] / aligned['supply']['power_1']
+
+Readings taken one after the other on different ports are hundreds of milliseconds apart.
+align() interpolates every stream onto the same grid, so columns with the same index describe
+the same instant.  Only the interval covered by every stream is used.  Readings are flattened
+into columns: dict keys and namedtuple fields, per channel tuples as name_1, name_2 ...,
+booleans as 0/1 and None as NaN."""
+
+import time
+
+import numpy as np
+
+from bkinsts import own_sample_t
+
+def timed(method, *args, **kwargs):
+    """Call a driver method, returns (t, reading) with t the driver's sample_t for that reading.
+    Stamps are kept per thread, other threads using the same driver do not disturb it."""
+    value = method(*args, **kwargs)
+    t = own_sample_t(getattr(method, '__self__', None))
+    return (time.monotonic() if t is None else t), value
+
+def flatten(reading):
+    """A reading as a {column: float} dict."""
+    if isinstance(reading, dict):
+        items = reading.items()
+    elif hasattr(reading, '_fields'):
+        items = zip(reading._fields, reading)
+    else:
+        items = [('value', reading)]
+    columns = {}
+    for name, value in items:
+        if isinstance(value, (tuple, list)):
+            for chan, item in enumerate(value, 1):
+                columns['%s_%d' % (name, chan)] = np.nan if item is None else float(item)
+        elif value is None:
+            columns[name] = np.nan
+        elif isinstance(value, (bool, int, float)):
+            columns[name] = float(value)
+    return columns
+
+class StreamRecorder(object):
+    """Collects timestamped readings per stream, streams() turns them into NumPy columns."""
+    
+    def __init__(self):
+        self.times = {}
+        self.rows = {}
+    
+    def add(self, name, t, reading):
+        self.times.setdefault(name, []).append(t)
+        self.rows.setdefault(name, []).append(flatten(reading))
+    
+    def stream(self, name):
+        """Returns (t, {column: array}) for one stream, sorted by time."""
+        t = np.asarray(self.times[name], dtype=np.float64)
+        rows = self.rows[name]
+        order = np.argsort(t, kind='stable')
+        names = sorted(set().union(*rows))
+        columns = dict((column, np.array([row.get(column, np.nan) for row in rows], dtype=np.float64)[order]) for column in names)
+        return t[order], columns
+    
+    def streams(self):
+        return dict((name, self.stream(name)) for name in self.times)
+
+def resample(t, values, grid):
+    """Linearly interpolate values taken at the increasing times t onto grid, NaN outside t.
+    values is 1-D or 2-D with one row per time, every column is interpolated in one pass."""
+    t = np.asarray(t, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    grid = np.asarray(grid, dtype=np.float64)
+    if values.ndim == 1:
+        return np.interp(grid, t, values, left=np.nan, right=np.nan)
+    out = np.full((len(grid), values.shape[1]), np.nan)
+    if len(t) < 2:
+        # Like np.interp, a single sample is only known at its own time
+        if len(t):
+            out[grid == t[0]] = values[0]
+        return out
+    # Bracketing samples and weights are found once and shared by every column
+    right = np.clip(np.searchsorted(t, grid, side='right'), 1, len(t) - 1)
+    left = right - 1
+    span = t[right] - t[left]
+    weight = np.divide(grid - t[left], span, out=np.zeros_like(grid), where=span > 0)
+    inside = (grid >= t[0]) & (grid <= t[-1])
+    out[inside] = (values[left] + (values[right] - values[left]) * weight[:, None])[inside]
+    return out
+
+def common_grid(streams, rate):
+    """Evenly spaced grid at rate points a second over the interval every stream covers."""
+    start = max(t[0] for t, columns in streams.values())
+    stop = min(t[-1] for t, columns in streams.values())
+    if stop < start:
+        raise ValueError('STREAMS DO NOT OVERLAP')
+    return start + np.arange(int((stop - start) * rate) + 1) / float(rate)
+
+def align(streams, rate=None, grid=None, reference=None):
+    """Interpolate every stream in {name: (t, {column: array})} onto one grid.
+    The grid is given, or evenly spaced at rate, or the sample times of the reference stream
+    within the common interval.  Returns (grid, {name: {column: array}})."""
+    if grid is None:
+        if rate is not None:
+            grid = common_grid(streams, rate)
+        elif reference is not None:
+            start = max(t[0] for t, columns in streams.values())
+            stop = min(t[-1] for t, columns in streams.values())
+            t = streams[reference][0]
+            grid = t[(t >= start) & (t <= stop)]
+        else:
+            raise ValueError('GIVE A GRID, RATE OR REFERENCE STREAM')
+    grid = np.asarray(grid, dtype=np.float64)
+    aligned = {}
+    for name, (t, columns) in streams.items():
+        names = sorted(columns)
+        if not names:
+            aligned[name] = {}
+            continue
+        values = resample(t, np.column_stack([columns[column] for column in names]), grid)
+        aligned[name] = dict((column, values[:, i]) for i, column in enumerate(names))
+    return grid, aligned